@@ -271,6 +271,7 @@ class base_client_job(base_job.base_job):
 
         self.warning_loggers = None
         self.warning_manager = None
+        self.max_parallel = None
 
 
     def _init_drop_caches(self, drop_caches):
@@ -920,6 +920,8 @@ class base_job(object):
         messages should be logged and which should be supressed. [OPTIONAL]
     @property warning_loggers: A set of readable streams that will be monitored
         for WARN messages to be logged. [OPTIONAL]
+    @property max_parallel: The maximum number of machines worked on at once
+        by the job, all of them if 0. [OPTIONAL]
 
     Abstract methods:
         _find_base_directories [CLASSMETHOD]
@@ -86,7 +86,7 @@ class test_init(unittest.TestCase):
             'last_boot_tag', 'logging', 'machines', 'num_tests_failed',
             'num_tests_run', 'pkgmgr', 'profilers', 'resultdir',
             'run_test_cleanup', 'sysinfo', 'tag', 'user', 'use_sequence_number',
-            'warning_loggers', 'warning_manager',
+            'warning_loggers', 'warning_manager', 'max_parallel',
             ])
 
         OPTIONAL_ATTRIBUTES = set([
@@ -94,7 +94,7 @@ class test_init(unittest.TestCase):
 
             'automatic_test_tag', 'bootloader', 'control', 'harness',
             'last_boot_tag', 'num_tests_run', 'num_tests_failed', 'tag',
-            'warning_manager', 'warning_loggers',
+            'warning_manager', 'warning_loggers', 'max_parallel',
             ])
 
         def test_public_attributes_initialized(self):
@@ -435,6 +435,11 @@ class Statistic(object):
             self._min = value
 
 
+_KEYVAL_LINE_RE = re.compile(r'^([-\.\w]+)=(.*)$')
+_INT_VALUE_RE = re.compile(r'^\d+$')
+_FLOAT_VALUE_RE = re.compile(r'^(\d+\.)?\d+$')
+
+
 def read_keyval(path):
     """
     Read a key-value pair format file into a dictionary, and return it.
@@ -446,13 +451,15 @@ def read_keyval(path):
     keyval = {}
     if os.path.exists(path):
         for line in open(path):
-            line = re.sub('#.*', '', line).rstrip()
-            if not re.search(r'^[-\.\w]+=', line):
+            # drop the comment and the trailing whitespace
+            line = line.split('#', 1)[0].rstrip()
+            match = _KEYVAL_LINE_RE.match(line)
+            if not match:
                 raise ValueError('Invalid format line: %s' % line)
-            key, value = line.split('=', 1)
-            if re.search('^\d+$', value):
+            key, value = match.groups()
+            if _INT_VALUE_RE.match(value):
                 value = int(value)
-            elif re.search('^(\d+\.)?\d+$', value):
+            elif _FLOAT_VALUE_RE.match(value):
                 value = float(value)
             keyval[key] = value
     return keyval
@@ -125,7 +125,10 @@ class _DjangoBackend(_GenericBackend):
 
     def connect(self, host=None, username=None, password=None, db_name=None):
         self._connection = self._django_connection
-        self._cursor = self._connection.cursor()
+        # DatabaseConnection.execute() counts the queries made through us
+        cursor_factory = self._connection.cursor
+        self._cursor = getattr(cursor_factory, 'uncounted_cursor',
+                               cursor_factory)()
 
 
     def execute(self, query, parameters=None):
@@ -136,6 +139,75 @@ class _DjangoBackend(_GenericBackend):
             self._django_transaction.commit_unless_managed()
 
 
+class _CountingCursor(object):
+    """
+    Wraps a Django cursor, adding its queries and fetched rows to the
+    DatabaseConnection totals.
+    """
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+
+    def execute(self, *args, **kwargs):
+        DatabaseConnection.queries_executed += 1
+        return self._cursor.execute(*args, **kwargs)
+
+
+    def executemany(self, *args, **kwargs):
+        DatabaseConnection.queries_executed += 1
+        return self._cursor.executemany(*args, **kwargs)
+
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            DatabaseConnection.rows_fetched += 1
+        return row
+
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        DatabaseConnection.rows_fetched += len(rows)
+        return rows
+
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        DatabaseConnection.rows_fetched += len(rows)
+        return rows
+
+
+    def __iter__(self):
+        for row in self._cursor:
+            DatabaseConnection.rows_fetched += 1
+            yield row
+
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class _CountingCursorFactory(object):
+    def __init__(self, uncounted_cursor):
+        self.uncounted_cursor = uncounted_cursor
+
+
+    def __call__(self):
+        return _CountingCursor(self.uncounted_cursor())
+
+
+def count_django_queries():
+    """
+    Add the queries made through the Django ORM to the DatabaseConnection
+    totals, for the Django connection of the calling thread.  The queries
+    made by a DatabaseConnection using the django backend are only counted
+    once.
+    """
+    from django.db import connection
+    if not isinstance(connection.cursor, _CountingCursorFactory):
+        connection.cursor = _CountingCursorFactory(connection.cursor)
+
+
 _BACKEND_MAP = {
     'mysql': _MySqlBackend,
     'sqlite': _SqliteBackend,
@@ -159,7 +231,16 @@ class DatabaseConnection(object):
       should be passed to the constructor, not set later, and may be None, in
       which case information must be passed to connect().
     * debug - if set True, all queries will be printed before being executed
+
+    Class attributes:
+    * queries_executed, rows_fetched - running totals across every connection
+      in this process, and the Django ORM once count_django_queries() is
+      called, used to account for database work (see
+      scheduler/tick_profiler.py).
     """
+    queries_executed = 0
+    rows_fetched = 0
+
     _DATABASE_ATTRIBUTES = ('db_type', 'host', 'username', 'password',
                             'db_name')
 
@@ -275,6 +356,9 @@ class DatabaseConnection(object):
             results = self._backend.execute(query, parameters)
 
         self.rowcount = self._backend.rowcount
+        DatabaseConnection.queries_executed += 1
+        if results:
+            DatabaseConnection.rows_fetched += len(results)
         return results
 
 
@@ -341,6 +341,9 @@ class Host(model_logic.ModelWithInvalid, dbmodels.Model,
     lock_time = dbmodels.DateTimeField(null=True, blank=True, editable=False)
     dirty = dbmodels.BooleanField(default=True,
                                   editable=frontend_settings.FULL_ADMIN)
+    # bumped on every write, and when the host's labels or ACL groups change;
+    # the scheduler uses it to update its host index incrementally
+    last_modified = dbmodels.DateTimeField(auto_now=True, db_index=True)
 
     name_field = 'hostname'
     objects = model_logic.ModelWithInvalidManager()
@@ -737,6 +740,33 @@ class AclGroup(dbmodels.Model, model_logic.ModelExtensions):
         return unicode(self.name)
 
 
+def _touch_hosts_on_membership_change(sender, instance, action, pk_set,
+                                      **kwargs):
+    """
+    Bump last_modified on the hosts whose labels or ACL groups changed.  The
+    many-to-many tables have no timestamp of their own.
+    """
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if isinstance(instance, Host):
+        hosts = Host.objects.filter(id=instance.id)
+    elif action == 'pre_clear':
+        # no pk_set when clearing, but the hosts are still related here
+        if isinstance(instance, Label):
+            hosts = Host.objects.filter(labels=instance)
+        else:
+            hosts = Host.objects.filter(aclgroup=instance)
+    else:
+        hosts = Host.objects.filter(id__in=pk_set)
+    hosts.update(last_modified=datetime.now())
+
+
+dbmodels.signals.m2m_changed.connect(_touch_hosts_on_membership_change,
+                                     sender=Host.labels.through)
+dbmodels.signals.m2m_changed.connect(_touch_hosts_on_membership_change,
+                                     sender=AclGroup.hosts.through)
+
+
 class Kernel(dbmodels.Model):
     """
     A kernel configuration for a parameterized job
@@ -1152,6 +1182,9 @@ class HostQueueEntry(dbmodels.Model, model_logic.ModelExtensions):
     atomic_group = dbmodels.ForeignKey(AtomicGroup, blank=True, null=True)
     aborted = dbmodels.BooleanField(default=False)
     started_on = dbmodels.DateTimeField(null=True, blank=True)
+    # bumped on every write; the scheduler uses it to fetch only the entries
+    # that changed since its previous tick
+    last_modified = dbmodels.DateTimeField(auto_now=True, db_index=True)
 
     objects = model_logic.ExtendedManager()
 
@@ -244,6 +244,18 @@ class IterationResult(dbmodels.Model, model_logic.ModelExtensions):
         db_table = 'tko_iteration_result'
 
 
+class PackedIterations(dbmodels.Model, model_logic.ModelExtensions):
+    # the iterations of a test parsed with tko_pack_iterations, replacing its
+    # IterationAttribute and IterationResult rows.  See tko/packed_iterations.
+    test = dbmodels.ForeignKey(Test, db_column='test_idx', primary_key=True)
+    data = dbmodels.TextField()
+
+    objects = model_logic.ExtendedManager()
+
+    class Meta:
+        db_table = 'tko_packed_iterations'
+
+
 class TestLabel(dbmodels.Model, model_logic.ModelExtensions):
     name = dbmodels.CharField(max_length=80, unique=True)
     description = dbmodels.TextField(blank=True)
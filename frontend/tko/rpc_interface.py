@@ -4,6 +4,7 @@ from autotest.frontend.afe import rpc_utils, model_logic
 from autotest.frontend.afe import models as afe_models, readonly_connection
 from autotest.frontend.tko import models, tko_rpc_utils, graphing_utils
 from autotest.frontend.tko import preconfigs
+from autotest.tko import packed_iterations
 
 # table/spreadsheet view support
 
@@ -163,6 +164,10 @@ def _iteration_attributes_to_dict(attribute_list):
 def _format_iteration_keyvals(test):
     iteration_attr = _iteration_attributes_to_dict(test.iteration_attributes)
     iteration_perf = _iteration_attributes_to_dict(test.iteration_results)
+    for packed in test.packed_iterations:
+        for index, attr, perf in packed_iterations.unpack(packed.data):
+            iteration_attr.setdefault(index, {}).update(attr)
+            iteration_perf.setdefault(index, {}).update(perf)
 
     all_iterations = iteration_attr.keys() + iteration_perf.keys()
     max_iterations = max(all_iterations + [0])
@@ -189,6 +194,8 @@ def get_detailed_test_views(**filter_data):
                                                'iteration_attributes')
     models.Test.objects.populate_relationships(tests, models.IterationResult,
                                                'iteration_results')
+    models.Test.objects.populate_relationships(tests, models.PackedIterations,
+                                               'packed_iterations')
     models.Test.objects.populate_relationships(tests, models.TestLabel,
                                                'labels')
 
@@ -485,11 +492,101 @@ def get_test_attributes(**filter_data):
         models.TestAttribute.list_objects(filter_data))
 
 
+# the fields of the tko_iteration_attributes and tko_iteration_result rows
+# that packed iterations can be filtered on, with exact or "in" lookups
+_PACKED_ITERATION_FIELDS = ('iteration', 'attribute', 'value')
+
+
+def _packed_iteration_rows(filter_data, is_result):
+    """
+    Unpack the iterations of the tests matching filter_data, for the tests
+    parsed with tko_pack_iterations.
+
+    @param is_result: True for the rows the iterations would have in
+            tko_iteration_result, False for tko_iteration_attributes.
+
+    @returns A list of rows like those of list_objects(), without the
+            sorting and paging of filter_data.
+    """
+    special_params, regular_filters = (
+            models.PackedIterations._extract_special_params(filter_data))
+    test_filters, keyval_filters, unsupported = {}, [], []
+    for key, value in regular_filters.iteritems():
+        field_lookup = key.split('__', 1)
+        if field_lookup[0] in ('test', 'test_id'):
+            test_filters[key] = value
+        elif (field_lookup[0] in _PACKED_ITERATION_FIELDS and
+              field_lookup[1:] in ([], ['in'])):
+            if not field_lookup[1:]:
+                value = [value]
+            keyval_filters.append((field_lookup[0], value))
+        else:
+            unsupported.append(key)
+    unsupported.extend(key for key in ('extra_args', 'extra_where')
+                       if key in special_params)
+
+    packed_tests = models.PackedIterations.query_objects(test_filters)
+    if not packed_tests:
+        return []
+    if unsupported:
+        raise model_logic.ValidationError(
+                dict((key, 'Cannot be applied to packed iterations')
+                     for key in unsupported))
+
+    rows = []
+    for packed in packed_tests:
+        for index, attr, perf in packed_iterations.unpack(packed.data):
+            keyvals = is_result and perf or attr
+            for key, value in sorted(keyvals.iteritems()):
+                row = {'test': packed.test_id, 'iteration': index,
+                       'attribute': key, 'value': value}
+                for field, values in keyval_filters:
+                    if row[field] not in values:
+                        break
+                else:
+                    rows.append(row)
+    return rows
+
+
+def _list_iteration_keyvals(model, filter_data, is_result):
+    """
+    list_objects() of an iteration keyval model, along with the keyvals of
+    the packed iterations.
+    """
+    packed_rows = _packed_iteration_rows(filter_data, is_result)
+    if not packed_rows:
+        return model.list_objects(filter_data)
+
+    special_params, regular_filters = model._extract_special_params(
+            filter_data)
+    rows = model.list_objects(regular_filters) + packed_rows
+    # sort on the last field first, as the sort is stable
+    for field in reversed(special_params.get('sort_by') or []):
+        field_name = field.lstrip('-')
+        if field_name not in _PACKED_ITERATION_FIELDS + ('test',):
+            raise model_logic.ValidationError(
+                    {'sort_by': 'Cannot sort packed iterations on %s' %
+                     field_name})
+        rows.sort(key=operator.itemgetter(field_name),
+                  reverse=field.startswith('-'))
+
+    query_start = special_params.get('query_start')
+    query_limit = special_params.get('query_limit')
+    if query_start is not None and query_limit is None:
+        raise ValueError('Cannot pass query_start without query_limit')
+    query_start = query_start or 0
+    if query_limit is not None:
+        return rows[query_start:query_start + query_limit]
+    return rows[query_start:]
+
+
 def get_iteration_attributes(**filter_data):
     return rpc_utils.prepare_for_serialization(
-        models.IterationAttribute.list_objects(filter_data))
+        _list_iteration_keyvals(models.IterationAttribute, filter_data,
+                                is_result=False))
 
 
 def get_iteration_results(**filter_data):
     return rpc_utils.prepare_for_serialization(
-        models.IterationResult.list_objects(filter_data))
+        _list_iteration_keyvals(models.IterationResult, filter_data,
+                                is_result=True))
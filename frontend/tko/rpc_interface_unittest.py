@@ -9,7 +9,9 @@ from autotest.frontend import setup_django_environment
 from autotest.frontend import setup_test_environment
 from autotest.client.shared.test_utils import mock
 from django.db import connection
+from autotest.frontend.afe import model_logic
 from autotest.frontend.tko import models, rpc_interface
+from autotest.tko import models as tko_models, packed_iterations
 
 # this will need to be updated if the table schemas change (or removed if we
 # add proper primary keys)
@@ -485,6 +487,53 @@ class RpcInterfaceTest(unittest.TestCase, TkoTestMixin):
         self.assertEquals(groups[1]['group_count'], 1)
 
 
+    def _add_packed_iterations(self):
+        test = models.Test.objects.get(test='mytest2')
+        iterations = [tko_models.iteration(1, {'iattr': 'pval'},
+                                           {'iresult': 5, 'presult': 6}),
+                      tko_models.iteration(2, {}, {'iresult': 7})]
+        models.PackedIterations.objects.create(
+                test=test, data=packed_iterations.pack(iterations))
+        return test.test_idx
+
+
+    def test_get_iteration_results_with_packed_iterations(self):
+        test_idx = self._add_packed_iterations()
+        results = rpc_interface.get_iteration_results(test=test_idx)
+        self.assertEquals(
+                sorted((result['iteration'], result['attribute'],
+                        result['value']) for result in results),
+                [(1, 'iresult', 5), (1, 'presult', 6), (2, 'iresult', 7)])
+        self.assertEquals(set(result['test'] for result in results),
+                          set([test_idx]))
+
+        results = rpc_interface.get_iteration_results(
+                attribute='iresult', sort_by=['-value'], query_start=1,
+                query_limit=3)
+        self.assertEquals([result['value'] for result in results],
+                          [5, 3, 1])
+
+
+    def test_get_iteration_attributes_with_packed_iterations(self):
+        test_idx = self._add_packed_iterations()
+        attributes = rpc_interface.get_iteration_attributes(
+                attribute__in=['iattr'])
+        self.assertEquals(
+                sorted((attribute['test'], attribute['value'])
+                       for attribute in attributes),
+                [(self.first_test.test_idx, 'ival'), (test_idx, 'pval')])
+
+
+    def test_packed_iterations_unsupported_filter(self):
+        self._add_packed_iterations()
+        self.assertRaises(model_logic.ValidationError,
+                          rpc_interface.get_iteration_results,
+                          attribute__startswith='i')
+        self.assertRaises(model_logic.ValidationError,
+                          rpc_interface.get_iteration_results,
+                          sort_by=['test__job__tag'])
+
+
     def test_get_iteration_result_fields(self):
         num_iterations = rpc_interface.get_num_test_views(
                 iteration_result_fields=['iresult', 'iresult2'])
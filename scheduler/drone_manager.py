@@ -1,4 +1,4 @@
-import os, heapq, traceback
+import os, heapq, sys, threading, traceback, Queue
 try:
     import autotest.common as common
 except ImportError:
@@ -26,10 +26,62 @@ ALL_PIDFILE_NAMES = (AUTOSERV_PID_FILE, CRASHINFO_PID_FILE, PARSER_PID_FILE,
                      ARCHIVER_PID_FILE)
 
 
+_DEFAULT_MAX_DRONE_THREADS = 10
+_DEFAULT_REFRESH_TIMEOUT_SECS = 300
+_DEFAULT_EXECUTE_TIMEOUT_SECS = 900
+
+
 class DroneManagerError(Exception):
     pass
 
 
+def _run_in_parallel(functions, max_threads):
+    """
+    Call each function in a pool of at most max_threads threads.
+
+    @param functions: list of argumentless callables.
+    @param max_threads: maximum number of concurrent calls.  With a single
+            thread (or a single function) everything runs in the calling
+            thread.
+    @returns a list of (return value, exc_info) pairs in the order of
+            functions.  exc_info is None when the call succeeded, otherwise
+            the return value is None.
+    """
+    outcomes = [None] * len(functions)
+
+    def run_one(index):
+        try:
+            outcomes[index] = (functions[index](), None)
+        except Exception:
+            outcomes[index] = (None, sys.exc_info())
+
+    num_threads = min(max_threads, len(functions))
+    if num_threads <= 1:
+        for index in xrange(len(functions)):
+            run_one(index)
+        return outcomes
+
+    work_queue = Queue.Queue()
+    for index in xrange(len(functions)):
+        work_queue.put(index)
+
+    def worker():
+        while True:
+            try:
+                index = work_queue.get_nowait()
+            except Queue.Empty:
+                return
+            run_one(index)
+
+    threads = [threading.Thread(target=worker, name='drone_call_%d' % number)
+               for number in xrange(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return outcomes
+
+
 class CustomEquals(object):
     def _id(self):
         raise NotImplementedError
@@ -142,6 +194,8 @@ class DroneManager(object):
         self._results_dir = None
         # holds Process objects
         self._process_set = set()
+        # the Process objects of _process_set that are parse daemons
+        self._parse_daemon_process_set = set()
         # maps PidfileId to PidfileContents
         self._pidfiles = {}
         # same as _pidfiles
@@ -157,6 +211,15 @@ class DroneManager(object):
         self._attached_files = {}
         # heapq of _DroneHeapWrappers
         self._drone_queue = []
+        # maximum number of drones contacted concurrently
+        self._max_drone_threads = _DEFAULT_MAX_DRONE_THREADS
+        # maps hostname to the last successful refresh results of that drone
+        self._last_refresh_results = {}
+        # hostnames of drones whose latest refresh failed
+        self._failed_refresh_hostnames = set()
+        # maps hostname to a dict mapping the paths of the pidfiles found on
+        # that drone to (signature, parsed contents), see _process_pidfiles()
+        self._parsed_pidfiles = {}
 
 
     def initialize(self, base_results_dir, drone_hostnames,
@@ -216,6 +279,8 @@ class DroneManager(object):
 
     def _remove_drone(self, hostname):
         self._drones.pop(hostname, None)
+        self._last_refresh_results.pop(hostname, None)
+        self._parsed_pidfiles.pop(hostname, None)
 
 
     def refresh_drone_configs(self):
@@ -224,6 +289,15 @@ class DroneManager(object):
         """
         section = scheduler_config.CONFIG_SECTION
         settings.parse_config_file()
+        self._max_drone_threads = settings.get_value(
+                section, 'max_drone_threads', type=int,
+                default=_DEFAULT_MAX_DRONE_THREADS)
+        default_refresh_timeout = settings.get_value(
+                section, 'drone_refresh_timeout_secs', type=int,
+                default=_DEFAULT_REFRESH_TIMEOUT_SECS)
+        default_execute_timeout = settings.get_value(
+                section, 'drone_execute_timeout_secs', type=int,
+                default=_DEFAULT_EXECUTE_TIMEOUT_SECS)
         for hostname, drone in self._drones.iteritems():
             disabled = settings.get_value(section, '%s_disabled' % hostname,
                                           default='')
@@ -239,6 +313,13 @@ class DroneManager(object):
                 allowed_users = set(allowed_users.split())
             drone.allowed_users = allowed_users
 
+            drone.refresh_timeout = settings.get_value(
+                    section, '%s_refresh_timeout_secs' % hostname, type=int,
+                    default=default_refresh_timeout)
+            drone.execute_timeout = settings.get_value(
+                    section, '%s_execute_timeout_secs' % hostname, type=int,
+                    default=default_execute_timeout)
+
         self._reorder_drone_queue() # max_processes may have changed
 
 
@@ -268,16 +349,42 @@ class DroneManager(object):
 
     def _reset(self):
         self._process_set = set()
+        self._parse_daemon_process_set = set()
         self._pidfiles = {}
         self._pidfiles_second_read = {}
         self._drone_queue = []
 
 
+    def _run_on_all_drones(self, function, drone_list=None):
+        """
+        Call function(drone) for every drone, concurrently.
+
+        @param drone_list: the drones to call, all of them by default.
+        @returns a list of (drone, return value, exc_info) tuples sorted by
+                drone hostname, so that callers merge results in a stable
+                order no matter which drone answered first.
+        """
+        if drone_list is None:
+            drone_list = self.get_drones()
+        drone_list = sorted(drone_list, key=lambda drone: drone.hostname)
+        functions = [lambda drone=drone: function(drone)
+                     for drone in drone_list]
+        outcomes = _run_in_parallel(functions, self._max_drone_threads)
+        return [(drone, result, exc_info)
+                for drone, (result, exc_info) in zip(drone_list, outcomes)]
+
+
+    def _raise_first_error(self, outcomes):
+        for drone, result, exc_info in outcomes:
+            if exc_info:
+                raise exc_info[0], exc_info[1], exc_info[2]
+
+
     def _call_all_drones(self, method, *args, **kwargs):
-        all_results = {}
-        for drone in self.get_drones():
-            all_results[drone] = drone.call(method, *args, **kwargs)
-        return all_results
+        outcomes = self._run_on_all_drones(
+                lambda drone: drone.call(method, *args, **kwargs))
+        self._raise_first_error(outcomes)
+        return dict((drone, result) for drone, result, _ in outcomes)
 
 
     def _parse_pidfile(self, drone, raw_contents):
@@ -303,17 +410,48 @@ class DroneManager(object):
         return contents
 
 
-    def _process_pidfiles(self, drone, pidfiles, store_in_dict):
-        for pidfile_path, contents in pidfiles.iteritems():
-            pidfile_id = PidfileId(pidfile_path)
-            contents = self._parse_pidfile(drone, contents)
-            store_in_dict[pidfile_id] = contents
+    def _get_known_pidfile_signatures(self, drone):
+        parsed_pidfiles = self._parsed_pidfiles.get(drone.hostname, {})
+        return dict((path, signature) for path, (signature, contents)
+                    in parsed_pidfiles.iteritems())
+
+
+    def _process_pidfiles(self, drone, results):
+        """
+        Fill self._pidfiles and self._pidfiles_second_read from the results of
+        a drone refresh.  Drones only send back the pidfiles that changed, so
+        the parsed contents of the others are reused from the previous
+        refresh.
+        """
+        previously_parsed = self._parsed_pidfiles.get(drone.hostname, {})
+        parsed_pidfiles = {}
+        for pidfile_path, signature in (
+                results['pidfile_signatures'].iteritems()):
+            if pidfile_path in results['pidfiles']:
+                contents = self._parse_pidfile(
+                        drone, results['pidfiles'][pidfile_path])
+            else:
+                contents = previously_parsed[pidfile_path][1]
+            parsed_pidfiles[pidfile_path] = (signature, contents)
+            self._pidfiles[PidfileId(pidfile_path)] = contents
+
+        for pidfile_path in results['pidfile_signatures_second_read']:
+            if pidfile_path in results['pidfiles_second_read']:
+                contents = self._parse_pidfile(
+                        drone, results['pidfiles_second_read'][pidfile_path])
+            else:
+                # unchanged since the first read
+                contents = parsed_pidfiles[pidfile_path][1]
+            self._pidfiles_second_read[PidfileId(pidfile_path)] = contents
+
+        self._parsed_pidfiles[drone.hostname] = parsed_pidfiles
 
 
     def _add_process(self, drone, process_info):
         process = Process(drone.hostname, int(process_info['pid']),
                           int(process_info['ppid']))
         self._process_set.add(process)
+        return process
 
 
     def _add_autoserv_process(self, drone, process_info):
@@ -353,32 +491,88 @@ class DroneManager(object):
         self._drop_old_pidfiles()
         pidfile_paths = [pidfile_id.path
                          for pidfile_id in self._registered_pidfile_info]
-        all_results = self._call_all_drones('refresh', pidfile_paths)
-
-        for drone, results_list in all_results.iteritems():
-            results = results_list[0]
+        outcomes = self._run_on_all_drones(
+                lambda drone: drone.timed_call(
+                        drone.refresh_timeout, 'refresh', pidfile_paths,
+                        self._get_known_pidfile_signatures(drone)))
+
+        for drone, results_list, exc_info in outcomes:
+            if exc_info:
+                results = self._handle_refresh_failure(drone, exc_info)
+            else:
+                results = results_list[0]
+                self._last_refresh_results[drone.hostname] = results
+                self._failed_refresh_hostnames.discard(drone.hostname)
 
             for process_info in results['autoserv_processes']:
                 self._add_autoserv_process(drone, process_info)
             for process_info in results['parse_processes']:
-                self._add_process(drone, process_info)
+                process = self._add_process(drone, process_info)
+                if (process_info['comm'] ==
+                    drone_utility.PARSE_DAEMON_COMMAND):
+                    self._parse_daemon_process_set.add(process)
 
-            self._process_pidfiles(drone, results['pidfiles'], self._pidfiles)
-            self._process_pidfiles(drone, results['pidfiles_second_read'],
-                                   self._pidfiles_second_read)
+            self._process_pidfiles(drone, results)
 
             self._compute_active_processes(drone)
-            if drone.enabled:
+            if drone.enabled and not exc_info:
                 self._enqueue_drone(drone)
 
 
+    def _handle_refresh_failure(self, drone, exc_info):
+        """
+        Fall back to the previous results of a drone that failed or timed out
+        during refresh, so that a single bad drone does not take down the
+        scheduler or make its processes look lost.  The drone gets no new
+        work until it answers again.
+
+        @returns the stale refresh results for the drone.
+        @raises the original error if the drone never refreshed successfully.
+        """
+        if drone.hostname not in self._last_refresh_results:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+        message = ('Refresh of drone %s failed, reusing its previous '
+                   'results:\n%s' % (drone.hostname,
+                                     ''.join(traceback.format_exception(
+                                             *exc_info))))
+        logging.warning(message)
+        if drone.hostname not in self._failed_refresh_hostnames:
+            self._failed_refresh_hostnames.add(drone.hostname)
+            email_manager.manager.enqueue_notify_email(
+                    'Drone %s failed to refresh' % drone.hostname, message)
+        return self._last_refresh_results[drone.hostname]
+
+
     def execute_actions(self):
         """
         Called at the end of a scheduler cycle to execute all queued actions
         on drones.
+
+        Drones that failed to refresh in this cycle are not waited on again:
+        their calls stay queued until they answer a refresh.  A drone that
+        fails or times out while executing its calls has them dropped, since
+        we can't tell how many of them ran.
         """
-        for drone in self._drones.values():
-            drone.execute_queued_calls()
+        responsive_drones = []
+        for drone in self.get_drones():
+            if drone.hostname in self._failed_refresh_hostnames:
+                logging.warning('Not executing queued calls on drone %s, it '
+                                'failed to refresh', drone.hostname)
+            else:
+                responsive_drones.append(drone)
+        outcomes = self._run_on_all_drones(
+                lambda drone: drone.execute_queued_calls(
+                        timeout=drone.execute_timeout),
+                drone_list=responsive_drones)
+        unexpected_outcomes = []
+        for drone, result, exc_info in outcomes:
+            if exc_info and issubclass(exc_info[0], (error.AutoservError,
+                                                     drones.DroneAgentError)):
+                self._handle_execute_failure(drone, exc_info)
+            else:
+                unexpected_outcomes.append((drone, result, exc_info))
+        self._raise_first_error(unexpected_outcomes)
 
         try:
             self._results_drone.execute_queued_calls()
@@ -390,12 +584,25 @@ class DroneManager(object):
             self._results_drone.clear_call_queue()
 
 
+    def _handle_execute_failure(self, drone, exc_info):
+        warning = ('Drone %s failed to execute calls:\n%s' %
+                   (drone.hostname,
+                    ''.join(traceback.format_exception(*exc_info))))
+        logging.warning(warning)
+        email_manager.manager.enqueue_notify_email(
+                'Drone %s error' % drone.hostname, warning)
+        drone.clear_call_queue()
+
+
     def get_orphaned_autoserv_processes(self):
         """
         Returns a set of Process objects for orphaned processes only.
+        Parse daemons are not started by the scheduler, so they are not
+        orphans when it does not know about them.
         """
         return set(process for process in self._process_set
-                   if process.ppid == 1)
+                   if process.ppid == 1 and
+                   process not in self._parse_daemon_process_set)
 
 
     def kill_process(self, process):
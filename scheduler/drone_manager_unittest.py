@@ -5,9 +5,11 @@ try:
     import autotest.common as common
 except ImportError:
     import common
+from autotest.client.shared import error
 from autotest.client.shared.settings import settings
 from autotest.client.shared.test_utils import mock
-from autotest.scheduler import drone_manager, drones
+from autotest.scheduler import drone_manager, drone_utility, drones
+from autotest.scheduler import email_manager
 from autotest.scheduler import scheduler_config
 
 class MockDrone(drones._AbstractDrone):
@@ -323,6 +325,195 @@ class DroneManager(unittest.TestCase):
                 os.path.join(self._DRONE_RESULTS_DIR, file_path), written_data))
 
 
+    def _refresh_results(self, pidfile_id=None, pid=None, signature=(1, 2, 3),
+                         changed=True, second_read=None):
+        """
+        @param second_read: (contents, signature) of the second read, if the
+                pidfile changed in between.
+        """
+        pidfiles, signatures = {}, {}
+        if pidfile_id is not None:
+            signatures[pidfile_id.path] = signature
+            if changed:
+                pidfiles[pidfile_id.path] = '%d\n' % pid
+        pidfiles_second_read, signatures_second_read = {}, dict(signatures)
+        if second_read:
+            pidfiles_second_read[pidfile_id.path] = second_read[0]
+            signatures_second_read[pidfile_id.path] = second_read[1]
+        return [{'autoserv_processes': [], 'parse_processes': [],
+                 'pidfiles': pidfiles, 'pidfile_signatures': signatures,
+                 'pidfiles_second_read': pidfiles_second_read,
+                 'pidfile_signatures_second_read': signatures_second_read}]
+
+
+    def _stub_refresh(self, drone, *results):
+        """Make drone.timed_call('refresh', ...) return or raise results."""
+        results = list(results)
+        self.known_signatures = []
+        def timed_call(timeout, method, pidfile_paths, known_signatures):
+            self.assertEquals(method, 'refresh')
+            self.known_signatures.append(known_signatures)
+            result = results.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+        drone.timed_call = timed_call
+
+
+    def test_run_in_parallel(self):
+        def fail():
+            raise ValueError('failed')
+        outcomes = drone_manager._run_in_parallel(
+                [lambda: 1, fail, lambda: 3], max_threads=2)
+        self.assertEquals([result for result, _ in outcomes], [1, None, 3])
+        self.assertEquals(outcomes[0][1], None)
+        self.assertEquals(outcomes[1][1][0], ValueError)
+
+
+    def test_refresh_failure_reuses_previous_results(self):
+        self.god.stub_with(self.manager, '_get_max_pidfile_refreshes',
+                           lambda: 10)
+        pidfile_id = self.manager.get_pidfile_id_from('tag', 'name')
+        self.manager.register_pidfile(pidfile_id)
+        other_drone = MockDrone('another_drone')
+        self.manager._drones[other_drone.name] = other_drone
+        self._stub_refresh(self.mock_drone,
+                           self._refresh_results(pidfile_id, pid=10),
+                           error.AutoservRunError('timed out', None))
+        self._stub_refresh(other_drone, self._refresh_results(),
+                           self._refresh_results())
+        self.god.stub_function(email_manager.manager, 'enqueue_notify_email')
+
+        self.manager.refresh()
+        self.assertEquals(len(self.manager._drone_queue), 2)
+
+        email_manager.manager.enqueue_notify_email.expect_any_call()
+        self.manager.refresh()
+        self.god.check_playback()
+        # the process reported by the failed drone is still known...
+        contents = self.manager.get_pidfile_contents(pidfile_id)
+        self.assertEquals(contents.process,
+                          drone_manager.Process(self.mock_drone.name, 10))
+        # ...but the drone gets no new work until it answers again
+        queued_drones = [wrapper.drone
+                         for wrapper in self.manager._drone_queue]
+        self.assertEquals(queued_drones, [other_drone])
+
+
+    def test_refresh_reuses_unchanged_pidfiles(self):
+        pidfile_id = self.manager.get_pidfile_id_from('tag', 'name')
+        self.manager.register_pidfile(pidfile_id)
+        self._stub_refresh(
+                self.mock_drone,
+                self._refresh_results(pidfile_id, pid=10),
+                self._refresh_results(pidfile_id, changed=False,
+                                      second_read=('10\n0\n0\n', (4, 5, 6))),
+                self._refresh_results(pidfile_id, pid=10, signature=(4, 5, 6)))
+
+        self.manager.refresh()
+        first_contents = self.manager.get_pidfile_contents(pidfile_id)
+        self.assertEquals(first_contents.process,
+                          drone_manager.Process(self.mock_drone.name, 10))
+
+        # unchanged on the first read, finished by the second read
+        self.manager.refresh()
+        self.assertEquals(self.known_signatures[1],
+                          {pidfile_id.path: (1, 2, 3)})
+        self.assert_(self.manager.get_pidfile_contents(pidfile_id)
+                     is first_contents)
+        second_read = self.manager.get_pidfile_contents(pidfile_id,
+                                                        use_second_read=True)
+        self.assertEquals(second_read.exit_status, 0)
+
+        self.manager.refresh()
+        self.assertEquals(self.known_signatures[2],
+                          {pidfile_id.path: (1, 2, 3)})
+        self.assert_(self.manager.get_pidfile_contents(pidfile_id)
+                     is not first_contents)
+
+
+    def test_parse_daemons_are_not_orphans(self):
+        results = self._refresh_results()
+        results[0]['parse_processes'] = [
+                {'pid': '10', 'ppid': '1', 'pgid': '10', 'comm': 'parse'},
+                {'pid': '11', 'ppid': '1', 'pgid': '11',
+                 'comm': drone_utility.PARSE_DAEMON_COMMAND}]
+        self._stub_refresh(self.mock_drone, results)
+
+        self.manager.refresh()
+        self.assertEquals(self.manager.get_orphaned_autoserv_processes(),
+                          set([drone_manager.Process(self.mock_drone.name,
+                                                     10)]))
+        self.assert_(self.manager.is_process_running(
+                drone_manager.Process(self.mock_drone.name, 11)))
+
+
+    def test_refresh_failure_without_previous_results(self):
+        self._stub_refresh(self.mock_drone,
+                           error.AutoservRunError('timed out', None))
+        self.assertRaises(error.AutoservRunError, self.manager.refresh)
+
+
+    def test_execute_actions_runs_every_drone(self):
+        executed = []
+        class FailingDrone(MockDrone):
+            def execute_queued_calls(self, timeout=None):
+                executed.append((self.hostname, timeout))
+                raise error.AutoservRunError('timed out', None)
+        failing_drone = FailingDrone('failing_drone')
+        failing_drone.execute_timeout = 20
+        failing_drone.queue_call('kill_process', self.mock_drone_process)
+        self.manager._drones[failing_drone.name] = failing_drone
+        self.mock_drone.execute_timeout = 10
+        self.god.stub_with(
+                self.mock_drone, 'execute_queued_calls',
+                lambda timeout=None: executed.append(
+                        (self.mock_drone.hostname, timeout)))
+        self.god.stub_function(email_manager.manager, 'enqueue_notify_email')
+
+        email_manager.manager.enqueue_notify_email.expect_any_call()
+        self.manager.execute_actions()
+        self.god.check_playback()
+        self.assertEquals(sorted(executed),
+                          [('failing_drone', 20), ('mock_drone', 10)])
+        # we can't tell which calls ran, so they are not retried
+        self.assertEquals(failing_drone._calls, [])
+
+
+    def test_execute_actions_unexpected_error(self):
+        def execute_queued_calls(timeout=None):
+            raise ValueError('bug')
+        self.god.stub_with(self.mock_drone, 'execute_queued_calls',
+                           execute_queued_calls)
+        self.assertRaises(ValueError, self.manager.execute_actions)
+
+
+    def test_execute_actions_skips_drones_that_failed_refresh(self):
+        other_drone = MockDrone('another_drone')
+        self.manager._drones[other_drone.name] = other_drone
+        self._stub_refresh(self.mock_drone, self._refresh_results(),
+                           error.AutoservRunError('timed out', None))
+        self._stub_refresh(other_drone, self._refresh_results(),
+                           self._refresh_results())
+        self.god.stub_function(email_manager.manager, 'enqueue_notify_email')
+        executed = []
+        for drone in (self.mock_drone, other_drone):
+            self.god.stub_with(
+                    drone, 'execute_queued_calls',
+                    lambda timeout=None, drone=drone: executed.append(
+                            drone.hostname))
+
+        self.manager.refresh()
+        self.manager.execute_actions()
+        self.assertEquals(sorted(executed), ['another_drone', 'mock_drone'])
+
+        email_manager.manager.enqueue_notify_email.expect_any_call()
+        self.manager.refresh()
+        self.manager.execute_actions()
+        self.god.check_playback()
+        self.assertEquals(executed[2:], ['another_drone'])
+
+
     def test_pidfile_expiration(self):
         self.god.stub_with(self.manager, '_get_max_pidfile_refreshes',
                            lambda: 0)
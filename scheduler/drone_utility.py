@@ -1,7 +1,7 @@
 #!/usr/bin/python
 
 import pickle, subprocess, os, shutil, sys, time, signal, getpass, logging
-import datetime, traceback, tempfile, itertools
+import datetime, traceback, tempfile, itertools, optparse, fcntl
 try:
     import autotest.common as common
 except ImportError:
@@ -25,6 +25,13 @@ else:
 
 _TRANSFER_FAILED_FILE = '.transfer_failed'
 
+# process name of tko/parse_daemon, which parses jobs for the scheduler
+# without being one of its processes
+PARSE_DAEMON_COMMAND = 'parse_daemon'
+
+# bumped whenever the framing or the greeting of agent mode changes
+AGENT_PROTOCOL_VERSION = 1
+
 
 class _MethodCall(object):
     def __init__(self, method, args, kwargs):
@@ -50,6 +57,98 @@ def call(method, *args, **kwargs):
     return _MethodCall(method, args, kwargs)
 
 
+class _ProcessTableScanner(object):
+    """
+    Lists the processes of the current user, like "ps x", by reading /proc
+    directly.
+
+    Command lines are cached for the lifetime of each process image
+    (identified by its pid, start time and comm, since exec() changes the
+    command line but keeps the pid and start time), so after the first scan
+    only /proc/<pid>/stat is read for each process.
+    """
+    def __init__(self, proc_dir='/proc'):
+        self._proc_dir = proc_dir
+        # maps pid to (start time, comm, args) for the processes of the last
+        # scan
+        self._cache = {}
+
+
+    def is_available(self):
+        return os.path.isdir(os.path.join(self._proc_dir, 'self'))
+
+
+    def _read(self, pid, name):
+        proc_file = open(os.path.join(self._proc_dir, pid, name), 'rb')
+        try:
+            return proc_file.read()
+        finally:
+            proc_file.close()
+
+
+    @staticmethod
+    def _parse_stat(stat_data):
+        """
+        @returns a tuple (comm, ppid, pgid, start time) from the contents of
+                /proc/<pid>/stat.
+        """
+        # comm may contain spaces and parentheses itself
+        comm_start = stat_data.index('(') + 1
+        comm_end = stat_data.rindex(')')
+        # fields from the state (third field of the file) onwards
+        fields = stat_data[comm_end + 2:].split()
+        return stat_data[comm_start:comm_end], fields[1], fields[2], fields[19]
+
+
+    def _get_args(self, pid, comm, start_time):
+        cached = self._cache.get(pid)
+        if cached and cached[:2] == (start_time, comm):
+            return cached[2]
+        args = self._read(pid, 'cmdline').replace('\0', ' ').strip()
+        if not args:
+            # kernel threads and zombies, shown the same way by ps
+            args = '[%s]' % comm
+        return args
+
+
+    def scan(self):
+        """
+        @returns a list of dicts with pid, pgid, ppid, comm and args keys and
+                string values, one per process of the current user.
+        """
+        uid = os.geteuid()
+        processes = []
+        cache = {}
+        for pid in os.listdir(self._proc_dir):
+            if not pid.isdigit():
+                continue
+            try:
+                if os.stat(os.path.join(self._proc_dir, pid)).st_uid != uid:
+                    continue
+                comm, ppid, pgid, start_time = self._parse_stat(
+                        self._read(pid, 'stat'))
+                args = self._get_args(pid, comm, start_time)
+            except (EnvironmentError, ValueError, IndexError):
+                # the process went away while we were looking at it
+                continue
+            cache[pid] = (start_time, comm, args)
+            processes.append(dict(pid=pid, pgid=pgid, ppid=ppid, comm=comm,
+                                  args=args))
+        self._cache = cache
+        return processes
+
+
+    def get_start_time(self, pid):
+        """
+        @returns the start time of pid as of the last scan, or None if it
+                wasn't seen.
+        """
+        cached = self._cache.get(pid)
+        if cached:
+            return cached[0]
+        return None
+
+
 class DroneUtility(object):
     """
     This class executes actual OS calls on the drone machine.
@@ -64,6 +163,10 @@ class DroneUtility(object):
 
         self.warnings = []
         self._subcommands = []
+        self._process_scanner = _ProcessTableScanner()
+        # maps (pid, start time) to the result of _check_pid_for_dark_mark(),
+        # which can't change during the lifetime of a process
+        self._dark_mark_cache = {}
 
 
     def initialize(self, results_dir):
@@ -99,11 +202,22 @@ class DroneUtility(object):
         return DARK_MARK_ENVIRONMENT_VAR in env_data
 
 
+    def _has_dark_mark(self, pid, open=open):
+        start_time = self._process_scanner.get_start_time(pid)
+        if start_time is None:
+            return self._check_pid_for_dark_mark(pid, open=open)
+        key = (pid, start_time)
+        if key not in self._dark_mark_cache:
+            self._dark_mark_cache[key] = self._check_pid_for_dark_mark(
+                    pid, open=open)
+        return self._dark_mark_cache[key]
+
+
     _PS_ARGS = ('pid', 'pgid', 'ppid', 'comm', 'args')
 
 
     @classmethod
-    def _get_process_info(cls):
+    def _get_process_info_from_ps(cls):
         """
         @returns A generator of dicts with cls._PS_ARGS as keys and
                 string values each representing a running process.
@@ -119,20 +233,45 @@ class DroneUtility(object):
                 for line_components in split_lines)
 
 
+    def _get_process_info(self):
+        """
+        @returns A list of dicts with self._PS_ARGS as keys and string values
+                each representing a running process.  Read from /proc when
+                available, from ps otherwise.
+        """
+        if not self._process_scanner.is_available():
+            return list(self._get_process_info_from_ps())
+        processes = self._process_scanner.scan()
+        # forget the processes that are gone
+        get_start_time = self._process_scanner.get_start_time
+        for key in self._dark_mark_cache.keys():
+            pid, start_time = key
+            if get_start_time(pid) != start_time:
+                del self._dark_mark_cache[key]
+        return processes
+
+
     def _refresh_processes(self, command_name, open=open,
-                           site_check_parse=None):
+                           site_check_parse=None, process_info=None):
+        """
+        @param process_info: list of processes as returned by
+                _get_process_info(), to share one scan between several calls.
+                Scans the process table if None.
+        """
         if type(command_name) == str:
             command_name = [command_name]
+        if process_info is None:
+            process_info = self._get_process_info()
         # The open argument is used for test injection.
         check_mark = settings.get_value('SCHEDULER',
                                         'check_processes_for_dark_mark',
                                         bool, False)
         processes = []
-        for info in self._get_process_info():
+        for info in process_info:
             is_parse = (site_check_parse and site_check_parse(info))
             if info['comm'] in command_name or is_parse:
-                if (check_mark and not
-                        self._check_pid_for_dark_mark(info['pid'], open=open)):
+                if check_mark and not self._has_dark_mark(info['pid'],
+                                                          open=open):
                     self._warn('%(comm)s process pid %(pid)s has no '
                                'dark mark; ignoring.' % info)
                     continue
@@ -141,44 +280,91 @@ class DroneUtility(object):
         return processes
 
 
-    def _read_pidfiles(self, pidfile_paths):
+    @staticmethod
+    def _get_pidfile_signature(pidfile_path):
+        """
+        @returns (mtime, size, inode) of the pidfile, or None if it doesn't
+                exist.
+        """
+        try:
+            stat = os.stat(pidfile_path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+
+
+    def _read_pidfiles(self, pidfile_paths, known_signatures=None):
+        """
+        @param known_signatures: dict mapping pidfile paths to the signature
+                they had when the caller last read them.  Those pidfiles are
+                only read again if their signature changed.
+        @returns a tuple (pidfiles, signatures).  pidfiles maps paths to file
+                contents, for pidfiles that exist and changed.  signatures
+                maps the path of every existing pidfile to its signature.
+        """
+        if known_signatures is None:
+            known_signatures = {}
         pidfiles = {}
+        signatures = {}
         for pidfile_path in pidfile_paths:
-            if not os.path.exists(pidfile_path):
+            # stat before reading, so that a write racing with the read shows
+            # up as a change on the next refresh
+            signature = self._get_pidfile_signature(pidfile_path)
+            if signature is None:
                 continue
-            try:
-                file_object = open(pidfile_path, 'r')
-                pidfiles[pidfile_path] = file_object.read()
-                file_object.close()
-            except IOError:
-                continue
-        return pidfiles
+            if known_signatures.get(pidfile_path) != signature:
+                try:
+                    file_object = open(pidfile_path, 'r')
+                    pidfiles[pidfile_path] = file_object.read()
+                    file_object.close()
+                except IOError:
+                    continue
+            signatures[pidfile_path] = signature
+        return pidfiles, signatures
 
 
-    def refresh(self, pidfile_paths):
+    def refresh(self, pidfile_paths, known_pidfile_signatures=None):
         """
         pidfile_paths should be a list of paths to check for pidfiles.
+        known_pidfile_signatures, if given, maps pidfile paths to the
+        signatures returned for them by the previous refresh; the contents of
+        those pidfiles are only returned if they changed.
 
         Returns a dict containing:
         * pidfiles: dict mapping pidfile paths to file contents, for pidfiles
-        that exist.
+        that exist and changed.
+        * pidfile_signatures: dict mapping the path of every existing pidfile
+        to its (mtime, size, inode) signature.
         * autoserv_processes: list of dicts corresponding to running autoserv
         processes.  each dict contain pid, pgid, ppid, comm, and args (see
         "man ps" for details).
-        * parse_processes: likewise, for parse processes.
-        * pidfiles_second_read: same info as pidfiles, but gathered after the
-        processes are scanned.
+        * parse_processes: likewise, for parse processes, including parse
+        daemons.
+        * pidfiles_second_read, pidfile_signatures_second_read: same info as
+        pidfiles and pidfile_signatures, but gathered after the processes are
+        scanned.  Only pidfiles that changed since the first read are
+        included in pidfiles_second_read.
         """
         site_check_parse = utils.import_site_function(
                 __file__, 'autotest.scheduler.site_drone_utility',
                 'check_parse', lambda x: False)
+        pidfiles, signatures = self._read_pidfiles(pidfile_paths,
+                                                   known_pidfile_signatures)
+        process_info = self._get_process_info()
+        autoserv_processes = self._refresh_processes(
+                ['autoserv', 'autotest-remote'], process_info=process_info)
+        parse_processes = self._refresh_processes(
+                ['parse', PARSE_DAEMON_COMMAND],
+                site_check_parse=site_check_parse, process_info=process_info)
+        pidfiles_second_read, signatures_second_read = self._read_pidfiles(
+                pidfile_paths, signatures)
         results = {
-            'pidfiles' : self._read_pidfiles(pidfile_paths),
-            'autoserv_processes' : self._refresh_processes(['autoserv',
-                                                            'autotest-remote']),
-            'parse_processes' : self._refresh_processes(
-                    'parse', site_check_parse=site_check_parse),
-            'pidfiles_second_read' : self._read_pidfiles(pidfile_paths),
+            'pidfiles' : pidfiles,
+            'pidfile_signatures' : signatures,
+            'autoserv_processes' : autoserv_processes,
+            'parse_processes' : parse_processes,
+            'pidfiles_second_read' : pidfiles_second_read,
+            'pidfile_signatures_second_read' : signatures_second_read,
         }
         return results
 
@@ -443,7 +629,83 @@ def return_data(data):
     print pickle.dumps(data)
 
 
+def write_frame(output_file, data):
+    """
+    Send data as one frame: the length of the pickle on its own line, followed
+    by the pickle itself.
+    """
+    pickled_data = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+    output_file.write('%d\n%s' % (len(pickled_data), pickled_data))
+    output_file.flush()
+
+
+def read_frame(input_file):
+    """
+    Read a frame written by write_frame().
+
+    @returns the unpickled data, or None on a clean end of file.
+    @raises ValueError if the stream is truncated or not framed.
+    """
+    header = input_file.readline()
+    if not header:
+        return None
+    try:
+        size = int(header)
+    except ValueError:
+        raise ValueError('Invalid frame header: %r' % header)
+    pickled_data = input_file.read(size)
+    if len(pickled_data) != size:
+        raise ValueError('Truncated frame: expected %d bytes, got %d' %
+                         (size, len(pickled_data)))
+    return pickle.loads(pickled_data)
+
+
+def serve_agent(input_file, output_file):
+    """
+    Agent mode: keep one DroneUtility around and execute each batch of calls
+    read from input_file, answering on output_file, until end of file.
+
+    Like a one-shot run, the agent exits after a batch raises, reporting the
+    traceback to the caller instead of the results.
+    """
+    drone_utility = DroneUtility()
+    write_frame(output_file, dict(agent_version=AGENT_PROTOCOL_VERSION))
+    while True:
+        calls = read_frame(input_file)
+        if calls is None:
+            return
+        try:
+            return_value = drone_utility.execute_calls(calls)
+        except Exception:
+            write_frame(output_file, dict(error=traceback.format_exc()))
+            raise
+        write_frame(output_file, return_value)
+
+
+def _claim_stdout():
+    """
+    Keep the real stdout for frames only.  Anything else printed by this
+    process or its children goes to stderr so it can't corrupt the channel.
+    """
+    channel_fd = os.dup(sys.stdout.fileno())
+    # the processes we start (autoserv...) must not keep the channel open,
+    # or the scheduler never sees it close when we die
+    flags = fcntl.fcntl(channel_fd, fcntl.F_GETFD)
+    fcntl.fcntl(channel_fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    return os.fdopen(channel_fd, 'wb')
+
+
 def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--agent', action='store_true',
+                      help='Keep running and execute framed batches of calls '
+                           'from stdin until it is closed')
+    options, args = parser.parse_args()
+    if options.agent:
+        serve_agent(sys.stdin, _claim_stdout())
+        return
+
     calls = parse_input()
     drone_utility = DroneUtility()
     return_value = drone_utility.execute_calls(calls)
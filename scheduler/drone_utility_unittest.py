@@ -2,7 +2,7 @@
 
 """Tests for drone_utility."""
 
-import unittest
+import os, shutil, subprocess, sys, tempfile, unittest
 from cStringIO import StringIO
 
 try:
@@ -78,5 +78,245 @@ class TestDroneUtility(unittest.TestCase):
         self.god.check_playback()
 
 
+    def test_dark_mark_checked_once_per_process(self):
+        self._set_check_dark_mark(True)
+        self.god.stub_function(self.drone_utility._process_scanner,
+                               'get_start_time')
+        opened = []
+        def _open_mark(path, mode):
+            opened.append(path)
+            return StringIO('%s=\0' % drone_utility.DARK_MARK_ENVIRONMENT_VAR)
+        for start_time in ('100', '100', '200'):
+            self.drone_utility._process_scanner.get_start_time.expect_call(
+                    3).and_return(start_time)
+            processes = self.drone_utility._refresh_processes(
+                    self._fake_command, open=_open_mark,
+                    process_info=[self._fake_proc_info])
+            self.assertEqual([self._fake_proc_info], processes)
+        self.god.check_playback()
+        # the pid was reused by a new process for the last refresh
+        self.assertEqual(opened, ['/proc/3/environ', '/proc/3/environ'])
+
+
+class TestPidfileReads(unittest.TestCase):
+    def setUp(self):
+        self.drone_utility = drone_utility.DroneUtility()
+        self.results_dir = tempfile.mkdtemp()
+        self.pidfile_path = os.path.join(self.results_dir, '.autoserv_execute')
+        self.missing_path = os.path.join(self.results_dir, 'missing')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.results_dir)
+
+
+    def _write_pidfile(self, contents):
+        pidfile = open(self.pidfile_path, 'w')
+        pidfile.write(contents)
+        pidfile.close()
+
+
+    def test_read_pidfiles(self):
+        self._write_pidfile('10\n')
+        paths = [self.pidfile_path, self.missing_path]
+        pidfiles, signatures = self.drone_utility._read_pidfiles(paths)
+        self.assertEqual(pidfiles, {self.pidfile_path: '10\n'})
+        self.assertEqual(signatures.keys(), [self.pidfile_path])
+
+        # unchanged pidfiles are not read again
+        pidfiles, new_signatures = self.drone_utility._read_pidfiles(
+                paths, signatures)
+        self.assertEqual(pidfiles, {})
+        self.assertEqual(new_signatures, signatures)
+
+        self._write_pidfile('10\n0\n0\n')
+        pidfiles, new_signatures = self.drone_utility._read_pidfiles(
+                paths, signatures)
+        self.assertEqual(pidfiles, {self.pidfile_path: '10\n0\n0\n'})
+        self.assertNotEqual(new_signatures, signatures)
+
+
+    def test_refresh_skips_unchanged_pidfiles(self):
+        self._write_pidfile('10\n')
+        self.god = mock.mock_god()
+        self.god.stub_with(self.drone_utility, '_get_process_info', lambda: [])
+        try:
+            results = self.drone_utility.refresh([self.pidfile_path])
+            self.assertEqual(results['pidfiles'], {self.pidfile_path: '10\n'})
+            # nothing changed between the two reads
+            self.assertEqual(results['pidfiles_second_read'], {})
+            self.assertEqual(results['pidfile_signatures_second_read'],
+                             results['pidfile_signatures'])
+
+            results = self.drone_utility.refresh(
+                    [self.pidfile_path], results['pidfile_signatures'])
+            self.assertEqual(results['pidfiles'], {})
+            self.assertEqual(results['pidfile_signatures'].keys(),
+                             [self.pidfile_path])
+        finally:
+            self.god.unstub_all()
+
+
+class TestProcessTableScanner(unittest.TestCase):
+    def setUp(self):
+        self.proc_dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.proc_dir, 'self'))
+        self.scanner = drone_utility._ProcessTableScanner(self.proc_dir)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_dir)
+
+
+    def _write(self, pid, name, contents):
+        pid_dir = os.path.join(self.proc_dir, str(pid))
+        if not os.path.isdir(pid_dir):
+            os.mkdir(pid_dir)
+        proc_file = open(os.path.join(pid_dir, name), 'w')
+        proc_file.write(contents)
+        proc_file.close()
+
+
+    def _add_process(self, pid, comm, ppid, pgid, start_time, cmdline):
+        other_fields = ' '.join(['0'] * 16)
+        self._write(pid, 'stat', '%d (%s) S %d %d %s %s 0 0\n' %
+                    (pid, comm, ppid, pgid, other_fields, start_time))
+        self._write(pid, 'cmdline', cmdline)
+
+
+    def _scan(self):
+        return dict((info['pid'], info) for info in self.scanner.scan())
+
+
+    def test_scan(self):
+        self._add_process(10, 'autoserv', 1, 10, 500,
+                          '/usr/bin/python\0autoserv\0-m\0host\0')
+        self._add_process(11, 'odd (name)', 10, 10, 600, '')
+        processes = self._scan()
+        self.assertEqual(processes['10'],
+                         {'pid': '10', 'pgid': '10', 'ppid': '1',
+                          'comm': 'autoserv',
+                          'args': '/usr/bin/python autoserv -m host'})
+        self.assertEqual(processes['11']['comm'], 'odd (name)')
+        self.assertEqual(processes['11']['args'], '[odd (name)]')
+        self.assertEqual(self.scanner.get_start_time('10'), '500')
+        self.assertEqual(self.scanner.get_start_time('12'), None)
+
+
+    def test_args_cached_per_process_lifetime(self):
+        self._add_process(10, 'autoserv', 1, 10, 500, 'first')
+        self._scan()
+        # reparented, same process: ppid is refreshed, args are not reread
+        self._add_process(10, 'autoserv', 2, 10, 500, 'second')
+        self.assertEqual(self._scan()['10']['ppid'], '2')
+        self.assertEqual(self._scan()['10']['args'], 'first')
+        # exec() of another program by the same process
+        self._add_process(10, 'python', 2, 10, 500, 'second')
+        self.assertEqual(self._scan()['10']['args'], 'second')
+        # pid reused by a new process
+        self._add_process(10, 'autoserv', 2, 10, 700, 'third')
+        self.assertEqual(self._scan()['10']['args'], 'third')
+
+
+    def test_vanished_process(self):
+        self._add_process(10, 'autoserv', 1, 10, 500, 'autoserv')
+        os.mkdir(os.path.join(self.proc_dir, '11'))
+        self.assertEqual(self._scan().keys(), ['10'])
+        shutil.rmtree(os.path.join(self.proc_dir, '10'))
+        self.assertEqual(self._scan(), {})
+        self.assertEqual(self.scanner.get_start_time('10'), None)
+
+
+    def test_real_proc(self):
+        scanner = drone_utility._ProcessTableScanner()
+        if not scanner.is_available():
+            return
+        processes = dict((info['pid'], info) for info in scanner.scan())
+        self.assert_(str(os.getpid()) in processes)
+        self.assertEqual(processes[str(os.getpid())]['ppid'],
+                         str(os.getppid()))
+
+
+class TestAgentMode(unittest.TestCase):
+    def _frames(self, *items):
+        stream = StringIO()
+        for item in items:
+            drone_utility.write_frame(stream, item)
+        stream.seek(0)
+        return stream
+
+
+    def _read_all_frames(self, stream):
+        stream.seek(0)
+        frames = []
+        frame = drone_utility.read_frame(stream)
+        while frame is not None:
+            frames.append(frame)
+            frame = drone_utility.read_frame(stream)
+        return frames
+
+
+    def test_frame_round_trip(self):
+        stream = self._frames({'results': [1, 'two']}, None, 'last')
+        self.assertEqual(drone_utility.read_frame(stream),
+                         {'results': [1, 'two']})
+        self.assertEqual(drone_utility.read_frame(stream), None)
+        self.assertEqual(drone_utility.read_frame(stream), 'last')
+        self.assertEqual(drone_utility.read_frame(stream), None)
+
+
+    def test_truncated_frame(self):
+        stream = StringIO(self._frames('some data').getvalue()[:-2])
+        self.assertRaises(ValueError, drone_utility.read_frame, stream)
+
+
+    def test_serve_agent(self):
+        input_file = self._frames([drone_utility.call('_warn', 'first')],
+                                  [drone_utility.call('_warn', 'second')])
+        output_file = StringIO()
+        drone_utility.serve_agent(input_file, output_file)
+
+        frames = self._read_all_frames(output_file)
+        self.assertEqual(frames[0], {'agent_version':
+                                     drone_utility.AGENT_PROTOCOL_VERSION})
+        # a single DroneUtility serves every batch
+        self.assertEqual(frames[1:],
+                         [{'results': [None], 'warnings': ['first']},
+                          {'results': [None], 'warnings': ['second']}])
+
+
+    def test_serve_agent_error(self):
+        input_file = self._frames([drone_utility.call('no_such_method')],
+                                  [drone_utility.call('_warn', 'unused')])
+        output_file = StringIO()
+        self.assertRaises(AttributeError, drone_utility.serve_agent,
+                          input_file, output_file)
+
+        frames = self._read_all_frames(output_file)
+        self.assertEqual(len(frames), 2)
+        self.assert_('no_such_method' in frames[1]['error'])
+
+
+    def test_channel_not_inherited(self):
+        saved_stdout = os.dup(sys.stdout.fileno())
+        try:
+            channel = drone_utility._claim_stdout()
+            try:
+                devnull = open(os.devnull, 'w')
+                status = subprocess.call(
+                        [sys.executable, '-c',
+                         'import os, sys; os.fstat(int(sys.argv[1]))',
+                         str(channel.fileno())],
+                        stdout=devnull, stderr=devnull)
+                devnull.close()
+            finally:
+                channel.close()
+        finally:
+            os.dup2(saved_stdout, sys.stdout.fileno())
+            os.close(saved_stdout)
+        # the child could not fstat() the channel: it was closed on exec
+        self.assertNotEqual(status, 0)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,25 +1,132 @@
-import cPickle, os, logging
+import cPickle, os, logging, select, subprocess, time
 try:
     import autotest.common as common
 except ImportError:
     import common
 from autotest.scheduler import drone_utility, email_manager
+from autotest.client.shared import utils
 from autotest.client.shared.settings import settings
 
 
 AUTOTEST_INSTALL_DIR = settings.get_value('SCHEDULER',
                                           'drone_installation_directory')
 
+# same as the default of hosts.SSHHost.run()
+_DEFAULT_REMOTE_TIMEOUT = 3600
+# time allowed for the drone agent to start up and greet us
+_AGENT_START_TIMEOUT = 120
+# after the agent fails to start, use one-shot calls for this long before
+# trying to start it again
+_AGENT_RETRY_INTERVAL = 3600
+
 class DroneUnreachable(Exception):
     """The drone is non-sshable."""
     pass
 
 
+class DroneAgentError(Exception):
+    """The persistent drone_utility agent failed or stopped answering."""
+    pass
+
+
+class _DroneAgentChannel(object):
+    """
+    A drone_utility.py process running in agent mode, talked to through the
+    stdin/stdout of a single long-lived command (usually ssh).  See
+    drone_utility.serve_agent() for the other end.
+    """
+    def __init__(self, command):
+        self._process = subprocess.Popen(command, shell=True, close_fds=True,
+                                         stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE)
+        self._buffer = ''
+
+
+    def _read_some(self, deadline):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise DroneAgentError('Timed out waiting for the drone agent')
+        stdout_fd = self._process.stdout.fileno()
+        ready, _, _ = select.select([stdout_fd], [], [], remaining)
+        if not ready:
+            raise DroneAgentError('Timed out waiting for the drone agent')
+        data = os.read(stdout_fd, 65536)
+        if not data:
+            raise DroneAgentError('Drone agent exited (status %s)' %
+                                  self._process.poll())
+        self._buffer += data
+
+
+    def _read_frame(self, timeout):
+        deadline = time.time() + timeout
+        while '\n' not in self._buffer:
+            self._read_some(deadline)
+        header, self._buffer = self._buffer.split('\n', 1)
+        try:
+            size = int(header)
+        except ValueError:
+            raise DroneAgentError('Invalid frame header from drone agent: %r'
+                                  % header)
+        while len(self._buffer) < size:
+            self._read_some(deadline)
+        pickled_data = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return cPickle.loads(pickled_data)
+
+
+    def wait_for_greeting(self, timeout):
+        greeting = self._read_frame(timeout)
+        version = greeting.get('agent_version')
+        if version != drone_utility.AGENT_PROTOCOL_VERSION:
+            raise DroneAgentError('Drone agent speaks protocol %s, expected %s'
+                                  % (version,
+                                     drone_utility.AGENT_PROTOCOL_VERSION))
+
+
+    def execute_calls(self, calls, timeout):
+        """
+        @returns the return message of drone_utility.execute_calls().
+        @raises DroneAgentError if the agent fails or doesn't answer in time.
+        """
+        try:
+            drone_utility.write_frame(self._process.stdin, calls)
+        except IOError, exc:
+            raise DroneAgentError('Failed to send calls to the drone agent: %s'
+                                  % exc)
+        return_message = self._read_frame(timeout)
+        if 'error' in return_message:
+            raise DroneAgentError('Drone agent failed:\n%s' %
+                                  return_message['error'])
+        return return_message
+
+
+    def close(self):
+        """
+        Close the channel.  The agent exits when it sees the end of its input;
+        it is killed if it is still running after that.
+        """
+        try:
+            self._process.stdin.close()
+        except IOError:
+            pass
+        if self._process.poll() is None:
+            time.sleep(0.1)
+        if self._process.poll() is None:
+            utils.nuke_subprocess(self._process)
+        self._process.stdout.close()
+
+
 class _AbstractDrone(object):
     """
     Attributes:
     * allowed_users: set of usernames allowed to use this drone.  if None,
             any user can use this drone.
+    * refresh_timeout: seconds to wait for the drone to answer a refresh
+            before giving up on it for the current cycle.  if None, there is no
+            limit other than the default one of the transport.
+    * execute_timeout: seconds to wait for the drone to execute its queued
+            calls at the end of a cycle.  if None, the default limit of the
+            transport applies.
     """
     def __init__(self):
         self._calls = []
@@ -28,6 +135,8 @@ class _AbstractDrone(object):
         self.max_processes = 0
         self.active_processes = 0
         self.allowed_users = None
+        self.refresh_timeout = None
+        self.execute_timeout = None
 
 
     def shutdown(self):
@@ -57,12 +166,12 @@ class _AbstractDrone(object):
         return user in self.allowed_users
 
 
-    def _execute_calls_impl(self, calls):
+    def _execute_calls_impl(self, calls, timeout=None):
         raise NotImplementedError
 
 
-    def _execute_calls(self, calls):
-        return_message = self._execute_calls_impl(calls)
+    def _execute_calls(self, calls, timeout=None):
+        return_message = self._execute_calls_impl(calls, timeout=timeout)
         for warning in return_message['warnings']:
             subject = 'Warning from drone %s' % self.hostname
             logging.warn(subject + '\n' + warning)
@@ -75,6 +184,15 @@ class _AbstractDrone(object):
             [drone_utility.call(method, *args, **kwargs)])
 
 
+    def timed_call(self, timeout, method, *args, **kwargs):
+        """
+        Like call(), but fail if the drone does not answer within timeout
+        seconds (None means no limit).
+        """
+        return self._execute_calls(
+            [drone_utility.call(method, *args, **kwargs)], timeout=timeout)
+
+
     def queue_call(self, method, *args, **kwargs):
         self._calls.append(drone_utility.call(method, *args, **kwargs))
 
@@ -82,10 +200,10 @@ class _AbstractDrone(object):
         self._calls = []
 
 
-    def execute_queued_calls(self):
+    def execute_queued_calls(self, timeout=None):
         if not self._calls:
             return
-        self._execute_calls(self._calls)
+        self._execute_calls(self._calls, timeout=timeout)
         self.clear_call_queue()
 
 
@@ -100,7 +218,8 @@ class _LocalDrone(_AbstractDrone):
         self._drone_utility = drone_utility.DroneUtility()
 
 
-    def _execute_calls_impl(self, calls):
+    def _execute_calls_impl(self, calls, timeout=None):
+        # calls run in-process, there is no transport to time out
         return self._drone_utility.execute_calls(calls)
 
 
@@ -123,6 +242,11 @@ class _RemoteDrone(_AbstractDrone):
             logging.error('Drone %s is unpingable, kicking out', hostname)
             raise DroneUnreachable
         self._autotest_install_dir = AUTOTEST_INSTALL_DIR
+        self._use_agent = settings.get_value('SCHEDULER', 'use_drone_agent',
+                                             type=bool, default=False)
+        self._agent = None
+        # time before which we don't try to start the agent again
+        self._agent_retry_time = 0
 
 
     @property
@@ -133,18 +257,68 @@ class _RemoteDrone(_AbstractDrone):
 
     def set_autotest_install_dir(self, path):
         self._autotest_install_dir = path
+        # a running agent was started from the old location
+        self._close_agent()
 
 
     def shutdown(self):
         super(_RemoteDrone, self).shutdown()
+        self._close_agent()
         self._host.close()
 
 
-    def _execute_calls_impl(self, calls):
+    def _close_agent(self):
+        if self._agent:
+            self._agent.close()
+            self._agent = None
+
+
+    def _start_agent(self):
+        """
+        Start drone_utility in agent mode over a dedicated ssh connection.
+
+        @returns True if the agent is up, False if it could not be started, in
+                which case one-shot calls are used for a while.
+        """
+        if time.time() < self._agent_retry_time:
+            return False
+        logging.info('Starting drone agent on %s', self.hostname)
+        self._host.start_master_ssh()
+        command = '%s "%s"' % (
+                self._host.ssh_command(connect_timeout=300),
+                utils.sh_escape('python %s --agent' % self._drone_utility_path))
+        try:
+            self._agent = _DroneAgentChannel(command)
+            self._agent.wait_for_greeting(_AGENT_START_TIMEOUT)
+        except (DroneAgentError, EnvironmentError), exc:
+            logging.warning('Could not start drone agent on %s, using one-shot '
+                            'calls: %s', self.hostname, exc)
+            self._close_agent()
+            self._agent_retry_time = time.time() + _AGENT_RETRY_INTERVAL
+            return False
+        return True
+
+
+    def _execute_calls_on_agent(self, calls, timeout):
+        try:
+            return self._agent.execute_calls(calls, timeout)
+        except DroneAgentError:
+            # we can't tell how much of the batch ran, so don't retry it; a
+            # new agent is started for the next batch
+            self._close_agent()
+            raise
+
+
+    def _execute_calls_impl(self, calls, timeout=None):
+        if timeout is None:
+            timeout = _DEFAULT_REMOTE_TIMEOUT
+        if self._use_agent and (self._agent or self._start_agent()):
+            return self._execute_calls_on_agent(calls, timeout)
+
         logging.info("Running drone_utility on %s", self.hostname)
         result = self._host.run('python %s' % self._drone_utility_path,
                                 stdin=cPickle.dumps(calls), stdout_tee=None,
-                                connect_timeout=300)
+                                timeout=timeout, connect_timeout=300)
         try:
             return cPickle.loads(result.stdout)
         except Exception: # cPickle.loads can throw all kinds of exceptions
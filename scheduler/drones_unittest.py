@@ -2,12 +2,13 @@
 
 """Tests for autotest.scheduler.drones."""
 
-import cPickle
+import cPickle, os, sys
 
 import common
 from autotest.client.shared import utils
+from autotest.client.shared.settings import settings
 from autotest.client.shared.test_utils import mock, unittest
-from autotest.scheduler import drones
+from autotest.scheduler import drone_utility, drones
 from autotest.server.hosts import ssh_host
 
 
@@ -17,10 +18,12 @@ class RemoteDroneTest(unittest.TestCase):
         self._mock_host = self.god.create_mock_class(ssh_host.SSHHost,
                                                      'mock SSHHost')
         self.god.stub_function(drones.drone_utility, 'create_host')
+        settings.override_value('SCHEDULER', 'use_drone_agent', 'False')
 
 
     def tearDown(self):
         self.god.unstub_all()
+        settings.reset_values()
 
 
     def test_unreachable(self):
@@ -31,24 +34,147 @@ class RemoteDroneTest(unittest.TestCase):
                           drones._RemoteDrone, 'fakehost')
 
 
-    def test_execute_calls_impl(self):
+    def _expect_execute_calls(self, mock_calls, timeout):
         self.god.stub_with(drones._RemoteDrone, '_drone_utility_path',
                            'mock-drone-utility-path')
         drones.drone_utility.create_host.expect_call('fakehost').and_return(
                 self._mock_host)
         self._mock_host.is_up.expect_call().and_return(True)
-        mock_calls = ('foo',)
         mock_result = utils.CmdResult(stdout=cPickle.dumps('mock return'))
         self._mock_host.run.expect_call(
                 'python mock-drone-utility-path',
                 stdin=cPickle.dumps(mock_calls), stdout_tee=None,
+                timeout=timeout,
                 connect_timeout=mock.is_instance_comparator(int)).and_return(
                         mock_result)
 
+
+    def test_execute_calls_impl(self):
+        mock_calls = ('foo',)
+        self._expect_execute_calls(mock_calls, drones._DEFAULT_REMOTE_TIMEOUT)
+
+        drone = drones._RemoteDrone('fakehost')
+        self.assertEqual('mock return', drone._execute_calls_impl(mock_calls))
+        self.god.check_playback()
+
+
+    def test_execute_calls_impl_with_timeout(self):
+        mock_calls = ('foo',)
+        self._expect_execute_calls(mock_calls, 30)
+
         drone = drones._RemoteDrone('fakehost')
+        self.assertEqual('mock return',
+                         drone._execute_calls_impl(mock_calls, timeout=30))
+        self.god.check_playback()
+
+
+    def _create_agent_drone(self, channel_class):
+        settings.override_value('SCHEDULER', 'use_drone_agent', 'True')
+        self.god.stub_with(drones, '_DroneAgentChannel', channel_class)
+        self.god.stub_with(drones._RemoteDrone, '_drone_utility_path',
+                           'mock-drone-utility-path')
+        drones.drone_utility.create_host.expect_call('fakehost').and_return(
+                self._mock_host)
+        self._mock_host.is_up.expect_call().and_return(True)
+        return drones._RemoteDrone('fakehost')
+
+
+    def _expect_agent_start(self):
+        self._mock_host.start_master_ssh.expect_call()
+        self._mock_host.ssh_command.expect_call(
+                connect_timeout=mock.is_instance_comparator(int)).and_return(
+                        'ssh fakehost')
+
+
+    def test_execute_calls_on_agent(self):
+        executed = []
+        class FakeChannel(object):
+            def __init__(self, command):
+                self.command = command
+            def wait_for_greeting(self, timeout):
+                pass
+            def execute_calls(self, calls, timeout):
+                executed.append((self.command, calls, timeout))
+                return 'agent return'
+
+        drone = self._create_agent_drone(FakeChannel)
+        self._expect_agent_start()
+        self.assertEqual('agent return', drone._execute_calls_impl(('foo',)))
+        # the agent is reused for later batches
+        self.assertEqual('agent return',
+                         drone._execute_calls_impl(('bar',), timeout=30))
+        self.god.check_playback()
+        self.assertEqual(
+                executed,
+                [('ssh fakehost "python mock-drone-utility-path --agent"',
+                  ('foo',), drones._DEFAULT_REMOTE_TIMEOUT),
+                 ('ssh fakehost "python mock-drone-utility-path --agent"',
+                  ('bar',), 30)])
+
+
+    def test_agent_start_failure_falls_back(self):
+        class BrokenChannel(object):
+            def __init__(self, command):
+                pass
+            def wait_for_greeting(self, timeout):
+                raise drones.DroneAgentError('no greeting')
+            def close(self):
+                pass
+
+        drone = self._create_agent_drone(BrokenChannel)
+        self._expect_agent_start()
+        mock_calls = ('foo',)
+        mock_result = utils.CmdResult(stdout=cPickle.dumps('mock return'))
+        for _ in xrange(2):
+            self._mock_host.run.expect_call(
+                    'python mock-drone-utility-path',
+                    stdin=cPickle.dumps(mock_calls), stdout_tee=None,
+                    timeout=drones._DEFAULT_REMOTE_TIMEOUT,
+                    connect_timeout=mock.is_instance_comparator(int)
+                    ).and_return(mock_result)
+
+        self.assertEqual('mock return', drone._execute_calls_impl(mock_calls))
+        # no new start attempt until the retry interval has passed
         self.assertEqual('mock return', drone._execute_calls_impl(mock_calls))
         self.god.check_playback()
 
 
+    def test_agent_failure_is_not_retried(self):
+        closed = []
+        class DyingChannel(object):
+            def __init__(self, command):
+                pass
+            def wait_for_greeting(self, timeout):
+                pass
+            def execute_calls(self, calls, timeout):
+                raise drones.DroneAgentError('agent exited')
+            def close(self):
+                closed.append(True)
+
+        drone = self._create_agent_drone(DyingChannel)
+        self._expect_agent_start()
+        self.assertRaises(drones.DroneAgentError, drone._execute_calls_impl,
+                          ('foo',))
+        self.god.check_playback()
+        self.assertEqual(closed, [True])
+        self.assertEqual(drone._agent, None)
+
+
+class DroneAgentChannelTest(unittest.TestCase):
+    def test_local_agent(self):
+        drone_utility_path = os.path.join(os.path.dirname(__file__),
+                                          'drone_utility.py')
+        channel = drones._DroneAgentChannel(
+                '%s %s --agent' % (sys.executable, drone_utility_path))
+        try:
+            channel.wait_for_greeting(60)
+            for message in ('hello', 'again'):
+                return_message = channel.execute_calls(
+                        [drone_utility.call('_warn', message)], 60)
+                self.assertEqual(return_message,
+                                 {'results': [None], 'warnings': [message]})
+        finally:
+            channel.close()
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,7 @@
 """
 Autotest scheduling utility.
 """
-import logging
+import datetime, logging, time
 
 from autotest.client.shared import utils
 from autotest.client.shared.settings import settings
@@ -19,13 +19,356 @@ class SchedulerError(Exception):
     """Raised by HostScheduler when an inconsistent state occurs."""
 
 
+# Sets of hosts are also kept as bitmasks: integers with bit N set when the
+# host with id N is in the set.  Intersecting a label with the ready hosts, the
+# ACL groups and the dependencies of a job is then a few bitwise operations
+# instead of a loop over the hosts.
+
+def _host_ids_to_mask(host_ids):
+    host_ids = list(host_ids)
+    if not host_ids:
+        return 0
+    size = max(host_ids) + 1
+    digits = bytearray('0' * size)
+    for host_id in host_ids:
+        digits[size - 1 - host_id] = '1'
+    return int(str(digits), 2)
+
+
+def _mask_to_host_ids(mask):
+    # the binary digits, lowest bit first
+    digits = bin(mask)[:1:-1]
+    host_ids = set()
+    host_id = digits.find('1')
+    while host_id != -1:
+        host_ids.add(host_id)
+        host_id = digits.find('1', host_id + 1)
+    return host_ids
+
+
+def _iterate_mask(mask):
+    """Yield the host ids in the mask, lowest first."""
+    while mask:
+        lowest_bit = mask & -mask
+        yield lowest_bit.bit_length() - 1
+        mask ^= lowest_bit
+
+
+class HostIndex(object):
+    """
+    An in-memory index of every host with its labels and ACL groups, tracking
+    which hosts are ready to be scheduled.  The hosts of each label and ACL
+    group, the ready hosts and the invalid hosts are also kept as bitmasks.
+
+    After the first full rebuild, refresh() only reloads the hosts and queue
+    entries whose last_modified column moved since the previous refresh (label
+    and ACL membership changes bump the host too), so its cost follows the rate
+    of change instead of the size of the fleet.  A full rebuild every
+    full_rebuild_interval seconds catches the writes that failed to bump
+    last_modified, and logs the hosts they had left stale.
+    """
+    # Same as HostQueueEntryCache._OVERLAP_SECS: rows stamped up to this many
+    # seconds before the previous refresh are fetched again.
+    _OVERLAP_SECS = 5
+
+    # Maximum number of ids in the IN (...) list of one query.
+    _CHUNK_SIZE = 1000
+
+
+    def __init__(self, db, full_rebuild_interval, now_func=time.time):
+        """
+        @param db: A DatabaseConnection.
+        @param full_rebuild_interval: Seconds between two full rebuilds.  Zero
+                rebuilds on every refresh.
+        @param now_func: A time.time like function.  Used for testing.
+        """
+        self._db = db
+        self._full_rebuild_interval = full_rebuild_interval
+        self._now_func = now_func
+        self._last_refresh_time = None
+        self._last_full_rebuild_time = None
+        self._clear()
+
+
+    def _clear(self):
+        # maps host id to Host, for every host
+        self._hosts = {}
+        # map host id to the set of label ids and of ACL group ids
+        self._host_labels = {}
+        self._host_acls = {}
+        # map label id and ACL group id to the mask of their hosts
+        self._label_masks = {}
+        self._acl_masks = {}
+        # maps active HostQueueEntry id to its host id
+        self._active_entry_hosts = {}
+        # maps host id to its number of active HostQueueEntries
+        self._active_entry_counts = {}
+        # unlocked, Ready hosts without an active entry
+        self._ready_host_ids = set()
+        self._ready_mask = 0
+        self._invalid_mask = 0
+
+
+    def invalidate(self):
+        """Make the next refresh() a full rebuild."""
+        self._last_full_rebuild_time = None
+
+
+    def _needs_full_rebuild(self, now):
+        if self._last_full_rebuild_time is None:
+            return True
+        return (now - self._last_full_rebuild_time >=
+                self._full_rebuild_interval)
+
+
+    def _fetch_host_relations(self, table, column, host_ids=None):
+        """
+        @param host_ids: Restrict the query to these hosts.  None means all.
+
+        @returns A dict mapping host id to the set of values of column.
+        """
+        query = 'SELECT host_id, %s FROM %s' % (column, table)
+        if host_ids is None:
+            rows = self._db.execute(query)
+        else:
+            rows = []
+            host_ids = sorted(host_ids)
+            for start in xrange(0, len(host_ids), self._CHUNK_SIZE):
+                chunk = host_ids[start:start + self._CHUNK_SIZE]
+                rows.extend(self._db.execute(
+                        query + ' WHERE host_id IN (%s)' %
+                        ','.join(str(host_id) for host_id in chunk)))
+        relations = {}
+        for host_id, other_id in rows:
+            relations.setdefault(int(host_id), set()).add(int(other_id))
+        return relations
+
+
+    def _host_from_row(self, row, known_hosts):
+        host = known_hosts.get(row[0])
+        if host is not None and not host._compare_fields_in_row(row):
+            return host
+        return scheduler_models.Host(id=row[0], row=row)
+
+
+    def _is_ready(self, host_id):
+        host = self._hosts.get(host_id)
+        return (host is not None and not host.locked
+                and host.status in (None, models.Host.Status.READY)
+                and not self._active_entry_counts.get(host_id))
+
+
+    def _update_ready_state(self, host_id):
+        bit = 1 << host_id
+        if self._is_ready(host_id):
+            self._ready_host_ids.add(host_id)
+            self._ready_mask |= bit
+        else:
+            self._ready_host_ids.discard(host_id)
+            self._ready_mask &= ~bit
+
+
+    def _set_host(self, host):
+        self._hosts[host.id] = host
+        if host.invalid:
+            self._invalid_mask |= 1 << host.id
+        else:
+            self._invalid_mask &= ~(1 << host.id)
+
+
+    @staticmethod
+    def _set_host_relations(relations, masks, host_id, new_ids):
+        old_ids = relations.pop(host_id, set())
+        if new_ids:
+            relations[host_id] = new_ids
+        bit = 1 << host_id
+        for other_id in old_ids - new_ids:
+            masks[other_id] &= ~bit
+        for other_id in new_ids - old_ids:
+            masks[other_id] = masks.get(other_id, 0) | bit
+
+
+    @staticmethod
+    def _get_masks(relations):
+        host_ids_by_other_id = {}
+        for host_id, other_ids in relations.iteritems():
+            for other_id in other_ids:
+                host_ids_by_other_id.setdefault(other_id, []).append(host_id)
+        return dict((other_id, _host_ids_to_mask(host_ids))
+                    for other_id, host_ids
+                    in host_ids_by_other_id.iteritems())
+
+
+    def _set_entry_host(self, entry_id, host_id):
+        """
+        Record the host of an active entry, or that the entry is no longer
+        active when host_id is None.
+        """
+        old_host_id = self._active_entry_hosts.pop(entry_id, None)
+        if old_host_id is not None:
+            self._active_entry_counts[old_host_id] -= 1
+            if not self._active_entry_counts[old_host_id]:
+                del self._active_entry_counts[old_host_id]
+        if host_id is not None:
+            self._active_entry_hosts[entry_id] = host_id
+            self._active_entry_counts[host_id] = (
+                    self._active_entry_counts.get(host_id, 0) + 1)
+
+
+    def _get_state(self):
+        return self._ready_host_ids, self._host_labels, self._host_acls
+
+
+    def _find_stale_hosts(self, old_state):
+        old_ready, old_labels, old_acls = old_state
+        stale_host_ids = old_ready.symmetric_difference(self._ready_host_ids)
+        for old_relations, relations in ((old_labels, self._host_labels),
+                                         (old_acls, self._host_acls)):
+            for host_id in set(old_relations).union(relations):
+                if old_relations.get(host_id) != relations.get(host_id):
+                    stale_host_ids.add(host_id)
+        return stale_host_ids
+
+
+    def _full_rebuild(self):
+        old_state = None
+        if self._last_refresh_time is not None:
+            old_state = self._get_state()
+        old_hosts = self._hosts
+        self._clear()
+
+        rows = self._db.execute('SELECT %s FROM afe_hosts' %
+                                scheduler_models.Host._get_select_columns())
+        self._hosts = dict((row[0], self._host_from_row(row, old_hosts))
+                           for row in rows)
+        self._host_labels = self._fetch_host_relations('afe_hosts_labels',
+                                                       'label_id')
+        self._host_acls = self._fetch_host_relations('afe_acl_groups_hosts',
+                                                     'aclgroup_id')
+        self._label_masks = self._get_masks(self._host_labels)
+        self._acl_masks = self._get_masks(self._host_acls)
+        rows = self._db.execute('SELECT id, host_id '
+                                'FROM afe_host_queue_entries '
+                                'WHERE active AND host_id IS NOT NULL')
+        for entry_id, host_id in rows:
+            self._set_entry_host(entry_id, host_id)
+        self._ready_host_ids = set(host_id for host_id in self._hosts
+                                   if self._is_ready(host_id))
+        self._ready_mask = _host_ids_to_mask(self._ready_host_ids)
+        self._invalid_mask = _host_ids_to_mask(
+                host.id for host in self._hosts.itervalues() if host.invalid)
+
+        logging.info('Indexed %d hosts, %d ready', len(self._hosts),
+                     len(self._ready_host_ids))
+        if old_state is not None:
+            stale_host_ids = self._find_stale_hosts(old_state)
+            if stale_host_ids:
+                logging.warning('Host index rebuild fixed %d stale hosts: %s',
+                                len(stale_host_ids),
+                                ', '.join(str(host_id) for host_id
+                                          in sorted(stale_host_ids)))
+
+
+    def _apply_changes(self, since):
+        modified_since = datetime.datetime.fromtimestamp(
+                since - self._OVERLAP_SECS).replace(microsecond=0)
+        host_rows = self._db.execute(
+                'SELECT %s FROM afe_hosts WHERE last_modified >= %%s'
+                % scheduler_models.Host._get_select_columns(),
+                (modified_since,))
+        entry_rows = self._db.execute(
+                'SELECT id, host_id, active FROM afe_host_queue_entries '
+                'WHERE last_modified >= %s', (modified_since,))
+
+        changed_host_ids = set(row[0] for row in host_rows)
+        labels = self._fetch_host_relations('afe_hosts_labels', 'label_id',
+                                            changed_host_ids)
+        acls = self._fetch_host_relations('afe_acl_groups_hosts',
+                                          'aclgroup_id', changed_host_ids)
+
+        entry_hosts = {}
+        affected_host_ids = set(changed_host_ids)
+        for entry_id, host_id, active in entry_rows:
+            if not active:
+                host_id = None
+            old_host_id = self._active_entry_hosts.get(entry_id)
+            if host_id != old_host_id:
+                entry_hosts[entry_id] = host_id
+                affected_host_ids.update((host_id, old_host_id))
+        affected_host_ids.discard(None)
+
+        for row in host_rows:
+            host_id = row[0]
+            self._set_host(self._host_from_row(row, self._hosts))
+            self._set_host_relations(self._host_labels, self._label_masks,
+                                     host_id, labels.get(host_id, set()))
+            self._set_host_relations(self._host_acls, self._acl_masks,
+                                     host_id, acls.get(host_id, set()))
+        for entry_id, host_id in entry_hosts.iteritems():
+            self._set_entry_host(entry_id, host_id)
+        for host_id in affected_host_ids:
+            self._update_ready_state(host_id)
+
+
+    def refresh(self):
+        now = self._now_func()
+        if self._needs_full_rebuild(now):
+            self._full_rebuild()
+            self._last_full_rebuild_time = now
+        else:
+            self._apply_changes(since=self._last_refresh_time)
+        self._last_refresh_time = now
+
+
+    def get_ready_hosts(self):
+        """
+        @returns A new dict mapping host id to Host for every host that is
+                unlocked, Ready and has no active queue entry.  Invalid hosts
+                are included since they can be used as one-time hosts.
+        """
+        return dict((host_id, self._hosts[host_id])
+                    for host_id in self._ready_host_ids)
+
+
+    def get_ready_hosts_in_label(self, label_id):
+        """@returns A new set of the ids of the ready hosts in the label."""
+        return _mask_to_host_ids(self.get_label_mask(label_id) &
+                                 self._ready_mask)
+
+
+    def get_ready_mask(self):
+        return self._ready_mask
+
+
+    def get_invalid_mask(self):
+        return self._invalid_mask
+
+
+    def get_label_mask(self, label_id):
+        return self._label_masks.get(label_id, 0)
+
+
+    def get_acl_mask(self, acl_id):
+        return self._acl_masks.get(acl_id, 0)
+
+
+    def get_host_labels(self, host_id):
+        """@returns The set of label ids of the host.  Do not modify it."""
+        return self._host_labels.get(host_id, frozenset())
+
+
+    def get_host_acls(self, host_id):
+        """@returns The set of ACL group ids of the host.  Do not modify it."""
+        return self._host_acls.get(host_id, frozenset())
+
+
 class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
     """Handles the logic for choosing when to run jobs and on which hosts.
 
-    This class makes several queries to the database on each tick, building up
-    some auxiliary data structures and using them to determine which hosts are
-    eligible to run which jobs, taking into account all the various factors that
-    affect that.
+    This class keeps a HostIndex of the hosts, their labels and ACL groups,
+    and makes a few queries about the pending jobs on each tick, using them to
+    determine which hosts are eligible to run which jobs, taking into account
+    all the various factors that affect that.
 
     In the past this was done with one or two very large, complex database
     queries.  It has proven much simpler and faster to build these auxiliary
@@ -33,6 +376,11 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
     """
     def __init__(self, db):
         self._db = db
+        full_rebuild_mins = settings.get_value(
+                scheduler_config.CONFIG_SECTION,
+                'host_index_full_rebuild_interval_mins', type=int, default=10)
+        self._host_index = HostIndex(
+                db, full_rebuild_interval=60 * full_rebuild_mins)
         self._metahost_schedulers = metahost_scheduler.get_metahost_schedulers()
 
         # load site-specific scheduler selected in settings
@@ -50,19 +398,6 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
                                in self._metahost_schedulers))
 
 
-    def _get_ready_hosts(self):
-        # avoid any host with a currently active queue entry against it
-        hosts = scheduler_models.Host.fetch(
-            joins='LEFT JOIN afe_host_queue_entries AS active_hqe '
-                  'ON (afe_hosts.id = active_hqe.host_id AND '
-                      'active_hqe.active)',
-            where="active_hqe.host_id IS NULL "
-                  "AND NOT afe_hosts.locked "
-                  "AND (afe_hosts.status IS NULL "
-                          "OR afe_hosts.status = 'Ready')")
-        return dict((host.id, host) for host in hosts)
-
-
     def _get_sql_id_list(self, id_list):
         return ','.join(str(item_id) for item_id in id_list)
 
@@ -115,29 +450,6 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
         return self._get_many2many_dict(query, job_ids)
 
 
-    def _get_host_acls(self, host_ids):
-        query = """
-        SELECT host_id, aclgroup_id
-        FROM afe_acl_groups_hosts
-        WHERE host_id IN (%s)
-        """
-        return self._get_many2many_dict(query, host_ids)
-
-
-    def _get_label_hosts(self, host_ids):
-        if not host_ids:
-            return {}, {}
-        query = """
-        SELECT label_id, host_id
-        FROM afe_hosts_labels
-        WHERE host_id IN (%s)
-        """ % self._get_sql_id_list(host_ids)
-        rows = self._db.execute(query)
-        labels_to_hosts = self._process_many2many_dict(rows)
-        hosts_to_labels = self._process_many2many_dict(rows, flip=True)
-        return labels_to_hosts, hosts_to_labels
-
-
     def _get_labels(self):
         return dict((label.id, label) for label
                     in scheduler_models.Label.fetch())
@@ -149,7 +461,13 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
 
 
     def refresh(self, pending_queue_entries):
-        self._hosts_available = self._get_ready_hosts()
+        self._host_index.refresh()
+        self._hosts_available = self._host_index.get_ready_hosts()
+        # the hosts of _hosts_available that can take a metahost entry
+        self._usable_mask = (self._host_index.get_ready_mask() &
+                             ~self._host_index.get_invalid_mask())
+        # per-tick copies of the ready hosts in each label, made on first use
+        self._label_hosts = {}
 
         relevant_jobs = [queue_entry.job_id
                          for queue_entry in pending_queue_entries]
@@ -157,11 +475,17 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
         self._ineligible_hosts = self._get_job_ineligible_hosts(relevant_jobs)
         self._job_dependencies = self._get_job_dependencies(relevant_jobs)
 
-        host_ids = self._hosts_available.keys()
-        self._host_acls = self._get_host_acls(host_ids)
-        self._label_hosts, self._host_labels = self._get_label_hosts(host_ids)
-
         self._labels = self._get_labels()
+        self._only_if_needed_label_ids = [
+                label_id for label_id, label in self._labels.iteritems()
+                if label.only_if_needed]
+        self._atomic_group_hosts_mask = 0
+        for label_id, label in self._labels.iteritems():
+            if label.atomic_group_id is not None:
+                self._atomic_group_hosts_mask |= (
+                        self._host_index.get_label_mask(label_id))
+        # maps job id to the mask computed by _get_job_mask()
+        self._job_masks = {}
 
 
     def tick(self):
@@ -169,16 +493,29 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
             metahost_scheduler.tick()
 
 
+    def _get_label_hosts(self, label_id):
+        if label_id not in self._label_hosts:
+            self._label_hosts[label_id] = (
+                    self._host_index.get_ready_hosts_in_label(label_id))
+        return self._label_hosts[label_id]
+
+
     def hosts_in_label(self, label_id):
-        return set(self._label_hosts.get(label_id, ()))
+        return set(self._get_label_hosts(label_id))
 
 
     def remove_host_from_label(self, host_id, label_id):
-        self._label_hosts[label_id].remove(host_id)
+        if label_id in self._label_hosts:
+            self._label_hosts[label_id].discard(host_id)
+
+
+    def _pop_available_host(self, host_id, *default):
+        self._usable_mask &= ~(1 << host_id)
+        return self._hosts_available.pop(host_id, *default)
 
 
     def pop_host(self, host_id):
-        return self._hosts_available.pop(host_id)
+        return self._pop_available_host(host_id)
 
 
     def ineligible_hosts_for_entry(self, queue_entry):
@@ -187,7 +524,7 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
 
     def _is_acl_accessible(self, host_id, queue_entry):
         job_acls = self._job_acls.get(queue_entry.job_id, set())
-        host_acls = self._host_acls.get(host_id, set())
+        host_acls = self._host_index.get_host_acls(host_id)
         return len(host_acls.intersection(job_acls)) > 0
 
 
@@ -290,7 +627,7 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
             return True
 
         job_dependencies = self._job_dependencies.get(queue_entry.job_id, set())
-        host_labels = self._host_labels.get(host_id, set())
+        host_labels = self._host_index.get_host_labels(host_id)
 
         return (self._is_acl_accessible(host_id, queue_entry) and
                 self._check_job_dependencies(job_dependencies, host_labels) and
@@ -299,6 +636,57 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
                 self._check_atomic_group_labels(host_labels, queue_entry))
 
 
+    def _get_job_mask(self, job_id):
+        """
+        @returns The mask of the hosts passing the checks that only depend on
+                the job: ACLs, dependency labels and ineligible hosts.  Hosts
+                in an atomic group are left out, since the entries that can
+                use them are scheduled by find_eligible_atomic_group().
+        """
+        if job_id not in self._job_masks:
+            mask = 0
+            for acl_id in self._job_acls.get(job_id, ()):
+                mask |= self._host_index.get_acl_mask(acl_id)
+            for label_id in self._job_dependencies.get(job_id, ()):
+                mask &= self._host_index.get_label_mask(label_id)
+            mask &= ~_host_ids_to_mask(self._ineligible_hosts.get(job_id, ()))
+            mask &= ~self._atomic_group_hosts_mask
+            self._job_masks[job_id] = mask
+        return self._job_masks[job_id]
+
+
+    def _get_unrequested_only_if_needed_mask(self, queue_entry):
+        """
+        @returns The mask of the hosts with an only_if_needed label that the
+                metahost entry neither asked for nor depends on.
+        """
+        if not queue_entry.meta_host:
+            return 0
+        job_dependencies = self._job_dependencies.get(queue_entry.job_id, ())
+        mask = 0
+        for label_id in self._only_if_needed_label_ids:
+            if (label_id != queue_entry.meta_host
+                and label_id not in job_dependencies):
+                mask |= self._host_index.get_label_mask(label_id)
+        return mask
+
+
+    def eligible_hosts_in_label(self, label_id, queue_entry):
+        """
+        Computes the eligible hosts with bitmasks, matching what the host by
+        host checks of is_host_usable() and is_host_eligible_for_job() accept.
+        Atomic group entries still go through those checks.
+        """
+        if queue_entry.atomic_group_id is not None:
+            return super(BaseHostScheduler, self).eligible_hosts_in_label(
+                    label_id, queue_entry)
+        mask = (self._usable_mask &
+                self._host_index.get_label_mask(label_id) &
+                self._get_job_mask(queue_entry.job_id) &
+                ~self._get_unrequested_only_if_needed_mask(queue_entry))
+        return _iterate_mask(mask)
+
+
     def _is_host_invalid(self, host_id):
         host_object = self._hosts_available.get(host_id, None)
         return host_object and host_object.invalid
@@ -307,7 +695,7 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
     def _schedule_non_metahost(self, queue_entry):
         if not self.is_host_eligible_for_job(queue_entry.host_id, queue_entry):
             return None
-        return self._hosts_available.pop(queue_entry.host_id, None)
+        return self._pop_available_host(queue_entry.host_id, None)
 
 
     def is_host_usable(self, host_id):
@@ -407,7 +795,7 @@ class BaseHostScheduler(metahost_scheduler.HostSchedulingUtility):
             host_list = []
             for host in eligible_hosts_in_group:
                 hosts_in_label.discard(host.id)
-                self._hosts_available.pop(host.id)
+                self._pop_available_host(host.id)
                 host_list.append(host)
             return host_list
 
@@ -41,23 +41,8 @@ class LabelMetahostSchedulerTest(unittest.TestCase):
         entry.meta_host = 1
         host = object()
 
-        self.scheduling_utility.hosts_in_label.expect_call(1).and_return(
-                [2, 3, 4, 5])
-        # 2 is in ineligible_hosts
-        (self.scheduling_utility.ineligible_hosts_for_entry.expect_call(entry)
-         .and_return([2]))
-        self.scheduling_utility.is_host_usable.expect_call(2).and_return(True)
-        # 3 is unusable
-        self.scheduling_utility.is_host_usable.expect_call(3).and_return(False)
-        self.scheduling_utility.remove_host_from_label.expect_call(3, 1)
-        # 4 is ineligible for the job
-        self.scheduling_utility.is_host_usable.expect_call(4).and_return(True)
-        (self.scheduling_utility.is_host_eligible_for_job.expect_call(4, entry)
-         .and_return(False))
-        # 5 runs
-        self.scheduling_utility.is_host_usable.expect_call(5).and_return(True)
-        (self.scheduling_utility.is_host_eligible_for_job.expect_call(5, entry)
-         .and_return(True))
+        (self.scheduling_utility.eligible_hosts_in_label.expect_call(1, entry)
+         .and_return(iter([5, 6])))
         self.scheduling_utility.remove_host_from_label.expect_call(5, 1)
         self.scheduling_utility.pop_host.expect_call(5).and_return(host)
         entry.set_host.expect_call(host)
@@ -71,14 +56,64 @@ class LabelMetahostSchedulerTest(unittest.TestCase):
         entry = self.entry()
         entry.meta_host = 1
 
-        self.scheduling_utility.hosts_in_label.expect_call(1).and_return(())
-        (self.scheduling_utility.ineligible_hosts_for_entry.expect_call(entry)
-         .and_return(()))
+        (self.scheduling_utility.eligible_hosts_in_label.expect_call(1, entry)
+         .and_return(iter(())))
 
         self.metahost_scheduler.schedule_metahost(entry,
                                                   self.scheduling_utility)
         self.god.check_playback()
 
 
+class HostSchedulingUtilityTest(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.utility = metahost_scheduler.HostSchedulingUtility()
+        for method in ('hosts_in_label', 'ineligible_hosts_for_entry',
+                       'is_host_usable', 'is_host_eligible_for_job',
+                       'remove_host_from_label'):
+            self.god.stub_function(self.utility, method)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+
+
+    def test_eligible_hosts_in_label(self):
+        entry = object()
+
+        self.utility.hosts_in_label.expect_call(1).and_return([2, 3, 4, 5])
+        # 2 is in ineligible_hosts
+        (self.utility.ineligible_hosts_for_entry.expect_call(entry)
+         .and_return([2]))
+        self.utility.is_host_usable.expect_call(2).and_return(True)
+        # 3 is unusable
+        self.utility.is_host_usable.expect_call(3).and_return(False)
+        self.utility.remove_host_from_label.expect_call(3, 1)
+        # 4 is ineligible for the job
+        self.utility.is_host_usable.expect_call(4).and_return(True)
+        (self.utility.is_host_eligible_for_job.expect_call(4, entry)
+         .and_return(False))
+        # 5 is eligible
+        self.utility.is_host_usable.expect_call(5).and_return(True)
+        (self.utility.is_host_eligible_for_job.expect_call(5, entry)
+         .and_return(True))
+
+        self.assertEquals(list(self.utility.eligible_hosts_in_label(1, entry)),
+                          [5])
+        self.god.check_playback()
+
+
+    def test_eligible_hosts_in_empty_label(self):
+        entry = object()
+
+        self.utility.hosts_in_label.expect_call(1).and_return(())
+        (self.utility.ineligible_hosts_for_entry.expect_call(entry)
+         .and_return(()))
+
+        self.assertEquals(list(self.utility.eligible_hosts_in_label(1, entry)),
+                          [])
+        self.god.check_playback()
+
+
 if __name__ == '__main__':
     unittest.main()
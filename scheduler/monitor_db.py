@@ -23,7 +23,8 @@ from autotest.frontend.afe import model_attributes
 from autotest.scheduler import drone_manager, drones, email_manager
 from autotest.scheduler import gc_stats, host_scheduler, monitor_db_cleanup
 from autotest.scheduler import status_server, scheduler_config
-from autotest.scheduler import scheduler_models
+from autotest.scheduler import scheduler_models, tick_profiler
+from autotest.tko import parse_daemon
 
 WATCHER_PID_FILE_PREFIX = 'autotest-scheduler-watcher'
 PID_FILE_PREFIX = 'autotest-scheduler'
@@ -73,6 +74,12 @@ _parser_path_func = utils.import_site_function(
 _parser_path = _parser_path_func(drones.AUTOTEST_INSTALL_DIR)
 
 
+def _get_parse_daemon_socket():
+    """@returns The socket of the parse daemon to submit jobs to, or None."""
+    return settings.get_value(scheduler_config.CONFIG_SECTION,
+                              'parse_daemon_socket', default='') or None
+
+
 def _get_pidfile_timeout_secs():
     """@returns How long to wait for autoserv to write pidfile."""
     pidfile_timeout_mins = settings.get_value(scheduler_config.CONFIG_SECTION,
@@ -170,6 +177,8 @@ def initialize():
     global _db
     _db = database_connection.DatabaseConnection(DB_CONFIG_SECTION)
     _db.connect(db_type='django')
+    # account for the Django ORM queries in the tick profile too
+    database_connection.count_django_queries()
 
     # ensure Django connection is in autocommit
     setup_django_environment.enable_autocommit()
@@ -295,6 +304,12 @@ class Dispatcher(object):
                 settings.get_value(
                         scheduler_config.CONFIG_SECTION,
                         'gc_stats_interval_mins', type=int, default=6*60))
+        full_resync_mins = settings.get_value(
+                scheduler_config.CONFIG_SECTION,
+                'queue_entry_full_resync_interval_mins', type=int, default=10)
+        self._queue_entry_cache = scheduler_models.HostQueueEntryCache(
+                full_resync_interval=60 * full_resync_mins)
+        self._profiler = tick_profiler.instance()
 
 
     def initialize(self, recover_hosts=True):
@@ -311,23 +326,29 @@ class Dispatcher(object):
 
 
     def tick(self):
-        self._garbage_collection()
-        _drone_manager.refresh()
-        self._run_cleanup()
-        self._find_aborting()
-        self._process_recurring_runs()
-        self._schedule_delay_tasks()
-        self._schedule_running_host_queue_entries()
-        self._schedule_special_tasks()
-        self._schedule_new_jobs()
-        self._handle_agents()
-        self._host_scheduler.tick()
-        _drone_manager.execute_actions()
-        email_manager.manager.send_queued_emails()
-        django.db.reset_queries()
+        self._profiler.run_tick(self._run_tick_phases)
         self._tick_count += 1
 
 
+    def _run_tick_phases(self):
+        phase = self._profiler.run_phase
+        phase('garbage_collection', self._garbage_collection)
+        phase('drone_refresh', _drone_manager.refresh)
+        phase('run_cleanup', self._run_cleanup)
+        phase('find_aborting', self._find_aborting)
+        phase('process_recurring_runs', self._process_recurring_runs)
+        phase('schedule_delay_tasks', self._schedule_delay_tasks)
+        phase('schedule_running_host_queue_entries',
+              self._schedule_running_host_queue_entries)
+        phase('schedule_special_tasks', self._schedule_special_tasks)
+        phase('schedule_new_jobs', self._schedule_new_jobs)
+        phase('handle_agents', self._handle_agents)
+        phase('host_scheduler_tick', self._host_scheduler.tick)
+        phase('drone_execute_actions', _drone_manager.execute_actions)
+        phase('send_queued_emails', email_manager.manager.send_queued_emails)
+        django.db.reset_queries()
+
+
     def _run_cleanup(self):
         self._periodic_cleanup.run_cleanup_maybe()
         self._24hr_upkeep.run_cleanup_maybe()
@@ -390,6 +411,15 @@ class Dispatcher(object):
                                        agent.queue_entry_ids, agent)
 
 
+    def _get_queue_entries(self, predicate):
+        """
+        Bring the queue entry cache up to date with the database and return
+        the incomplete HostQueueEntries accepted by predicate, by id.
+        """
+        self._queue_entry_cache.refresh()
+        return self._queue_entry_cache.get_entries(predicate)
+
+
     def _host_has_scheduled_special_task(self, host):
         return bool(models.SpecialTask.objects.filter(host__id=host.id,
                                                       is_active=False,
@@ -423,9 +453,8 @@ class Dispatcher(object):
                     models.HostQueueEntry.Status.GATHERING,
                     models.HostQueueEntry.Status.PARSING,
                     models.HostQueueEntry.Status.ARCHIVING)
-        status_list = ','.join("'%s'" % status for status in statuses)
-        queue_entries = scheduler_models.HostQueueEntry.fetch(
-                where='status IN (%s)' % status_list)
+        queue_entries = self._get_queue_entries(
+                lambda entry: entry.status in statuses)
 
         agent_tasks = []
         used_queue_entries = set()
@@ -533,8 +562,8 @@ class Dispatcher(object):
 
 
     def _get_unassigned_entries(self, status):
-        for entry in scheduler_models.HostQueueEntry.fetch(where="status = '%s'"
-                                                           % status):
+        for entry in self._get_queue_entries(
+                lambda entry: entry.status == status):
             if entry.status == status and not self.get_agents_for_entry(entry):
                 # The status can change during iteration, e.g., if job.run()
                 # sets a group of queue entries to Starting
@@ -563,8 +592,9 @@ class Dispatcher(object):
 
 
     def _check_for_unrecovered_verifying_entries(self):
-        queue_entries = scheduler_models.HostQueueEntry.fetch(
-                where='status = "%s"' % models.HostQueueEntry.Status.VERIFYING)
+        queue_entries = self._get_queue_entries(
+                lambda entry:
+                    entry.status == models.HostQueueEntry.Status.VERIFYING)
         unrecovered_hqes = []
         for queue_entry in queue_entries:
             special_tasks = models.SpecialTask.objects.filter(
@@ -656,11 +686,14 @@ class Dispatcher(object):
 
 
     def _get_pending_queue_entries(self):
+        queue_entries = self._get_queue_entries(
+                lambda entry: (not entry.active and
+                               entry.status ==
+                                       models.HostQueueEntry.Status.QUEUED))
         # prioritize by job priority, then non-metahost over metahost, then FIFO
-        return list(scheduler_models.HostQueueEntry.fetch(
-            joins='INNER JOIN afe_jobs ON (job_id=afe_jobs.id)',
-            where='NOT complete AND NOT active AND status="Queued"',
-            order_by='afe_jobs.priority DESC, meta_host, job_id'))
+        queue_entries.sort(key=lambda entry: (-entry.job.priority,
+                                              entry.meta_host, entry.job_id))
+        return queue_entries
 
 
     def _refresh_pending_queue_entries(self):
@@ -743,8 +776,9 @@ class Dispatcher(object):
 
 
     def _schedule_delay_tasks(self):
-        for entry in scheduler_models.HostQueueEntry.fetch(
-                where='status = "%s"' % models.HostQueueEntry.Status.WAITING):
+        for entry in self._get_queue_entries(
+                lambda entry:
+                    entry.status == models.HostQueueEntry.Status.WAITING):
             task = entry.job.schedule_delayed_callback_task(entry)
             if task:
                 self.add_agent_task(task)
@@ -756,8 +790,7 @@ class Dispatcher(object):
 
     def _find_aborting(self):
         jobs_to_stop = set()
-        for entry in scheduler_models.HostQueueEntry.fetch(
-                where='aborted and not complete'):
+        for entry in self._get_queue_entries(lambda entry: entry.aborted):
             logging.info('Aborting %s', entry)
             for agent in self.get_agents_for_entry(entry):
                 agent.abort()
@@ -1002,6 +1035,9 @@ class PidfileRunMonitor(object):
         process is unimportant here, as it shouldn't be used by anyone.
         """
         self.lost_process = True
+        # don't modify the contents held by the drone manager, they are
+        # reused across refreshes
+        self._state = drone_manager.PidfileContents()
         self._state.process = process
         self._state.exit_status = 1
         self._state.num_tests_failed = 0
@@ -2127,12 +2163,16 @@ class SelfThrottledPostJobTask(PostJobTask):
         if not self._can_run_new_process():
             return
 
-        # actually run the command
-        super(SelfThrottledPostJobTask, self).run()
+        self._start_process()
         if self._process_started():
             self._increment_running_processes()
 
 
+    def _start_process(self):
+        # actually run the command
+        super(SelfThrottledPostJobTask, self).run()
+
+
     def finished(self, success):
         super(SelfThrottledPostJobTask, self).finished(success)
         if self._process_started():
@@ -2166,6 +2206,30 @@ class FinalReparseTask(SelfThrottledPostJobTask):
         return scheduler_config.config.max_parse_processes
 
 
+    def _start_process(self):
+        socket_path = _get_parse_daemon_socket()
+        if not socket_path or _testing_mode:
+            super(FinalReparseTask, self)._start_process()
+            return
+        if not self._check_paired_results_exist():
+            return
+
+        results_dir = _drone_manager.absolute_path(self._working_directory())
+        try:
+            parse_daemon.submit(socket_path, results_dir)
+        except parse_daemon.SubmitError, e:
+            logging.warning('%s, starting a parser process instead', e)
+            super(FinalReparseTask, self)._start_process()
+            return
+        # the daemon wrote the pidfile of the parse, follow it as if it came
+        # from a parser process
+        self._create_monitor()
+        self.monitor.attach_to_existing_process(
+                self._working_directory(), pidfile_name=self._pidfile_name())
+        # the drone manager only reads the pidfiles registered with it
+        _drone_manager.register_pidfile(self.monitor.pidfile_id)
+
+
     def prolog(self):
         self._check_queue_entry_statuses(
                 self.queue_entries,
@@ -1,41 +1,22 @@
 #!/usr/bin/python
 
-import logging, os, unittest
+import datetime, logging, unittest
 try:
     import autotest.common as common
 except ImportError:
     import common
-from autotest.client.shared import enum, settings, host_protections
+from autotest.client.shared import settings, host_protections
 from autotest.database_legacy import database_connection
 from autotest.frontend import setup_django_environment
 from autotest.frontend.afe import frontend_test_utils, models
 from autotest.frontend.afe import model_attributes
 from autotest.scheduler import drone_manager, email_manager, host_scheduler
 from autotest.scheduler import monitor_db, scheduler_models
-
-# translations necessary for scheduler queries to work with SQLite
-_re_translator = database_connection.TranslatingDatabase.make_regexp_translator
-_DB_TRANSLATORS = (
-        _re_translator(r'NOW\(\)', 'time("now")'),
-        _re_translator(r'LAST_INSERT_ID\(\)', 'LAST_INSERT_ROWID()'),
-        # older SQLite doesn't support group_concat, so just don't bother until
-        # it arises in an important query
-        _re_translator(r'GROUP_CONCAT\((.*?)\)', r'\1'),
-)
+from autotest.scheduler import scheduler_test_utils
 
 HqeStatus = models.HostQueueEntry.Status
 HostStatus = models.Host.Status
 
-class NullMethodObject(object):
-    _NULL_METHODS = ()
-
-    def __init__(self):
-        def null_method(*args, **kwargs):
-            pass
-
-        for method_name in self._NULL_METHODS:
-            setattr(self, method_name, null_method)
-
 class MockGlobalConfig(object):
     def __init__(self):
         self._config_info = {}
@@ -53,253 +34,7 @@ class MockGlobalConfig(object):
         return self._config_info[identifier]
 
 
-# the SpecialTask names here must match the suffixes used on the SpecialTask
-# results directories
-_PidfileType = enum.Enum('verify', 'cleanup', 'repair', 'job', 'gather',
-                         'parse', 'archive')
-
-
-_PIDFILE_TO_PIDFILE_TYPE = {
-        drone_manager.AUTOSERV_PID_FILE: _PidfileType.JOB,
-        drone_manager.CRASHINFO_PID_FILE: _PidfileType.GATHER,
-        drone_manager.PARSER_PID_FILE: _PidfileType.PARSE,
-        drone_manager.ARCHIVER_PID_FILE: _PidfileType.ARCHIVE,
-        }
-
-
-_PIDFILE_TYPE_TO_PIDFILE = dict((value, key) for key, value
-                                in _PIDFILE_TO_PIDFILE_TYPE.iteritems())
-
-
-class MockDroneManager(NullMethodObject):
-    """
-    Public attributes:
-    max_runnable_processes_value: value returned by max_runnable_processes().
-            tests can change this to activate throttling.
-    """
-    _NULL_METHODS = ('reinitialize_drones', 'copy_to_results_repository',
-                     'copy_results_on_drone')
-
-    class _DummyPidfileId(object):
-        """
-        Object to represent pidfile IDs that is opaque to the scheduler code but
-        still debugging-friendly for us.
-        """
-        def __init__(self, working_directory, pidfile_name, num_processes=None):
-            self._working_directory = working_directory
-            self._pidfile_name = pidfile_name
-            self._num_processes = num_processes
-            self._paired_with_pidfile = None
-
-
-        def key(self):
-            """Key for MockDroneManager._pidfile_index"""
-            return (self._working_directory, self._pidfile_name)
-
-
-        def __str__(self):
-            return os.path.join(self._working_directory, self._pidfile_name)
-
-
-        def __repr__(self):
-            return '<_DummyPidfileId: %s>' % str(self)
-
-
-    def __init__(self):
-        super(MockDroneManager, self).__init__()
-        self.process_capacity = 100
-
-        # maps result_dir to set of tuples (file_path, file_contents)
-        self._attached_files = {}
-        # maps pidfile IDs to PidfileContents
-        self._pidfiles = {}
-        # pidfile IDs that haven't been created yet
-        self._future_pidfiles = []
-        # maps _PidfileType to the most recently created pidfile ID of that type
-        self._last_pidfile_id = {}
-        # maps (working_directory, pidfile_name) to pidfile IDs
-        self._pidfile_index = {}
-        # maps process to pidfile IDs
-        self._process_index = {}
-        # tracks pidfiles of processes that have been killed
-        self._killed_pidfiles = set()
-        # pidfile IDs that have just been unregistered (so will disappear on the
-        # next cycle)
-        self._unregistered_pidfiles = set()
-
-
-    # utility APIs for use by the test
-
-    def finish_process(self, pidfile_type, exit_status=0):
-        pidfile_id = self._last_pidfile_id[pidfile_type]
-        self._set_pidfile_exit_status(pidfile_id, exit_status)
-
-
-    def finish_specific_process(self, working_directory, pidfile_name):
-        pidfile_id = self.pidfile_from_path(working_directory, pidfile_name)
-        self._set_pidfile_exit_status(pidfile_id, 0)
-
-
-    def _set_pidfile_exit_status(self, pidfile_id, exit_status):
-        assert pidfile_id is not None
-        contents = self._pidfiles[pidfile_id]
-        contents.exit_status = exit_status
-        contents.num_tests_failed = 0
-
-
-    def was_last_process_killed(self, pidfile_type):
-        pidfile_id = self._last_pidfile_id[pidfile_type]
-        return pidfile_id in self._killed_pidfiles
-
-
-    def nonfinished_pidfile_ids(self):
-        return [pidfile_id for pidfile_id, pidfile_contents
-                in self._pidfiles.iteritems()
-                if pidfile_contents.exit_status is None]
-
-
-    def running_pidfile_ids(self):
-        return [pidfile_id for pidfile_id in self.nonfinished_pidfile_ids()
-                if self._pidfiles[pidfile_id].process is not None]
-
-
-    def pidfile_from_path(self, working_directory, pidfile_name):
-        return self._pidfile_index[(working_directory, pidfile_name)]
-
-
-    def attached_files(self, working_directory):
-        """
-        Return dict mapping path to contents for attached files with specified
-        paths.
-        """
-        return dict((path, contents) for path, contents
-                    in self._attached_files.get(working_directory, [])
-                    if path is not None)
-
-
-    # DroneManager emulation APIs for use by monitor_db
-
-    def get_orphaned_autoserv_processes(self):
-        return set()
-
-
-    def total_running_processes(self):
-        return sum(pidfile_id._num_processes
-                   for pidfile_id in self.nonfinished_pidfile_ids())
-
-
-    def max_runnable_processes(self, username, drone_hostnames_allowed):
-        return self.process_capacity - self.total_running_processes()
-
-
-    def refresh(self):
-        for pidfile_id in self._unregistered_pidfiles:
-            # intentionally handle non-registered pidfiles silently
-            self._pidfiles.pop(pidfile_id, None)
-        self._unregistered_pidfiles = set()
-
-
-    def execute_actions(self):
-        # executing an "execute_command" causes a pidfile to be created
-        for pidfile_id in self._future_pidfiles:
-            # Process objects are opaque to monitor_db
-            process = object()
-            self._pidfiles[pidfile_id].process = process
-            self._process_index[process] = pidfile_id
-        self._future_pidfiles = []
-
-
-    def attach_file_to_execution(self, result_dir, file_contents,
-                                 file_path=None):
-        self._attached_files.setdefault(result_dir, set()).add((file_path,
-                                                                file_contents))
-        return 'attach_path'
-
-
-    def _initialize_pidfile(self, pidfile_id):
-        if pidfile_id not in self._pidfiles:
-            assert pidfile_id.key() not in self._pidfile_index
-            self._pidfiles[pidfile_id] = drone_manager.PidfileContents()
-            self._pidfile_index[pidfile_id.key()] = pidfile_id
-
-
-    def _set_last_pidfile(self, pidfile_id, working_directory, pidfile_name):
-        if working_directory.startswith('hosts/'):
-            # such paths look like hosts/host1/1-verify, we'll grab the end
-            type_string = working_directory.rsplit('-', 1)[1]
-            pidfile_type = _PidfileType.get_value(type_string)
-        else:
-            pidfile_type = _PIDFILE_TO_PIDFILE_TYPE[pidfile_name]
-        self._last_pidfile_id[pidfile_type] = pidfile_id
-
-
-    def execute_command(self, command, working_directory, pidfile_name,
-                        num_processes, log_file=None, paired_with_pidfile=None,
-                        username=None, drone_hostnames_allowed=None):
-        logging.debug('Executing %s in %s', command, working_directory)
-        pidfile_id = self._DummyPidfileId(working_directory, pidfile_name)
-        if pidfile_id.key() in self._pidfile_index:
-            pidfile_id = self._pidfile_index[pidfile_id.key()]
-        pidfile_id._num_processes = num_processes
-        pidfile_id._paired_with_pidfile = paired_with_pidfile
-
-        self._future_pidfiles.append(pidfile_id)
-        self._initialize_pidfile(pidfile_id)
-        self._pidfile_index[(working_directory, pidfile_name)] = pidfile_id
-        self._set_last_pidfile(pidfile_id, working_directory, pidfile_name)
-        return pidfile_id
-
-
-    def get_pidfile_contents(self, pidfile_id, use_second_read=False):
-        if pidfile_id not in self._pidfiles:
-            logging.debug('Request for nonexistent pidfile %s' % pidfile_id)
-        return self._pidfiles.get(pidfile_id, drone_manager.PidfileContents())
-
-
-    def is_process_running(self, process):
-        return True
-
-
-    def register_pidfile(self, pidfile_id):
-        self._initialize_pidfile(pidfile_id)
-
-
-    def unregister_pidfile(self, pidfile_id):
-        self._unregistered_pidfiles.add(pidfile_id)
-
-
-    def declare_process_count(self, pidfile_id, num_processes):
-        pidfile_id.num_processes = num_processes
-
-
-    def absolute_path(self, path):
-        return 'absolute/' + path
-
-
-    def write_lines_to_file(self, file_path, lines, paired_with_process=None):
-        # TODO: record this
-        pass
-
-
-    def get_pidfile_id_from(self, execution_tag, pidfile_name):
-        default_pidfile = self._DummyPidfileId(execution_tag, pidfile_name,
-                                               num_processes=0)
-        return self._pidfile_index.get((execution_tag, pidfile_name),
-                                       default_pidfile)
-
-
-    def kill_process(self, process):
-        pidfile_id = self._process_index[process]
-        self._killed_pidfiles.add(pidfile_id)
-        self._set_pidfile_exit_status(pidfile_id, 271)
-
-
-class MockEmailManager(NullMethodObject):
-    _NULL_METHODS = ('send_queued_emails', 'send_email')
-
-    def enqueue_notify_email(self, subject, message):
-        logging.warn('enqueue_notify_email: %s', subject)
-        logging.warn(message)
+_PidfileType = scheduler_test_utils.PidfileType
 
 
 class SchedulerFunctionalTest(unittest.TestCase,
@@ -330,15 +65,15 @@ class SchedulerFunctionalTest(unittest.TestCase,
         self.mock_config = MockGlobalConfig()
         self.god.stub_with(settings, 'settings', self.mock_config)
 
-        self.mock_drone_manager = MockDroneManager()
+        self.mock_drone_manager = scheduler_test_utils.MockDroneManager()
         drone_manager._set_instance(self.mock_drone_manager)
 
-        self.mock_email_manager = MockEmailManager()
+        self.mock_email_manager = scheduler_test_utils.MockEmailManager()
         self.god.stub_with(email_manager, 'manager', self.mock_email_manager)
 
         self._database = (
             database_connection.TranslatingDatabase.get_test_database(
-                translators=_DB_TRANSLATORS))
+                translators=scheduler_test_utils.DB_TRANSLATORS))
         self._database.connect(db_type='django')
         self.god.stub_with(monitor_db, '_db', self._database)
         self.god.stub_with(scheduler_models, '_db', self._database)
@@ -358,6 +93,12 @@ class SchedulerFunctionalTest(unittest.TestCase,
         self.dispatcher.initialize()
 
 
+    def _update_queue_entries(self, queue_entries, **kwargs):
+        # QuerySet.update() bypasses auto_now and SQLite has no ON UPDATE
+        # CURRENT_TIMESTAMP, so bump last_modified for the scheduler to notice
+        queue_entries.update(last_modified=datetime.datetime.now(), **kwargs)
+
+
     def _run_dispatcher(self):
         for _ in xrange(self._A_LOT_OF_TICKS):
             self.dispatcher.tick()
@@ -526,7 +267,8 @@ class SchedulerFunctionalTest(unittest.TestCase,
 
 
     def _ensure_post_job_process_is_paired(self, queue_entry, pidfile_type):
-        pidfile_name = _PIDFILE_TYPE_TO_PIDFILE[pidfile_type]
+        pidfile_name = scheduler_test_utils.PIDFILE_TYPE_TO_PIDFILE[
+                pidfile_type]
         queue_entry = self._update_instance(queue_entry)
         pidfile_id = self.mock_drone_manager.pidfile_from_path(
                 queue_entry.execution_path(), pidfile_name)
@@ -645,7 +387,7 @@ class SchedulerFunctionalTest(unittest.TestCase,
         self._initialize_test()
         job = self._create_job(hosts=[1])
         self._run_dispatcher() # launches verify
-        job.hostqueueentry_set.update(aborted=True)
+        self._update_queue_entries(job.hostqueueentry_set, aborted=True)
         self._run_dispatcher() # kills verify, launches cleanup
         self.assert_(self.mock_drone_manager.was_last_process_killed(
                 _PidfileType.VERIFY))
@@ -660,7 +402,7 @@ class SchedulerFunctionalTest(unittest.TestCase,
         job.save()
 
         self._run_dispatcher() # launches job
-        job.hostqueueentry_set.update(aborted=True)
+        self._update_queue_entries(job.hostqueueentry_set, aborted=True)
         self._run_dispatcher() # kills job, launches gathering
         self.assert_(self.mock_drone_manager.was_last_process_killed(
                 _PidfileType.JOB))
@@ -676,7 +418,7 @@ class SchedulerFunctionalTest(unittest.TestCase,
         job.synch_count = 2
         job.save()
 
-        job.hostqueueentry_set.update(aborted=True)
+        self._update_queue_entries(job.hostqueueentry_set, aborted=True)
         self._run_dispatcher()
         for host_queue_entry in job.hostqueueentry_set.all():
             self.assertEqual(host_queue_entry.status,
@@ -771,7 +513,8 @@ class SchedulerFunctionalTest(unittest.TestCase,
         job = self._create_job(hosts=[1,2], atomic_group=1)
         job.save()
 
-        job.hostqueueentry_set.all().update(status=HqeStatus.PENDING)
+        self._update_queue_entries(job.hostqueueentry_set.all(),
+                                   status=HqeStatus.PENDING)
 
         self._initialize_test()
         for queue_entry in job.hostqueueentry_set.all():
@@ -817,7 +560,7 @@ class SchedulerFunctionalTest(unittest.TestCase,
 
         self.mock_drone_manager.process_capacity = 0
         self._run_dispatcher() # schedule job1, but won't start verify
-        job1.hostqueueentry_set.update(aborted=True)
+        self._update_queue_entries(job1.hostqueueentry_set, aborted=True)
         self.mock_drone_manager.process_capacity = 100
         self._run_dispatcher() # cleanup must run here, not verify for job2
         self._check_statuses(queue_entry1, HqeStatus.ABORTED,
@@ -977,7 +720,7 @@ class SchedulerFunctionalTest(unittest.TestCase,
         self._check_statuses(queue_entry, HqeStatus.STARTING,
                              HostStatus.PENDING)
 
-        job.hostqueueentry_set.update(aborted=True)
+        self._update_queue_entries(job.hostqueueentry_set, aborted=True)
         self._run_dispatcher()
         self._check_statuses(queue_entry, HqeStatus.GATHERING,
                              HostStatus.RUNNING)
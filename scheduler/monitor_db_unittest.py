@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import gc, logging, time
+import datetime, gc, logging, random, time
 try:
     import autotest.common as common
 except ImportError:
@@ -13,7 +13,8 @@ from autotest.database_legacy import database_connection
 from autotest.frontend.afe import models
 from autotest.scheduler import monitor_db, drone_manager, email_manager
 from autotest.scheduler import scheduler_config, gc_stats, host_scheduler
-from autotest.scheduler import monitor_db_functional_unittest
+from autotest.scheduler import metahost_scheduler
+from autotest.scheduler import scheduler_test_utils
 from autotest.scheduler import scheduler_models
 
 _DEBUG = False
@@ -96,7 +97,7 @@ class BaseSchedulerTest(unittest.TestCase,
 
         self._database = (
             database_connection.TranslatingDatabase.get_test_database(
-                translators=monitor_db_functional_unittest._DB_TRANSLATORS))
+                translators=scheduler_test_utils.DB_TRANSLATORS))
         self._database.connect(db_type='django')
         self._database.debug = _DEBUG
 
@@ -123,7 +124,18 @@ class BaseSchedulerTest(unittest.TestCase,
 
 
     def _update_hqe(self, set, where=''):
-        query = 'UPDATE afe_host_queue_entries SET ' + set
+        # bump last_modified so the dispatcher notices the change
+        query = ("UPDATE afe_host_queue_entries SET last_modified='%s', " %
+                 datetime.datetime.now().replace(microsecond=0)) + set
+        if where:
+            query += ' WHERE ' + where
+        self._do_query(query)
+
+
+    def _update_hosts(self, set, where=''):
+        # bump last_modified so the host index notices the change
+        query = ("UPDATE afe_hosts SET last_modified='%s', " %
+                 datetime.datetime.now().replace(microsecond=0)) + set
         if where:
             query += ' WHERE ' + where
         self._do_query(query)
@@ -197,14 +209,12 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
 
     def _convert_jobs_to_metahosts(self, *job_ids):
         sql_tuple = '(' + ','.join(str(i) for i in job_ids) + ')'
-        self._do_query('UPDATE afe_host_queue_entries SET '
-                       'meta_host=host_id, host_id=NULL '
-                       'WHERE job_id IN ' + sql_tuple)
+        self._update_hqe(set='meta_host=host_id, host_id=NULL',
+                         where='job_id IN ' + sql_tuple)
 
 
     def _lock_host(self, host_id):
-        self._do_query('UPDATE afe_hosts SET locked=1 WHERE id=' +
-                       str(host_id))
+        self._update_hosts(set='locked=1', where='id=%d' % host_id)
 
 
     def setUp(self):
@@ -245,17 +255,15 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
         scheduled.
         """
         self._create_job_simple([1], use_metahosts)
-        self._do_query('UPDATE afe_hosts SET status="Running" WHERE id=1')
+        self._update_hosts(set='status="Running"', where='id=1')
         self._run_scheduler()
         self._check_for_extra_schedulings()
 
-        self._do_query('UPDATE afe_hosts SET status="Ready", locked=1 '
-                       'WHERE id=1')
+        self._update_hosts(set='status="Ready", locked=1', where='id=1')
         self._run_scheduler()
         self._check_for_extra_schedulings()
 
-        self._do_query('UPDATE afe_hosts SET locked=0, invalid=1 '
-                       'WHERE id=1')
+        self._update_hosts(set='locked=0, invalid=1', where='id=1')
         self._run_scheduler()
         if not use_metahosts:
             self._assert_job_scheduled_on(1, 1)
@@ -299,7 +307,7 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
 
     def test_one_time_hosts_ignore_ACLs(self):
         self._do_query('DELETE FROM afe_acl_groups_hosts WHERE host_id=1')
-        self._do_query('UPDATE afe_hosts SET invalid=1 WHERE id=1')
+        self._update_hosts(set='invalid=1', where='id=1')
         self._create_job_simple([1])
         self._run_scheduler()
         self._assert_job_scheduled_on(1, 1)
@@ -311,7 +319,7 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
         Non-metahost entries can get scheduled on invalid hosts (this is how
         one-time hosts work).
         """
-        self._do_query('UPDATE afe_hosts SET invalid=1')
+        self._update_hosts(set='invalid=1')
         self._test_basic_scheduling_helper(False)
 
 
@@ -550,7 +558,7 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
 
     def test_atomic_group_scheduling_no_metahost(self):
         # Force it to schedule on the other group for a reliable test.
-        self._do_query('UPDATE afe_hosts SET invalid=1 WHERE id=9')
+        self._update_hosts(set='invalid=1', where='id=9')
         # An atomic job without a metahost.
         job = self._create_job(synchronous=True, atomic_group=1)
         self._run_scheduler()
@@ -561,7 +569,7 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
     def test_atomic_group_scheduling_partial_group(self):
         # Make one host in labels[3] unavailable so that there are only two
         # hosts left in the group.
-        self._do_query('UPDATE afe_hosts SET status="Repair Failed" WHERE id=5')
+        self._update_hosts(set='status="Repair Failed"', where='id=5')
         job = self._create_job(synchronous=True, metahosts=[self.label4.id],
                          atomic_group=1)
         self._run_scheduler()
@@ -574,10 +582,10 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
     def test_atomic_group_scheduling_not_enough_available(self):
         # Mark some hosts in each atomic group label as not usable.
         # One host running, another invalid in the first group label.
-        self._do_query('UPDATE afe_hosts SET status="Running" WHERE id=5')
-        self._do_query('UPDATE afe_hosts SET invalid=1 WHERE id=6')
+        self._update_hosts(set='status="Running"', where='id=5')
+        self._update_hosts(set='invalid=1', where='id=6')
         # One host invalid in the second group label.
-        self._do_query('UPDATE afe_hosts SET invalid=1 WHERE id=9')
+        self._update_hosts(set='invalid=1', where='id=9')
         # Nothing to schedule when no group label has enough (2) good hosts..
         self._create_job(atomic_group=1, synchronous=True)
         self._run_scheduler()
@@ -593,7 +601,7 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
 
 
     def test_atomic_group_scheduling_no_valid_hosts(self):
-        self._do_query('UPDATE afe_hosts SET invalid=1 WHERE id in (8,9)')
+        self._update_hosts(set='invalid=1', where='id in (8,9)')
         self._create_job(synchronous=True, metahosts=[self.label5.id],
                          atomic_group=1)
         self._run_scheduler()
@@ -700,7 +708,7 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
 
     def test_no_ready_hosts(self):
         self._create_job(hosts=[1])
-        self._do_query('UPDATE afe_hosts SET status="Repair Failed"')
+        self._update_hosts(set='status="Repair Failed"')
         self._run_scheduler()
         self._check_for_extra_schedulings()
 
@@ -721,6 +729,162 @@ class DispatcherSchedulingTest(BaseSchedulerTest):
 
 
 
+class HostIndexTest(BaseSchedulerTest):
+    def setUp(self):
+        super(HostIndexTest, self).setUp()
+        self.index = host_scheduler.HostIndex(self._database,
+                                              full_rebuild_interval=3600)
+        self.index.refresh()
+
+
+    def _ready_host_ids(self):
+        return set(self.index.get_ready_hosts())
+
+
+    def test_full_rebuild(self):
+        self.assertEquals(self._ready_host_ids(), set(xrange(1, 10)))
+        self.assertEquals(self.index.get_ready_hosts_in_label(self.label4.id),
+                          set([5, 6, 7]))
+        self.assert_(self.labels[0].id in self.index.get_host_labels(1))
+        self.assertEquals(len(self.index.get_host_acls(1)), 1)
+
+
+    def test_masks(self):
+        self.assertEquals(self.index.get_label_mask(self.label4.id),
+                          (1 << 5) | (1 << 6) | (1 << 7))
+        self._update_hosts(set='invalid=1', where='id=6')
+        self.hosts[6].labels.remove(self.label4)
+        self.index.refresh()
+        self.assertEquals(self.index.get_label_mask(self.label4.id),
+                          (1 << 5) | (1 << 6))
+        self.assertEquals(self.index.get_invalid_mask(), 1 << 6)
+        self.assertEquals(self.index.get_ready_mask(),
+                          host_scheduler._host_ids_to_mask(xrange(1, 10)))
+
+
+    def test_host_changes(self):
+        host = self.hosts[0]
+        host.locked = True
+        host.save()
+        self.hosts[1].labels.add(self.label3)
+        self.index.refresh()
+        self.assertEquals(self._ready_host_ids(), set(xrange(2, 10)))
+        self.assertEquals(
+                self.index.get_ready_hosts_in_label(self.labels[0].id), set())
+        self.assert_(self.label3.id in self.index.get_host_labels(2))
+        self.assertEquals(self.index.get_ready_hosts_in_label(self.label3.id),
+                          set([2]))
+
+        models.AclGroup.smart_get('my_acl').hosts.remove(self.hosts[1])
+        self.index.refresh()
+        self.assertEquals(self.index.get_host_acls(2), set())
+
+
+    def test_active_entries(self):
+        self._create_job(hosts=[1], active=True)
+        self.index.refresh()
+        self.assert_(1 not in self._ready_host_ids())
+
+        self._update_hqe(set='active=0, complete=1')
+        self.index.refresh()
+        self.assert_(1 in self._ready_host_ids())
+
+
+    def test_full_rebuild_fixes_stale_hosts(self):
+        # the hosts created by setUp are still within the overlap window of
+        # incremental refreshes, move them out of it
+        self._do_query("UPDATE afe_hosts SET last_modified='%s'" %
+                       datetime.datetime(2000, 1, 1))
+        # raw writes that don't bump last_modified go unnoticed...
+        self._do_query('DELETE FROM afe_acl_groups_hosts WHERE host_id=1')
+        self._do_query('UPDATE afe_hosts SET locked=1 WHERE id=2')
+        self.index.refresh()
+        self.assertEquals(len(self.index.get_host_acls(1)), 1)
+        self.assert_(2 in self._ready_host_ids())
+
+        # ...until the next full rebuild
+        self.index.invalidate()
+        self.index.refresh()
+        self.assertEquals(self.index.get_host_acls(1), frozenset())
+        self.assert_(2 not in self._ready_host_ids())
+
+
+class HostSchedulerEligibilityTest(BaseSchedulerTest):
+    """
+    The bitmasks of BaseHostScheduler.eligible_hosts_in_label() must accept
+    the hosts the host by host checks of HostSchedulingUtility accept.
+    """
+    def _restrict_hosts(self):
+        rng = random.Random(0)
+        # hosts the job owner has no ACL for
+        other_acl = models.AclGroup.objects.create(name='other_acl')
+        my_acl = models.AclGroup.smart_get('my_acl')
+        for host in rng.sample(self.hosts, 3):
+            my_acl.hosts.remove(host)
+            other_acl.hosts.add(host)
+        # more labels, only_if_needed ones included
+        plain_labels = [label for label in self.labels
+                        if label.atomic_group is None]
+        for host in self.hosts:
+            for label in rng.sample(plain_labels, 2):
+                host.labels.add(label)
+        only_if_needed = models.Label.objects.create(name='only_if_needed2',
+                                                     only_if_needed=True)
+        for host in rng.sample(self.hosts, 4):
+            host.labels.add(only_if_needed)
+        # an unusable host in most labels
+        invalid_host = self.hosts[1]
+        invalid_host.labels.add(self.label6, self.label7, self.label3)
+        self._update_hosts(set='invalid=1', where='id=%d' % invalid_host.id)
+        return only_if_needed
+
+
+    def _create_jobs(self, only_if_needed):
+        label_ids = [label.id for label in models.Label.objects.all()]
+        jobs = [self._create_job(metahosts=label_ids)]
+        for dependencies in ([self.label3], [self.label6, self.label7],
+                             [only_if_needed, self.label6]):
+            job = self._create_job(metahosts=label_ids)
+            job.dependency_labels = dependencies
+            jobs.append(job)
+        job = self._create_job(metahosts=label_ids)
+        for host in self.hosts[:4]:
+            models.IneligibleHostQueue.objects.create(job=job, host=host)
+        # an owner without any ACL
+        job = self._create_job(metahosts=label_ids)
+        models.User.objects.create(login='outsider')
+        job.owner = 'outsider'
+        job.save()
+        self._create_job(metahosts=[self.label4.id], atomic_group=1)
+        self._create_job(atomic_group=2)
+
+
+    def _check_eligible_hosts(self, queue_entries):
+        host_scheduler = self._dispatcher._host_scheduler
+        for queue_entry in queue_entries:
+            for label in models.Label.objects.all():
+                expected = set(metahost_scheduler.HostSchedulingUtility.
+                               eligible_hosts_in_label(host_scheduler,
+                                                       label.id, queue_entry))
+                self.assertEquals(
+                        set(host_scheduler.eligible_hosts_in_label(
+                                label.id, queue_entry)),
+                        expected, 'job %d, label %s' % (queue_entry.job_id,
+                                                        label.name))
+
+
+    def test_masks_match_host_checks(self):
+        self._create_jobs(self._restrict_hosts())
+        queue_entries = self._dispatcher._refresh_pending_queue_entries()
+        self._check_eligible_hosts(queue_entries)
+
+        # hosts taken by the entries scheduled earlier in the tick
+        host_scheduler = self._dispatcher._host_scheduler
+        for host in self.hosts[::3]:
+            host_scheduler.pop_host(host.id)
+        self._check_eligible_hosts(queue_entries)
+
+
 class DispatcherThrottlingTest(BaseSchedulerTest):
     """
     Test that the dispatcher throttles:
@@ -1538,5 +1702,70 @@ class AgentTaskTest(unittest.TestCase,
         self.god.check_playback()
 
 
+class FinalReparseTaskTest(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.god.stub_function(monitor_db, '_get_parse_daemon_socket')
+        self.god.stub_function(monitor_db.parse_daemon, 'submit')
+        self.drone_manager = self.god.create_mock_class(
+                drone_manager.DroneManager, 'drone_manager')
+        self.god.stub_with(monitor_db, '_drone_manager', self.drone_manager)
+        self.god.stub_function(monitor_db.SelfThrottledPostJobTask,
+                               '_start_process')
+
+        class MockFinalReparseTask(monitor_db.FinalReparseTask):
+            def __init__(self):
+                self.monitor = None
+            def _check_paired_results_exist(self):
+                return True
+            def _working_directory(self):
+                return 'job/dir'
+        self.task = MockFinalReparseTask()
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+
+
+    def _expect_submit(self):
+        monitor_db._get_parse_daemon_socket.expect_call().and_return(
+                '/parse.sock')
+        self.drone_manager.absolute_path.expect_call('job/dir').and_return(
+                '/results/job/dir')
+        return monitor_db.parse_daemon.submit.expect_call('/parse.sock',
+                                                          '/results/job/dir')
+
+
+    def test_submit_to_daemon(self):
+        self._expect_submit()
+        pidfile_id = object()
+        self.drone_manager.get_pidfile_id_from.expect_call(
+                'job/dir', pidfile_name=drone_manager.PARSER_PID_FILE
+                ).and_return(pidfile_id)
+        self.drone_manager.register_pidfile.expect_call(pidfile_id)
+
+        self.task._start_process()
+        self.god.check_playback()
+        self.assertEqual(self.task.monitor.pidfile_id, pidfile_id)
+
+
+    def test_submit_error_starts_parser(self):
+        self._expect_submit().and_raises(
+                monitor_db.parse_daemon.SubmitError('no daemon'))
+        monitor_db.SelfThrottledPostJobTask._start_process.expect_call()
+
+        self.task._start_process()
+        self.god.check_playback()
+        self.assertEqual(self.task.monitor, None)
+
+
+    def test_no_daemon_configured(self):
+        monitor_db._get_parse_daemon_socket.expect_call().and_return(None)
+        monitor_db.SelfThrottledPostJobTask._start_process.expect_call()
+
+        self.task._start_process()
+        self.god.check_playback()
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,477 @@
+#!/usr/bin/python
+"""
+Benchmark of the scheduler tick against a synthetic fleet.
+
+Each scale fills a fresh in-memory SQLite database with hosts, labels, ACL
+groups and completed, running and queued host queue entries, then drives
+Dispatcher.tick() against the MockDroneManager of scheduler_test_utils.  The
+latency, SQL queries, rows fetched and resident memory growth of every tick
+phase are reported per scale.
+
+The fleets are generated from --seed, so the query and row counts in the JSON
+written by --output only depend on the scales, the seed and the scheduler
+code, while the timings and memory growth also depend on the machine and its
+load.
+Runs on two commits, made on the same machine, can be compared with
+--baseline, which reports the phases that got slower or started issuing more
+queries and exits with status 1 if there is any.
+
+Example, growing the fleet and the load together:
+
+    scheduler_benchmark.py --hosts 100,1000,5000 --labels 10,50,200 \\
+            --queued 50,500,2500 --output before.json
+"""
+
+import datetime, json, logging, optparse, random, resource, sys
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.settings import settings
+from autotest.client.shared.test_utils import mock
+from autotest.database_legacy import database_connection
+from autotest.frontend import setup_django_environment
+from autotest.frontend import setup_test_environment, thread_local
+from autotest.frontend.afe import model_attributes, models
+from autotest.scheduler import drone_manager, email_manager, monitor_db
+from autotest.scheduler import scheduler_test_utils
+from autotest.scheduler import scheduler_models, tick_profiler
+from django.db import connection
+
+
+SCALE_KEYS = ('hosts', 'labels', 'acls', 'queued', 'running', 'completed')
+
+_DEFAULT_SCALES = {'hosts': '100,1000',
+                   'labels': '10,50',
+                   'acls': '2,10',
+                   'queued': '50,500',
+                   'running': '10,100',
+                   'completed': '1000,10000'}
+
+# share of the queued jobs asking for a specific host rather than a label, and
+# depending on an extra label
+_SPECIFIC_HOST_RATIO = 0.1
+_DEPENDENCY_RATIO = 0.2
+# share of the labels that are only_if_needed
+_ONLY_IF_NEEDED_RATIO = 0.1
+_LABELS_PER_HOST = 3
+
+# phases must get slower than the baseline by this much, on top of the
+# relative threshold, to be reported
+_MIN_SECONDS_INCREASE = 0.001
+_MIN_QUERIES_INCREASE = 0.5
+
+_BULK_BATCH_SIZE = 500
+
+
+def _get_rss_kb():
+    try:
+        statm = open('/proc/self/statm').read().split()
+        return int(statm[1]) * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        # peak rather than current usage, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class _MemoryTrackingProfiler(tick_profiler.TickProfiler):
+    """
+    A TickProfiler also recording how much the resident set size grew during
+    each phase.
+    """
+    def __init__(self, *args, **kwargs):
+        super(_MemoryTrackingProfiler, self).__init__(*args, **kwargs)
+        # maps phase name to the total growth in KB
+        self.rss_growth_kb = {}
+
+
+    def _run_measured(self, name, function, args, kwargs):
+        rss_before = _get_rss_kb()
+        try:
+            return super(_MemoryTrackingProfiler, self)._run_measured(
+                    name, function, args, kwargs)
+        finally:
+            self.rss_growth_kb[name] = (self.rss_growth_kb.get(name, 0) +
+                                        _get_rss_kb() - rss_before)
+
+
+def parse_scales(options):
+    """
+    @param options: An object with a comma separated list of integers for
+            every key of SCALE_KEYS.  Lists with a single value apply to every
+            scale, the others must all have the same length.
+
+    @returns A list of dicts mapping each key of SCALE_KEYS to an integer.
+    """
+    values = {}
+    for key in SCALE_KEYS:
+        values[key] = [int(value) for value
+                       in getattr(options, key).split(',')]
+    lengths = set(len(value_list) for value_list in values.itervalues())
+    lengths.discard(1)
+    if len(lengths) > 1:
+        raise ValueError('Lists of scales have different lengths: %s' %
+                         ', '.join('%s=%d' % (key, len(values[key]))
+                                   for key in SCALE_KEYS))
+    num_scales = lengths and lengths.pop() or 1
+
+    scales = []
+    for index in xrange(num_scales):
+        scale = {}
+        for key in SCALE_KEYS:
+            value_list = values[key]
+            scale[key] = value_list[index % len(value_list)]
+        if scale['running'] > scale['hosts']:
+            raise ValueError('Cannot run %(running)d entries on %(hosts)d '
+                             'hosts' % scale)
+        scales.append(scale)
+    return scales
+
+
+class _SyntheticFleet(object):
+    """
+    Fills the database with the hosts, labels, ACL groups and jobs of a scale.
+    Rows are inserted in batches with explicit ids, as saving them one at a
+    time would take longer than the benchmark itself.
+    """
+    def __init__(self, scale, seed):
+        self._scale = scale
+        self._random = random.Random(seed)
+        self._next_job_id = 1
+        self._next_entry_id = 1
+        if models.DroneSet.drone_sets_enabled():
+            models.DroneSet.objects.create(
+                    name=models.DroneSet.default_drone_set_name())
+        self._drone_set = (models.DroneSet.default_drone_set_name()
+                           and models.DroneSet.get_default())
+
+
+    def _bulk_create(self, model, objects):
+        """
+        Insert model instances with a single executemany() per batch.  Their
+        ids must be set, as they are not read back.
+        """
+        fields = model._meta.local_fields
+        query = 'INSERT INTO %s (%s) VALUES (%s)' % (
+                model._meta.db_table,
+                ', '.join(field.column for field in fields),
+                ', '.join(['%s'] * len(fields)))
+        rows = [[field.get_db_prep_save(field.pre_save(instance, True),
+                                        connection=connection)
+                 for field in fields]
+                for instance in objects]
+        cursor = connection.cursor()
+        for start in xrange(0, len(rows), _BULK_BATCH_SIZE):
+            cursor.executemany(query, rows[start:start + _BULK_BATCH_SIZE])
+
+
+    def create_fleet(self):
+        scale = self._scale
+        self.host_ids = range(1, scale['hosts'] + 1)
+        self.label_ids = range(1, scale['labels'] + 1)
+        num_only_if_needed = int(scale['labels'] * _ONLY_IF_NEEDED_RATIO)
+        self._bulk_create(models.Label, [
+                models.Label(id=label_id, name='label%d' % label_id,
+                             only_if_needed=label_id <= num_only_if_needed)
+                for label_id in self.label_ids])
+        self._bulk_create(models.Host, [
+                models.Host(id=host_id, hostname='host%d' % host_id)
+                for host_id in self.host_ids])
+
+        host_labels = []
+        labels_per_host = min(_LABELS_PER_HOST, len(self.label_ids))
+        for host_id in self.host_ids:
+            for label_id in self._random.sample(self.label_ids,
+                                                labels_per_host):
+                host_labels.append(models.Host.labels.through(
+                        host_id=host_id, label_id=label_id))
+        self._bulk_create(models.Host.labels.through, host_labels)
+
+        user = models.User.current_user()
+        acl_hosts = []
+        for acl_index in xrange(scale['acls']):
+            acl_group = models.AclGroup.objects.create(
+                    name='acl%d' % acl_index)
+            acl_group.users.add(user)
+            acl_hosts.extend(
+                    models.AclGroup.hosts.through(aclgroup_id=acl_group.id,
+                                                  host_id=host_id)
+                    for host_id in self.host_ids[acl_index::scale['acls']])
+        self._bulk_create(models.AclGroup.hosts.through, acl_hosts)
+
+
+    def _make_job(self, **kwargs):
+        job = models.Job(
+                id=self._next_job_id, name='benchmark',
+                owner=models.User.current_user().login,
+                created_on=datetime.datetime(2008, 1, 1),
+                reboot_before=model_attributes.RebootBefore.NEVER,
+                drone_set=self._drone_set, control_file='control', **kwargs)
+        self._next_job_id += 1
+        return job
+
+
+    def _make_entry(self, job, **kwargs):
+        entry = models.HostQueueEntry(id=self._next_entry_id, job_id=job.id,
+                                      **kwargs)
+        self._next_entry_id += 1
+        return entry
+
+
+    def create_completed_entries(self):
+        jobs, entries = [], []
+        Status = models.HostQueueEntry.Status
+        for _ in xrange(self._scale['completed']):
+            job = self._make_job()
+            jobs.append(job)
+            entries.append(self._make_entry(
+                    job, host_id=self._random.choice(self.host_ids),
+                    status=Status.COMPLETED, complete=True))
+        self._bulk_create(models.Job, jobs)
+        self._bulk_create(models.HostQueueEntry, entries)
+
+
+    def create_queued_entries(self, count, host_ids=()):
+        """
+        @param host_ids: Hosts to create one job each for.  The other jobs go
+                to a random host or label, with a random dependency.
+        """
+        jobs, entries, ineligible_hosts, dependencies = [], [], [], []
+        Status = models.HostQueueEntry.Status
+        host_ids = list(host_ids)
+        for index in xrange(count):
+            job = self._make_job()
+            jobs.append(job)
+            if index < len(host_ids):
+                host_id = host_ids[index]
+            elif self._random.random() < _SPECIFIC_HOST_RATIO:
+                host_id = self._random.choice(self.host_ids)
+            else:
+                host_id = None
+
+            if host_id is None:
+                entries.append(self._make_entry(
+                        job, meta_host_id=self._random.choice(self.label_ids),
+                        status=Status.QUEUED))
+                if self._random.random() < _DEPENDENCY_RATIO:
+                    dependencies.append(models.Job.dependency_labels.through(
+                            job_id=job.id,
+                            label_id=self._random.choice(self.label_ids)))
+            else:
+                entries.append(self._make_entry(job, host_id=host_id,
+                                                status=Status.QUEUED))
+                ineligible_hosts.append(models.IneligibleHostQueue(
+                        job_id=job.id, host_id=host_id))
+        self._bulk_create(models.Job, jobs)
+        self._bulk_create(models.HostQueueEntry, entries)
+        self._bulk_create(models.IneligibleHostQueue, ineligible_hosts)
+        self._bulk_create(models.Job.dependency_labels.through, dependencies)
+
+
+class _Benchmark(object):
+    def __init__(self, scale, ticks, warmup_ticks, seed):
+        self._scale = scale
+        self._ticks = ticks
+        self._warmup_ticks = warmup_ticks
+        self._seed = seed
+
+
+    def _set_up(self):
+        self._god = mock.mock_god()
+        setup_test_environment.set_up()
+        settings.override_value('AUTOTEST_WEB', 'parameterized_jobs', 'False')
+        settings.override_value('SERVER', 'rpc_logging', 'False')
+
+        self._drone_manager = scheduler_test_utils.MockDroneManager()
+        # throttling is left to the scheduler settings
+        self._drone_manager.process_capacity = sys.maxint
+        drone_manager._set_instance(self._drone_manager)
+        self._god.stub_with(email_manager, 'manager',
+                            scheduler_test_utils.MockEmailManager())
+
+        self._database = (
+                database_connection.TranslatingDatabase.get_test_database(
+                    translators=scheduler_test_utils.DB_TRANSLATORS))
+        self._database.connect(db_type='django')
+        database_connection.count_django_queries()
+        self._god.stub_with(monitor_db, '_db', self._database)
+        self._god.stub_with(scheduler_models, '_db', self._database)
+        monitor_db.initialize_globals()
+        scheduler_models.initialize_globals()
+
+
+    def _tear_down(self):
+        self._database.disconnect()
+        setup_test_environment.tear_down()
+        thread_local.set_user(None)
+        self._god.unstub_all()
+        scheduler_models.DBObject._clear_instance_cache()
+
+
+    def _run_ticks(self, dispatcher, ticks):
+        for _ in xrange(ticks):
+            dispatcher.tick()
+
+
+    def _summarize(self, profiler, dispatcher):
+        phases = {}
+        for phase in profiler.get_summary()['phases']:
+            name = phase['phase']
+            count = float(phase['count'])
+            phases[name] = {
+                    'seconds_p50': phase['seconds']['p50'],
+                    'seconds_p90': phase['seconds']['p90'],
+                    'queries_per_tick': phase['total_queries'] / count,
+                    'rows_per_tick': phase['total_rows'] / count,
+                    'rss_growth_kb': profiler.rss_growth_kb[name]}
+        active_entries = models.HostQueueEntry.objects.filter(
+                active=True).count()
+        queued_entries = models.HostQueueEntry.objects.filter(
+                status=models.HostQueueEntry.Status.QUEUED).count()
+        return {'scale': dict(self._scale),
+                'ticks': self._ticks,
+                'active_entries': active_entries,
+                'queued_entries': queued_entries,
+                'agents': len(dispatcher._agents),
+                'rss_kb': _get_rss_kb(),
+                'phases': phases}
+
+
+    def run(self):
+        self._set_up()
+        try:
+            fleet = _SyntheticFleet(self._scale, self._seed)
+            fleet.create_fleet()
+            fleet.create_completed_entries()
+            # the running load is made of jobs the scheduler starts itself,
+            # as the drone manager has no processes to recover
+            fleet.create_queued_entries(
+                    self._scale['running'],
+                    host_ids=fleet.host_ids[:self._scale['running']])
+
+            dispatcher = monitor_db.Dispatcher()
+            dispatcher.initialize()
+            self._run_ticks(dispatcher, self._warmup_ticks)
+
+            fleet.create_queued_entries(self._scale['queued'])
+            self._run_ticks(dispatcher, self._warmup_ticks)
+
+            profiler = _MemoryTrackingProfiler(window=self._ticks)
+            dispatcher._profiler = profiler
+            self._run_ticks(dispatcher, self._ticks)
+            return self._summarize(profiler, dispatcher)
+        finally:
+            self._tear_down()
+
+
+def _scale_key(scale):
+    return tuple(scale[key] for key in SCALE_KEYS)
+
+
+def compare_results(baseline, results, threshold):
+    """
+    @param baseline: Results of a previous run, as written by --output.
+    @param results: Results of this run.
+    @param threshold: Relative increase above which a phase has regressed.
+
+    @returns A list of (scale, phase, metric, baseline value, new value) for
+            every regression, for the scales present in both runs.
+    """
+    baseline_runs = dict((_scale_key(run['scale']), run)
+                         for run in baseline['runs'])
+    regressions = []
+    for run in results['runs']:
+        baseline_run = baseline_runs.get(_scale_key(run['scale']))
+        if baseline_run is None:
+            continue
+        for phase, stats in sorted(run['phases'].iteritems()):
+            baseline_stats = baseline_run['phases'].get(phase)
+            if baseline_stats is None:
+                continue
+            for metric, min_increase in (
+                    ('seconds_p50', _MIN_SECONDS_INCREASE),
+                    ('queries_per_tick', _MIN_QUERIES_INCREASE)):
+                old_value, new_value = baseline_stats[metric], stats[metric]
+                if (new_value > old_value * (1 + threshold)
+                    and new_value - old_value >= min_increase):
+                    regressions.append((run['scale'], phase, metric,
+                                        old_value, new_value))
+    return regressions
+
+
+def _format_scale(scale):
+    return ' '.join('%s=%d' % (key, scale[key]) for key in SCALE_KEYS)
+
+
+def format_run(run):
+    lines = ['%s: %d ticks, %d active and %d queued entries, %d agents, '
+             '%d KB resident' % (_format_scale(run['scale']), run['ticks'],
+                                 run['active_entries'], run['queued_entries'],
+                                 run['agents'], run['rss_kb']),
+             '%-36s %9s %9s %9s %10s %9s' % ('phase', 'p50 ms', 'p90 ms',
+                                            'queries', 'rows', 'rss KB')]
+    for phase, stats in sorted(run['phases'].iteritems()):
+        lines.append('%-36s %9.2f %9.2f %9.1f %10.1f %9d' % (
+                phase, stats['seconds_p50'] * 1000,
+                stats['seconds_p90'] * 1000, stats['queries_per_tick'],
+                stats['rows_per_tick'], stats['rss_growth_kb']))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    for key in SCALE_KEYS:
+        parser.add_option('--' + key, default=_DEFAULT_SCALES[key],
+                          help='Comma separated number of %s for each scale '
+                               '(default: %%default)' % key)
+    parser.add_option('--ticks', type='int', default=10,
+                      help='Measured ticks per scale (default: %default)')
+    parser.add_option('--warmup-ticks', type='int', default=3,
+                      help='Ticks run before adding the queued jobs, and again '
+                           'before measuring (default: %default)')
+    parser.add_option('--seed', type='int', default=0,
+                      help='Seed of the synthetic fleet (default: %default)')
+    parser.add_option('--output', help='Write the results to this JSON file')
+    parser.add_option('--baseline',
+                      help='Compare with the results of a previous --output')
+    parser.add_option('--threshold', type='float', default=0.2,
+                      help='Relative increase reported as a regression '
+                           '(default: %default)')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('Unexpected arguments: %s' % ' '.join(args))
+    try:
+        scales = parse_scales(options)
+    except ValueError, e:
+        parser.error(str(e))
+
+    # the scheduler logs every scheduling decision
+    logging.basicConfig(level=logging.WARNING)
+
+    results = {'runs': []}
+    for scale in scales:
+        run = _Benchmark(scale, options.ticks, options.warmup_ticks,
+                         options.seed).run()
+        results['runs'].append(run)
+        print format_run(run)
+        print
+
+    if options.output:
+        output_file = open(options.output, 'w')
+        try:
+            json.dump(results, output_file, sort_keys=True, indent=2)
+        finally:
+            output_file.close()
+
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        regressions = compare_results(baseline, results, options.threshold)
+        for scale, phase, metric, old_value, new_value in regressions:
+            print 'REGRESSION %s %s %s: %g -> %g' % (
+                    _format_scale(scale), phase, metric, old_value, new_value)
+        if regressions:
+            sys.exit(1)
+        print 'No regression against %s' % options.baseline
+
+
+if __name__ == '__main__':
+    main()
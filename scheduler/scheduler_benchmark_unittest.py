@@ -0,0 +1,86 @@
+#!/usr/bin/python
+
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.test_utils import unittest
+from autotest.scheduler import scheduler_benchmark
+
+
+class _Options(object):
+    def __init__(self, **kwargs):
+        for key in scheduler_benchmark.SCALE_KEYS:
+            setattr(self, key, kwargs.get(key, '1'))
+
+
+def _make_run(scale, **phases):
+    run_scale = dict((key, 1) for key in scheduler_benchmark.SCALE_KEYS)
+    run_scale.update(scale)
+    return {'scale': run_scale,
+            'phases': dict((name, {'seconds_p50': seconds,
+                                   'queries_per_tick': queries})
+                           for name, (seconds, queries) in phases.iteritems())}
+
+
+class ParseScalesTest(unittest.TestCase):
+    def test_single_values_are_broadcast(self):
+        scales = scheduler_benchmark.parse_scales(
+                _Options(hosts='10,20', queued='5'))
+        self.assertEquals([scale['hosts'] for scale in scales], [10, 20])
+        self.assertEquals([scale['queued'] for scale in scales], [5, 5])
+
+
+    def test_different_lengths(self):
+        self.assertRaises(ValueError, scheduler_benchmark.parse_scales,
+                          _Options(hosts='10,20', labels='1,2,3'))
+
+
+    def test_too_many_running(self):
+        self.assertRaises(ValueError, scheduler_benchmark.parse_scales,
+                          _Options(hosts='10', running='11'))
+
+
+class CompareResultsTest(unittest.TestCase):
+    def _compare(self, baseline_runs, runs):
+        return scheduler_benchmark.compare_results(
+                {'runs': baseline_runs}, {'runs': runs}, threshold=0.2)
+
+
+    def test_regressions(self):
+        baseline = [_make_run({'hosts': 10}, tick=(0.1, 10), refresh=(0.1, 2))]
+        runs = [_make_run({'hosts': 10}, tick=(0.2, 10), refresh=(0.1, 3))]
+        self.assertEquals(
+                [(phase, metric) for _, phase, metric, _, _
+                 in self._compare(baseline, runs)],
+                [('refresh', 'queries_per_tick'), ('tick', 'seconds_p50')])
+
+
+    def test_small_increases_are_ignored(self):
+        baseline = [_make_run({}, tick=(0.0001, 0))]
+        runs = [_make_run({}, tick=(0.0005, 0))]
+        self.assertEquals(self._compare(baseline, runs), [])
+
+
+    def test_unmatched_scales_and_phases(self):
+        baseline = [_make_run({'hosts': 10}, tick=(0.1, 1))]
+        runs = [_make_run({'hosts': 20}, tick=(1.0, 10)),
+                _make_run({'hosts': 10}, new_phase=(1.0, 10))]
+        self.assertEquals(self._compare(baseline, runs), [])
+
+
+class BenchmarkTest(unittest.TestCase):
+    def test_run(self):
+        scale = {'hosts': 20, 'labels': 5, 'acls': 2, 'queued': 10,
+                 'running': 5, 'completed': 20}
+        run = scheduler_benchmark._Benchmark(scale, ticks=2, warmup_ticks=1,
+                                             seed=0).run()
+        self.assertEquals(run['scale'], scale)
+        self.assert_(run['active_entries'] >= 5)
+        self.assert_('tick' in run['phases'])
+        self.assert_('schedule_new_jobs' in run['phases'])
+        self.assert_(scheduler_benchmark.format_run(run))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -131,6 +131,17 @@ class DBObject(object):
     _table_name = ''
     _fields = ()
 
+    # Subclasses MAY set this to the name of a column (also listed in _fields)
+    # that must be bumped to the current time on every write.
+    _last_modified_field = None
+
+    # Subclasses MAY map the relation names accepted by the prefetch argument
+    # of fetch() to (foreign key field, name of the related DBObject class).
+    _prefetch_relations = {}
+
+    # Maximum number of ids in the IN (...) list of one prefetch query.
+    _PREFETCH_CHUNK_SIZE = 1000
+
     # A mapping from (type, id) to the instance of the object for that
     # particular id.  This prevents us from creating new Job() and Host()
     # instances for every HostQueueEntry object that we instantiate as
@@ -189,8 +200,22 @@ class DBObject(object):
         cls._instances_by_type_and_id.clear()
 
 
+    @classmethod
+    def _get_select_columns(cls):
+        """
+        @returns The columns of _fields, in order, for the select list of the
+                queries whose rows build instances.  Rows are mapped to
+                _fields by position and the column order of the table is not
+                reliable (SQLite rebuilds the table when a migration adds a
+                column), so never SELECT * for them.
+        """
+        return ', '.join('%s.%s' % (cls._table_name, field)
+                         for field in cls._fields)
+
+
     def _fetch_row_from_db(self, row_id):
-        sql = 'SELECT * FROM %s WHERE ID=%%s' % self.__table
+        sql = 'SELECT %s FROM %s WHERE ID=%%s' % (self._get_select_columns(),
+                                                  self.__table)
         rows = _db.execute(sql, (row_id,))
         if not rows:
             raise DBError("row not found (table=%s, row id=%s)"
@@ -267,20 +292,36 @@ class DBObject(object):
         return int(rows[0][0])
 
 
+    @staticmethod
+    def _now():
+        # the stored timestamps have one second resolution
+        return datetime.datetime.now().replace(microsecond=0)
+
+
     def update_field(self, field, value):
         assert field in self._valid_fields
 
         if getattr(self, field) == value:
             return
 
-        query = "UPDATE %s SET %s = %%s WHERE id = %%s" % (self.__table, field)
-        _db.execute(query, (value, self.id))
+        if self._last_modified_field:
+            modified_time = self._now()
+            query = ("UPDATE %s SET %s = %%s, %s = %%s WHERE id = %%s" %
+                     (self.__table, field, self._last_modified_field))
+            _db.execute(query, (value, modified_time, self.id))
+            setattr(self, self._last_modified_field, modified_time)
+        else:
+            query = ("UPDATE %s SET %s = %%s WHERE id = %%s" %
+                     (self.__table, field))
+            _db.execute(query, (value, self.id))
 
         setattr(self, field, value)
 
 
     def save(self):
         if self.__new_record:
+            if self._last_modified_field:
+                setattr(self, self._last_modified_field, self._now())
             keys = self._fields[1:] # avoid id
             columns = ','.join([str(key) for key in keys])
             values = []
@@ -314,21 +355,83 @@ class DBObject(object):
 
 
     @classmethod
-    def fetch(cls, where='', params=(), joins='', order_by=''):
+    def fetch_by_ids(cls, ids):
+        """
+        Load the rows with the given ids using one query per
+        _PREFETCH_CHUNK_SIZE ids.  Instances already in the identity map are
+        updated in place, like a requery would.
+
+        @returns A list of instances, in no particular order.  Missing rows
+                are skipped.
+        """
+        ids = sorted(set(ids))
+        instances = []
+        for start in xrange(0, len(ids), cls._PREFETCH_CHUNK_SIZE):
+            chunk = ids[start:start + cls._PREFETCH_CHUNK_SIZE]
+            query = 'SELECT %s FROM %s WHERE id IN (%s)' % (
+                    cls._get_select_columns(), cls._table_name,
+                    ','.join(['%s'] * len(chunk)))
+            rows = _db.execute(query, chunk)
+            instances.extend(cls(id=row[0], row=row) for row in rows)
+        return instances
+
+
+    @classmethod
+    def _prefetch(cls, rows, relations):
+        """
+        Load the objects referenced by rows through each of the given
+        relations (see _prefetch_relations) into the identity map.
+
+        @returns The loaded objects.  The identity map only holds weak
+                references, so the caller must keep this list around until it
+                is done constructing the objects that refer to them.
+        """
+        related_objects = []
+        for relation in relations:
+            field, class_name = cls._prefetch_relations[relation]
+            related_class = globals()[class_name]
+            index = cls._fields.index(field)
+            related_ids = [row[index] for row in rows
+                           if row[index] is not None]
+            related_objects.extend(related_class.fetch_by_ids(related_ids))
+        return related_objects
+
+
+    @classmethod
+    def from_rows(cls, rows, prefetch=()):
+        """
+        Construct one instance per row, loading the objects of the prefetch
+        relations with one query per relation instead of one per row.
+        """
+        if not prefetch:
+            return [cls(id=row[0], row=row) for row in rows]
+        # only referenced to keep the related objects in the identity map
+        # until every instance refers to them
+        keepalive = cls._prefetch(rows, prefetch)
+        return [cls(id=row[0], row=row, prefetched=prefetch) for row in rows]
+
+
+    @classmethod
+    def fetch(cls, where='', params=(), joins='', order_by='', prefetch=()):
         """
         Construct instances of our class based on the given database query.
 
+        @param prefetch: names of relations (see _prefetch_relations) whose
+                objects are loaded in bulk along with the rows.
+
         @yields One class instance for each row fetched.
         """
         order_by = cls._prefix_with(order_by, 'ORDER BY ')
         where = cls._prefix_with(where, 'WHERE ')
-        query = ('SELECT %(table)s.* FROM %(table)s %(joins)s '
-                 '%(where)s %(order_by)s' % {'table' : cls._table_name,
+        query = ('SELECT %(columns)s FROM %(table)s %(joins)s '
+                 '%(where)s %(order_by)s' % {'columns' :
+                                                 cls._get_select_columns(),
+                                             'table' : cls._table_name,
                                              'joins' : joins,
                                              'where' : where,
                                              'order_by' : order_by})
         rows = _db.execute(query, params)
-        return [cls(id=row[0], row=row) for row in rows]
+        return cls.from_rows(rows, prefetch=prefetch)
 
 
 class IneligibleHostQueue(DBObject):
@@ -356,7 +459,9 @@ class Label(DBObject):
 class Host(DBObject):
     _table_name = 'afe_hosts'
     _fields = ('id', 'hostname', 'locked', 'synch_id', 'status',
-               'invalid', 'protection', 'locked_by_id', 'lock_time', 'dirty')
+               'invalid', 'protection', 'locked_by_id', 'lock_time', 'dirty',
+               'last_modified')
+    _last_modified_field = 'last_modified'
 
 
     def set_status(self,status):
@@ -429,16 +534,27 @@ class HostQueueEntry(DBObject):
     _table_name = 'afe_host_queue_entries'
     _fields = ('id', 'job_id', 'host_id', 'profile', 'status', 'meta_host',
                'active', 'complete', 'deleted', 'execution_subdir',
-               'atomic_group_id', 'aborted', 'started_on')
+               'atomic_group_id', 'aborted', 'started_on', 'last_modified')
+    _last_modified_field = 'last_modified'
+    _prefetch_relations = {'job': ('job_id', 'Job'),
+                           'host': ('host_id', 'Host')}
+    # what callers loading many entries should prefetch
+    ALL_RELATIONS = ('job', 'host')
 
 
-    def __init__(self, id=None, row=None, **kwargs):
+    def __init__(self, id=None, row=None, prefetched=(), **kwargs):
+        """
+        @param prefetched: relations whose objects were just loaded by the
+                caller (see DBObject.from_rows()), so they are not queried
+                again.
+        """
         assert id or row
         super(HostQueueEntry, self).__init__(id=id, row=row, **kwargs)
-        self.job = Job(self.job_id)
+        self.job = Job(self.job_id, always_query='job' not in prefetched)
 
         if self.host_id:
-            self.host = Host(self.host_id)
+            self.host = Host(self.host_id,
+                             always_query='host' not in prefetched)
         else:
             self.host = None
 
@@ -668,7 +784,9 @@ class HostQueueEntry(DBObject):
             return
 
         summary = []
-        hosts_queue = HostQueueEntry.fetch('job_id = %s' % self.job.id)
+        hosts_queue = HostQueueEntry.fetch(
+                'job_id = %s' % self.job.id,
+                prefetch=HostQueueEntry.ALL_RELATIONS)
         for queue_entry in hosts_queue:
             summary.append("Host: %s Status: %s" %
                                 (queue_entry._get_hostname(),
@@ -817,6 +935,150 @@ class HostQueueEntry(DBObject):
                 and self.atomic_group_id is None)
 
 
+class HostQueueEntryCache(object):
+    """
+    An in-memory mirror of every incomplete HostQueueEntry.
+
+    After the first full load, refresh() only fetches the rows whose
+    last_modified column moved since the previous refresh, so its cost
+    follows the rate of change instead of the size of the table.  Writes that
+    fail to bump last_modified (and rows deleted from under us) are caught by
+    a full resync every full_resync_interval seconds.
+
+    The hosts of the entries are refreshed the same way, from their own
+    last_modified column.  afe_jobs has no such column, so the job of an
+    entry is only reloaded along with a modified entry of the job, or by the
+    next full resync.
+    """
+    # Rows stamped up to this many seconds before the previous refresh are
+    # fetched again, to cover the one second resolution of the column, late
+    # committing transactions and small clock differences between writers.
+    _OVERLAP_SECS = 5
+
+
+    def __init__(self, full_resync_interval, now_func=time.time):
+        """
+        @param full_resync_interval: Seconds between two full resyncs.  Zero
+                resyncs on every refresh.
+        @param now_func: A time.time like function.  Used for testing.
+        """
+        self._full_resync_interval = full_resync_interval
+        self._now_func = now_func
+        # maps HostQueueEntry id to HostQueueEntry
+        self._entries = {}
+        self._last_refresh_time = None
+        self._last_full_resync_time = None
+
+
+    def invalidate(self):
+        """Make the next refresh() a full resync."""
+        self._last_full_resync_time = None
+
+
+    def _needs_full_resync(self, now):
+        if self._last_full_resync_time is None:
+            return True
+        return (now - self._last_full_resync_time >=
+                self._full_resync_interval)
+
+
+    def _fetch_rows(self, where, params=()):
+        query = 'SELECT %s FROM %s WHERE %s' % (
+                HostQueueEntry._get_select_columns(),
+                HostQueueEntry._table_name, where)
+        return _db.execute(query, params)
+
+
+    def _entry_from_row(self, row, known_entries):
+        """
+        The jobs and hosts of the row must have been prefetched by the caller
+        (see DBObject._prefetch()).
+        """
+        entry = known_entries.get(row[0])
+        if entry is not None and not entry._compare_fields_in_row(row):
+            # nothing changed since we last saw (or wrote) this row
+            return entry
+        return HostQueueEntry(id=row[0], row=row,
+                              prefetched=HostQueueEntry.ALL_RELATIONS)
+
+
+    def _prefetch(self, rows):
+        return HostQueueEntry._prefetch(rows, HostQueueEntry.ALL_RELATIONS)
+
+
+    def _full_resync(self):
+        rows = self._fetch_rows('NOT complete')
+        # this also refreshes the jobs and hosts of the entries we keep, and
+        # is only referenced to keep the new ones in the identity map
+        keepalive = self._prefetch(rows)
+        old_entries = self._entries
+        self._entries = {}
+        for row in rows:
+            self._entries[row[0]] = self._entry_from_row(row, old_entries)
+        logging.info('Loaded %d incomplete host queue entries',
+                     len(self._entries))
+
+
+    def _apply_changes(self, since):
+        modified_since = datetime.datetime.fromtimestamp(
+                since - self._OVERLAP_SECS).replace(microsecond=0)
+        rows = self._fetch_rows('last_modified >= %s', (modified_since,))
+        complete_index = HostQueueEntry._fields.index('complete')
+        incomplete_rows = [row for row in rows if not row[complete_index]]
+        # only referenced to keep the new jobs and hosts in the identity map
+        keepalive = self._prefetch(incomplete_rows)
+        for row in rows:
+            if row[complete_index]:
+                self._entries.pop(row[0], None)
+            else:
+                self._entries[row[0]] = self._entry_from_row(row,
+                                                             self._entries)
+        self._refresh_hosts(modified_since)
+
+
+    def _refresh_hosts(self, modified_since):
+        """
+        Update the hosts of the cached entries whose rows were modified since
+        the given time.
+        """
+        host_ids = set(entry.host_id for entry in self._entries.itervalues()
+                       if entry.host_id is not None)
+        query = 'SELECT %s FROM %s WHERE last_modified >= %%s' % (
+                Host._get_select_columns(), Host._table_name)
+        for row in _db.execute(query, (modified_since,)):
+            if row[0] in host_ids:
+                # updates the instance of the identity map in place
+                Host(id=row[0], row=row)
+
+
+    def refresh(self):
+        now = self._now_func()
+        if self._needs_full_resync(now):
+            self._full_resync()
+            self._last_full_resync_time = now
+        else:
+            self._apply_changes(since=self._last_refresh_time)
+        self._last_refresh_time = now
+
+
+    def get_entries(self, predicate=None):
+        """
+        @param predicate: Optional callable taking a HostQueueEntry, used to
+                filter the returned entries.
+
+        @returns A list of incomplete HostQueueEntry objects sorted by id.
+        """
+        entries = []
+        for entry_id in sorted(self._entries):
+            entry = self._entries[entry_id]
+            if entry.complete:
+                # completed by us since the last refresh
+                continue
+            if predicate is None or predicate(entry):
+                entries.append(entry)
+        return entries
+
+
 class Job(DBObject):
     _table_name = 'afe_jobs'
     _fields = ('id', 'owner', 'name', 'priority', 'control_file',
@@ -867,11 +1129,8 @@ class Job(DBObject):
 
 
     def get_host_queue_entries(self):
-        rows = _db.execute("""
-                SELECT * FROM afe_host_queue_entries
-                WHERE job_id= %s
-        """, (self.id,))
-        entries = [HostQueueEntry(row=i) for i in rows]
+        entries = HostQueueEntry.fetch(where='job_id = %s', params=(self.id,),
+                                       prefetch=HostQueueEntry.ALL_RELATIONS)
 
         assert len(entries)>0
 
@@ -1217,7 +1476,8 @@ class Job(DBObject):
         execution_subdir = queue_entry_from_group.execution_subdir
         return list(HostQueueEntry.fetch(
             where='job_id=%s AND execution_subdir=%s',
-            params=(self.id, execution_subdir)))
+            params=(self.id, execution_subdir),
+            prefetch=HostQueueEntry.ALL_RELATIONS))
 
 
     def _should_run_cleanup(self, queue_entry):
@@ -1291,7 +1551,8 @@ class Job(DBObject):
             where_clause = 'job_id = %s AND status = "Pending" AND id != %s'
             pending_entries = list(HostQueueEntry.fetch(
                      where=where_clause,
-                     params=(self.id, include_queue_entry.id)))
+                     params=(self.id, include_queue_entry.id),
+                     prefetch=HostQueueEntry.ALL_RELATIONS))
 
             # Sort the chosen hosts by hostname before slicing.
             def cmp_queue_entries_by_hostname(entry_a, entry_b):
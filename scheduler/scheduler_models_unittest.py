@@ -11,7 +11,7 @@ from autotest.client.shared.test_utils import mock
 from autotest.client.shared.test_utils import unittest
 from autotest.database_legacy import database_connection
 from autotest.frontend.afe import models, model_attributes
-from autotest.scheduler import monitor_db_functional_unittest
+from autotest.scheduler import scheduler_test_utils
 from autotest.scheduler import scheduler_models
 
 _DEBUG = False
@@ -31,7 +31,7 @@ class BaseSchedulerModelsTest(unittest.TestCase,
 
         self._database = (
             database_connection.TranslatingDatabase.get_test_database(
-                translators=monitor_db_functional_unittest._DB_TRANSLATORS))
+                translators=scheduler_test_utils.DB_TRANSLATORS))
         self._database.connect(db_type='django')
         self._database.debug = _DEBUG
 
@@ -140,6 +140,64 @@ class DBObjectTest(BaseSchedulerModelsTest):
         self.assert_(host_a is host_c, 'Cached instance not returned')
 
 
+    def _count_queries(self, function, *args, **kwargs):
+        queries_before = database_connection.DatabaseConnection.queries_executed
+        result = function(*args, **kwargs)
+        return (result, database_connection.DatabaseConnection.queries_executed
+                - queries_before)
+
+
+    def test_fetch_by_ids(self):
+        self.god.stub_with(scheduler_models.Host, '_PREFETCH_CHUNK_SIZE', 2)
+        hosts, queries = self._count_queries(
+                scheduler_models.Host.fetch_by_ids, [3, 1, 2, 1, 999])
+        self.assertEqual(queries, 2)
+        self.assertEqual(sorted(host.hostname for host in hosts),
+                         ['host1', 'host2', 'host3'])
+        self.assert_(scheduler_models.Host(id=1, always_query=False)
+                     in hosts)
+
+
+    def test_fetch_prefetch(self):
+        self._create_job(hosts=[1, 2, 3])
+        scheduler_models.DBObject._clear_instance_cache()
+        entries, queries = self._count_queries(
+                scheduler_models.HostQueueEntry.fetch,
+                prefetch=scheduler_models.HostQueueEntry.ALL_RELATIONS)
+        # one query for the entries, one for their jobs, one for their hosts
+        self.assertEqual(queries, 3)
+        self.assertEqual(len(entries), 3)
+        self.assert_(entries[0].job is entries[1].job is entries[2].job)
+        self.assertEqual(sorted(entry.host.hostname for entry in entries),
+                         ['host1', 'host2', 'host3'])
+
+        # without prefetching, every entry queries its job and host
+        scheduler_models.DBObject._clear_instance_cache()
+        entries, queries = self._count_queries(
+                scheduler_models.HostQueueEntry.fetch)
+        self.assertEqual(queries, 7)
+
+
+    def test_count_django_queries(self):
+        from django.db import connections, DEFAULT_DB_ALIAS
+        connection = connections[DEFAULT_DB_ALIAS]
+        self.god.stub_with(connection, 'cursor', connection.cursor)
+        database_connection.count_django_queries()
+        rows_before = database_connection.DatabaseConnection.rows_fetched
+        hosts, queries = self._count_queries(list, models.Host.objects.all())
+        self.assertEqual(queries, 1)
+        self.assertEqual(database_connection.DatabaseConnection.rows_fetched
+                         - rows_before, len(hosts))
+
+        # the queries of a DatabaseConnection are not counted twice
+        database = database_connection.TranslatingDatabase.get_test_database(
+                translators=scheduler_test_utils.DB_TRANSLATORS)
+        database.connect(db_type='django')
+        rows, queries = self._count_queries(database.execute,
+                                            'SELECT * FROM afe_hosts')
+        self.assertEqual(queries, 1)
+
+
     def test_delete(self):
         host = scheduler_models.Host(id=3)
         host.delete()
@@ -151,14 +209,15 @@ class DBObjectTest(BaseSchedulerModelsTest):
     def test_save(self):
         # Dummy Job to avoid creating a one in the HostQueueEntry __init__.
         class MockJob(object):
-            def __init__(self, id):
+            def __init__(self, id, **kwargs):
                 pass
             def tag(self):
                 return 'MockJob'
         self.god.stub_with(scheduler_models, 'Job', MockJob)
         hqe = scheduler_models.HostQueueEntry(
                 new_record=True,
-                row=[0, 1, 2, 'rhel6', 'Queued', None, 0, 0, 0, '.', None, False, None])
+                row=[0, 1, 2, 'rhel6', 'Queued', None, 0, 0, 0, '.', None, False, None,
+                     None])
         hqe.save()
         new_id = hqe.id
         # Force a re-query and verify that the correct data was stored.
@@ -176,6 +235,7 @@ class DBObjectTest(BaseSchedulerModelsTest):
         self.assertEqual(hqe.execution_subdir, '.')
         self.assertEqual(hqe.atomic_group_id, None)
         self.assertEqual(hqe.started_on, None)
+        self.assertNotEqual(hqe.last_modified, None)
 
 
 class HostTest(BaseSchedulerModelsTest):
@@ -409,5 +469,71 @@ class JobTest(BaseSchedulerModelsTest):
         self.assertEqual('my_rack.group1', job._next_group_name('my/rack'))
 
 
+class HostQueueEntryCacheTest(BaseSchedulerModelsTest):
+    def setUp(self):
+        super(HostQueueEntryCacheTest, self).setUp()
+        self._create_job(hosts=[1, 2])
+        self._cache = scheduler_models.HostQueueEntryCache(
+                full_resync_interval=3600)
+        self._cache.refresh()
+
+
+    def _statuses(self):
+        return [(entry.host_id, entry.status)
+                for entry in self._cache.get_entries()]
+
+
+    def test_full_resync_skips_complete_entries(self):
+        self._update_hqe('complete=1', where='host_id=2')
+        self._cache.invalidate()
+        self._cache.refresh()
+        self.assertEqual([(1, 'Queued')], self._statuses())
+
+
+    def test_refresh_fetches_modified_entries(self):
+        self._update_hqe("status='Pending', last_modified='%s'" %
+                         datetime.datetime.now().replace(microsecond=0),
+                         where='host_id=1')
+        self._cache.refresh()
+        self.assertEqual([(1, 'Pending'), (2, 'Queued')], self._statuses())
+
+
+    def test_refresh_ignores_unmodified_entries(self):
+        # a write that doesn't bump last_modified waits for the full resync
+        self._update_hqe("status='Pending', last_modified='2000-01-01'",
+                         where='host_id=1')
+        self._cache.refresh()
+        self.assertEqual([(1, 'Queued'), (2, 'Queued')], self._statuses())
+
+        self._cache.invalidate()
+        self._cache.refresh()
+        self.assertEqual([(1, 'Pending'), (2, 'Queued')], self._statuses())
+
+
+    def test_refresh_updates_modified_hosts(self):
+        # the entries themselves are not refetched
+        self._update_hqe("last_modified='2000-01-01'")
+        self._do_query("UPDATE afe_hosts SET locked=1, last_modified='%s' "
+                       "WHERE id=1" %
+                       datetime.datetime.now().replace(microsecond=0))
+        self._cache.refresh()
+        hosts = dict((entry.host_id, entry.host.locked)
+                     for entry in self._cache.get_entries())
+        self.assertEqual({1: True, 2: False}, hosts)
+
+
+    def test_completed_entries_are_dropped(self):
+        entry = self._cache.get_entries()[0]
+        entry.update_field('complete', True)
+        self.assertEqual([(2, 'Queued')], self._statuses())
+        self._cache.refresh()
+        self.assertEqual([(2, 'Queued')], self._statuses())
+
+
+    def test_get_entries_predicate(self):
+        entries = self._cache.get_entries(lambda entry: entry.host_id == 2)
+        self.assertEqual([2], [entry.host_id for entry in entries])
+
+
 if __name__ == '__main__':
     unittest.main()
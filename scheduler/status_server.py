@@ -3,7 +3,7 @@ try:
     import autotest.common as common
 except ImportError:
     import common
-from autotest.scheduler import drone_manager, scheduler_config
+from autotest.scheduler import drone_manager, scheduler_config, tick_profiler
 
 _PORT = 13467
 
@@ -22,10 +22,16 @@ _FOOTER = """
 </html>
 """
 
+# machine-readable tick statistics, see tick_profiler.py
+_METRICS_PATHS = {
+    '/metrics.json': ('application/json', 'get_json'),
+    '/metrics': ('text/plain; version=0.0.4', 'get_prometheus_text'),
+}
+
 class StatusServerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
-    def _send_headers(self):
+    def _send_headers(self, content_type='text/html'):
         self.send_response(200, 'OK')
-        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Type', content_type)
         self.end_headers()
 
 
@@ -84,7 +90,18 @@ class StatusServerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self._write_line()
 
 
+    def _write_metrics(self, path):
+        content_type, method_name = _METRICS_PATHS[path]
+        self._send_headers(content_type)
+        self.wfile.write(getattr(tick_profiler.instance(), method_name)())
+
+
     def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path in _METRICS_PATHS:
+            self._write_metrics(path)
+            return
+
         self._send_headers()
         self.wfile.write(_HEADER)
 
@@ -92,6 +109,8 @@ class StatusServerRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self._execute_actions(arguments)
         self._write_all_fields()
         self._write_drone_list()
+        self._write_line('Tick statistics: <a href="/metrics.json">JSON</a>, '
+                         '<a href="/metrics">Prometheus</a>')
 
         self.wfile.write(_FOOTER)
 
@@ -0,0 +1,213 @@
+"""
+Per-phase instrumentation of the scheduler tick.
+
+Every phase of Dispatcher.tick() is run through TickProfiler.run_phase(), which
+records its wall time together with the number of SQL queries and rows that
+went through database_connection, or through the Django ORM once
+database_connection.count_django_queries() is called, while it ran.  A
+rolling window of samples is kept per phase so percentiles reflect recent
+behaviour, and the results are exported by the status server as JSON and in
+the Prometheus text format.
+"""
+
+import collections, json, math, threading, time
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.settings import settings
+from autotest.database_legacy import database_connection
+from autotest.scheduler import scheduler_config
+
+
+# the whole tick is recorded as a pseudo-phase under this name
+TICK_PHASE = 'tick'
+PERCENTILES = (50, 90, 99)
+
+_METRIC_PREFIX = 'autotest_scheduler'
+
+
+def _database_counters():
+    connection_class = database_connection.DatabaseConnection
+    return connection_class.queries_executed, connection_class.rows_fetched
+
+
+def _percentile(sorted_values, percent):
+    """
+    Nearest-rank percentile of an already sorted, non-empty list.
+    """
+    rank = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    rank = max(rank, 0)
+    return sorted_values[rank]
+
+
+class _PhaseStats(object):
+    def __init__(self, window):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.total_queries = 0
+        self.total_rows = 0
+        self._seconds = collections.deque(maxlen=window)
+        self._queries = collections.deque(maxlen=window)
+        self._rows = collections.deque(maxlen=window)
+
+
+    def add_sample(self, seconds, queries, rows):
+        self.count += 1
+        self.total_seconds += seconds
+        self.total_queries += queries
+        self.total_rows += rows
+        self._seconds.append(seconds)
+        self._queries.append(queries)
+        self._rows.append(rows)
+
+
+    def _summarize_samples(self, samples):
+        summary = {'last': samples[-1]}
+        ordered = sorted(samples)
+        for percent in PERCENTILES:
+            summary['p%d' % percent] = _percentile(ordered, percent)
+        summary['max'] = ordered[-1]
+        return summary
+
+
+    def get_summary(self):
+        return {'count': self.count,
+                'total_seconds': self.total_seconds,
+                'total_queries': self.total_queries,
+                'total_rows': self.total_rows,
+                'seconds': self._summarize_samples(self._seconds),
+                'queries': self._summarize_samples(self._queries),
+                'rows': self._summarize_samples(self._rows)}
+
+
+class TickProfiler(object):
+    """
+    Collects per-phase statistics for the scheduler tick.
+
+    Phases are recorded from the scheduler thread while summaries are read from
+    the status server thread, so all access to the statistics goes through a
+    lock.
+    """
+    def __init__(self, window=100, time_func=time.time,
+                 counter_func=_database_counters):
+        """
+        @param window: number of recent samples kept per phase for
+                percentiles.
+        @param time_func: function returning the current time in seconds.
+        @param counter_func: function returning the running totals of
+                (queries executed, rows fetched).
+        """
+        self._window = window
+        self._time_func = time_func
+        self._counter_func = counter_func
+        self._lock = threading.Lock()
+        self._phases = {}
+        # phase names in the order they were first seen, for stable output
+        self._phase_names = []
+
+
+    def _add_sample(self, name, seconds, queries, rows):
+        self._lock.acquire()
+        try:
+            if name not in self._phases:
+                self._phases[name] = _PhaseStats(self._window)
+                self._phase_names.append(name)
+            self._phases[name].add_sample(seconds, queries, rows)
+        finally:
+            self._lock.release()
+
+
+    def _run_measured(self, name, function, args, kwargs):
+        start_time = self._time_func()
+        start_queries, start_rows = self._counter_func()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            end_queries, end_rows = self._counter_func()
+            self._add_sample(name, self._time_func() - start_time,
+                             end_queries - start_queries,
+                             end_rows - start_rows)
+
+
+    def run_phase(self, name, function, *args, **kwargs):
+        """
+        Call function(*args, **kwargs) and record it under the given phase
+        name.  Exceptions are propagated after the sample is recorded.
+        """
+        return self._run_measured(name, function, args, kwargs)
+
+
+    def run_tick(self, function, *args, **kwargs):
+        """
+        Call the tick function, recording it as a whole under TICK_PHASE.
+        """
+        return self._run_measured(TICK_PHASE, function, args, kwargs)
+
+
+    def get_summary(self):
+        """
+        @returns a dict with the sample window size and a list of per-phase
+                summaries, in the order the phases were first recorded.
+        """
+        self._lock.acquire()
+        try:
+            phases = []
+            for name in self._phase_names:
+                summary = self._phases[name].get_summary()
+                summary['phase'] = name
+                phases.append(summary)
+        finally:
+            self._lock.release()
+        return {'window': self._window, 'phases': phases}
+
+
+    def get_json(self):
+        return json.dumps(self.get_summary(), sort_keys=True, indent=2)
+
+
+    def get_prometheus_text(self):
+        """
+        @returns the statistics in the Prometheus text exposition format.
+        Each statistic is a summary: rolling percentiles as quantiles, plus
+        running sums and sample counts.
+        """
+        summary = self.get_summary()
+        lines = []
+        metrics = (('seconds', 'phase_seconds', 'total_seconds',
+                    'Wall time spent in each scheduler tick phase.'),
+                   ('queries', 'phase_queries', 'total_queries',
+                    'SQL queries issued by each scheduler tick phase, '
+                    'through database_connection and the Django ORM.'),
+                   ('rows', 'phase_rows', 'total_rows',
+                    'Rows fetched by each scheduler tick phase.'))
+        for key, metric, total_key, help_text in metrics:
+            metric = '%s_%s' % (_METRIC_PREFIX, metric)
+            lines.append('# HELP %s %s' % (metric, help_text))
+            lines.append('# TYPE %s summary' % metric)
+            for phase in summary['phases']:
+                for percent in PERCENTILES:
+                    lines.append('%s{phase="%s",quantile="%s"} %s'
+                                 % (metric, phase['phase'], percent / 100.0,
+                                    phase[key]['p%d' % percent]))
+                lines.append('%s_sum{phase="%s"} %s'
+                             % (metric, phase['phase'], phase[total_key]))
+                lines.append('%s_count{phase="%s"} %d'
+                             % (metric, phase['phase'], phase['count']))
+        return '\n'.join(lines) + '\n'
+
+
+_the_instance = None
+
+def instance():
+    if _the_instance is None:
+        window = settings.get_value(scheduler_config.CONFIG_SECTION,
+                                    'tick_profile_window', type=int,
+                                    default=100)
+        _set_instance(TickProfiler(window=window))
+    return _the_instance
+
+
+def _set_instance(instance): # usable for testing
+    global _the_instance
+    _the_instance = instance
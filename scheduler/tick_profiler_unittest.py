@@ -0,0 +1,110 @@
+#!/usr/bin/python
+
+import json
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.test_utils import unittest
+from autotest.scheduler import tick_profiler
+
+
+class TickProfilerTest(unittest.TestCase):
+    def setUp(self):
+        self._time = 0.0
+        self._queries = 0
+        self._rows = 0
+        self.profiler = tick_profiler.TickProfiler(
+                window=3, time_func=lambda: self._time,
+                counter_func=lambda: (self._queries, self._rows))
+
+
+    def _work(self, seconds, queries=0, rows=0):
+        self._time += seconds
+        self._queries += queries
+        self._rows += rows
+        return seconds
+
+
+    def _get_phase(self, name):
+        for phase in self.profiler.get_summary()['phases']:
+            if phase['phase'] == name:
+                return phase
+        self.fail('phase %s not recorded' % name)
+
+
+    def test_run_phase_records_sample(self):
+        result = self.profiler.run_phase('refresh', self._work, 2.0,
+                                         queries=3, rows=10)
+        self.assertEquals(result, 2.0)
+        phase = self._get_phase('refresh')
+        self.assertEquals(phase['count'], 1)
+        self.assertEquals(phase['seconds']['last'], 2.0)
+        self.assertEquals(phase['queries']['last'], 3)
+        self.assertEquals(phase['rows']['last'], 10)
+        self.assertEquals(phase['total_rows'], 10)
+
+
+    def test_exception_still_recorded(self):
+        def failing_phase():
+            self._work(1.0, queries=1)
+            raise ValueError
+        self.assertRaises(ValueError, self.profiler.run_phase, 'broken',
+                          failing_phase)
+        self.assertEquals(self._get_phase('broken')['total_queries'], 1)
+
+
+    def test_rolling_window(self):
+        for seconds in (100.0, 1.0, 2.0, 3.0):
+            self.profiler.run_phase('phase', self._work, seconds)
+        phase = self._get_phase('phase')
+        self.assertEquals(phase['count'], 4)
+        self.assertEquals(phase['total_seconds'], 106.0)
+        # the 100 second sample has fallen out of the window
+        self.assertEquals(phase['seconds']['max'], 3.0)
+        self.assertEquals(phase['seconds']['p50'], 2.0)
+        self.assertEquals(phase['seconds']['p99'], 3.0)
+
+
+    def test_tick_includes_phases(self):
+        def tick():
+            self.profiler.run_phase('first', self._work, 1.0, queries=1)
+            self.profiler.run_phase('second', self._work, 2.0, queries=2)
+        self.profiler.run_tick(tick)
+        names = [phase['phase']
+                 for phase in self.profiler.get_summary()['phases']]
+        self.assertEquals(names, ['first', 'second', tick_profiler.TICK_PHASE])
+        tick_phase = self._get_phase(tick_profiler.TICK_PHASE)
+        self.assertEquals(tick_phase['seconds']['last'], 3.0)
+        self.assertEquals(tick_phase['queries']['last'], 3)
+
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEquals(tick_profiler._percentile(values, 50), 50)
+        self.assertEquals(tick_profiler._percentile(values, 99), 99)
+        self.assertEquals(tick_profiler._percentile([7], 90), 7)
+
+
+    def test_json(self):
+        self.profiler.run_phase('refresh', self._work, 0.5, rows=4)
+        summary = json.loads(self.profiler.get_json())
+        self.assertEquals(summary['window'], 3)
+        self.assertEquals(summary['phases'][0]['rows']['p90'], 4)
+
+
+    def test_prometheus_text(self):
+        self.profiler.run_phase('refresh', self._work, 0.5, queries=2)
+        lines = self.profiler.get_prometheus_text().splitlines()
+        self.assert_('# TYPE autotest_scheduler_phase_seconds summary'
+                     in lines)
+        self.assert_('autotest_scheduler_phase_seconds'
+                     '{phase="refresh",quantile="0.9"} 0.5' in lines)
+        self.assert_('autotest_scheduler_phase_queries_sum{phase="refresh"} 2'
+                     in lines)
+        self.assert_('autotest_scheduler_phase_rows_count{phase="refresh"} 1'
+                     in lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
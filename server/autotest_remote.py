@@ -1,7 +1,8 @@
 # Copyright 2007 Google Inc. Released under the GPL v2
 
-import re, os, sys, traceback, time, glob, tempfile, logging
+import re, os, sys, traceback, time, glob, tempfile, logging, tarfile
 from autotest.server import installable_object, prebuild, utils
+from autotest.server import package_cache
 from autotest.client import os_dep
 from autotest.client import utils as client_utils
 from autotest.client.shared import base_job, log, error, autotemp
@@ -13,6 +14,14 @@ autoserv_prebuild = settings.get_value('AUTOSERV', 'enable_server_prebuild',
                                        type=bool, default=False)
 
 
+# the client directories a light install leaves for the client to fetch
+# from autoserv as packages
+LIGHT_INSTALL_EXCLUDED_DIRS = ("tests", "site_tests", "deps", "profilers")
+# the file listing the checksum of every client file autoserv installed in
+# an autodir, for the next install to only send the files that changed
+INSTALL_MANIFEST_FILE = '.install_manifest'
+
+
 class AutodirNotFoundError(Exception):
     """No Autotest installation could be found."""
 
@@ -206,12 +215,7 @@ class BaseAutotest(installable_object.InstallableObject):
         self.installed = True
 
 
-    def _install_using_send_file(self, host, autodir):
-        dirs_to_exclude = set(["tests", "site_tests", "deps", "profilers"])
-        light_files = [os.path.join(self.source_material, f)
-                       for f in os.listdir(self.source_material)
-                       if f not in dirs_to_exclude]
-
+    def _get_grubby_tarball(self):
         # there should be one and only one grubby tarball
         grubby_glob = os.path.join(self.source_material,
                                    "deps/grubby/grubby-*.tar.bz2")
@@ -219,7 +223,18 @@ class BaseAutotest(installable_object.InstallableObject):
         if grubby_tarball_paths:
             grubby_tarball_path = grubby_tarball_paths[0]
             if os.path.exists(grubby_tarball_path):
-                light_files.append(grubby_tarball_path)
+                return grubby_tarball_path
+        return None
+
+
+    def _install_using_send_file(self, host, autodir):
+        light_files = [os.path.join(self.source_material, f)
+                       for f in os.listdir(self.source_material)
+                       if f not in LIGHT_INSTALL_EXCLUDED_DIRS]
+
+        grubby_tarball_path = self._get_grubby_tarball()
+        if grubby_tarball_path:
+            light_files.append(grubby_tarball_path)
 
         host.send_file(light_files, autodir, delete_dest=True)
 
@@ -228,11 +243,15 @@ class BaseAutotest(installable_object.InstallableObject):
                                       '__init__.py')
         host.run("mkdir -p %s" % profilers_autodir)
         host.send_file(profilers_init, profilers_autodir, delete_dest=True)
-        dirs_to_exclude.discard("profilers")
+        self._create_excluded_dirs(host, autodir)
 
+
+    def _create_excluded_dirs(self, host, autodir):
         # create empty dirs for all the stuff we excluded
         commands = []
-        for path in dirs_to_exclude:
+        for path in LIGHT_INSTALL_EXCLUDED_DIRS:
+            if path == "profilers":
+                continue
             abs_path = os.path.join(autodir, path)
             abs_path = utils.sh_escape(abs_path)
             commands.append("mkdir -p '%s'" % abs_path)
@@ -240,6 +259,165 @@ class BaseAutotest(installable_object.InstallableObject):
         host.run(';'.join(commands))
 
 
+    def _get_install_files(self, light):
+        """
+        List the client files installed from the source material.
+
+        @param light: List the files of a light install, without the tests,
+                deps and profilers the client fetches from autoserv.
+
+        @return A list of (local path, path relative to the autodir) tuples.
+        """
+        install_files = []
+        for name in os.listdir(self.source_material):
+            if light and name in LIGHT_INSTALL_EXCLUDED_DIRS:
+                continue
+            path = os.path.join(self.source_material, name)
+            if not os.path.isdir(path):
+                install_files.append((path, name))
+                continue
+            for dirpath, _, filenames in os.walk(path):
+                relative_dir = dirpath[len(self.source_material):].lstrip('/')
+                for filename in filenames:
+                    install_files.append((os.path.join(dirpath, filename),
+                                          os.path.join(relative_dir,
+                                                       filename)))
+        if light:
+            grubby_tarball_path = self._get_grubby_tarball()
+            if grubby_tarball_path:
+                install_files.append((grubby_tarball_path,
+                                      os.path.basename(grubby_tarball_path)))
+            install_files.append((os.path.join(self.source_material,
+                                               'profilers', '__init__.py'),
+                                  'profilers/__init__.py'))
+        return install_files
+
+
+    def _get_install_manifest(self, light):
+        """
+        Compute the install manifest of the source material.
+
+        @param light: Compute the manifest of a light install.
+
+        @return A dictionary mapping the path relative to the autodir of
+                every file installed to a (local path, checksum) tuple, or
+                None if the source material is not a directory.
+        """
+        if not os.path.isdir(self.source_material):
+            return None
+        manifest = {}
+        for local_path, path in self._get_install_files(light):
+            mode = os.stat(local_path).st_mode & 07777
+            checksum = '%s %o' % (client_utils.hash_file(local_path), mode)
+            manifest[path] = (local_path, checksum)
+        return manifest
+
+
+    @staticmethod
+    def _write_install_manifest(manifest, manifest_file):
+        for path in sorted(manifest):
+            manifest_file.write('%s %s\n' % (manifest[path][1], path))
+
+
+    @staticmethod
+    def _parse_install_manifest(contents):
+        """
+        @return A dictionary mapping the path of every file listed in an
+                install manifest to its checksum.
+        """
+        installed = {}
+        for line in contents.splitlines():
+            md5, mode, path = line.split(' ', 2)
+            installed[path] = '%s %s' % (md5, mode)
+        return installed
+
+
+    def _send_install_manifest(self, host, autodir, manifest):
+        fd, manifest_path = tempfile.mkstemp(dir=host.job.tmpdir)
+        manifest_file = os.fdopen(fd, 'w')
+        try:
+            self._write_install_manifest(manifest, manifest_file)
+        finally:
+            manifest_file.close()
+        try:
+            host.send_file(manifest_path,
+                           os.path.join(autodir, INSTALL_MANIFEST_FILE))
+        finally:
+            os.remove(manifest_path)
+
+
+    def _install_delta(self, host, autodir, manifest, light):
+        """
+        Update the client installed in autodir by sending only the files
+        that changed since it was installed, and removing the ones that
+        are gone from the source material.
+
+        @return False if there is no install manifest in autodir to compare
+                the source material with, True once the client is updated.
+        """
+        manifest_path = os.path.join(autodir, INSTALL_MANIFEST_FILE)
+        result = host.run('cat %s' % utils.sh_escape(manifest_path),
+                          ignore_status=True)
+        if result.exit_status != 0:
+            return False
+        try:
+            installed = self._parse_install_manifest(result.stdout)
+        except ValueError:
+            logging.warning('Ignoring the corrupt install manifest %s',
+                            manifest_path)
+            return False
+
+        changed = sorted(path for path, (_, checksum) in manifest.iteritems()
+                         if installed.get(path) != checksum)
+        removed = sorted(path for path in installed if path not in manifest)
+        if not changed and not removed:
+            logging.info('Autotest is already installed in %s', autodir)
+            return True
+        logging.info('Updating %d files and removing %d files in %s',
+                     len(changed), len(removed), autodir)
+
+        # one tarball with the files changed and, last, the new manifest
+        fd, delta_path = tempfile.mkstemp(dir=host.job.tmpdir)
+        os.close(fd)
+        try:
+            delta = tarfile.open(delta_path, 'w:gz', dereference=True)
+            try:
+                for path in changed:
+                    delta.add(manifest[path][0], path)
+                manifest_info = tarfile.TarInfo(INSTALL_MANIFEST_FILE)
+                manifest_contents = tempfile.TemporaryFile()
+                self._write_install_manifest(manifest, manifest_contents)
+                manifest_info.size = manifest_contents.tell()
+                manifest_info.mtime = time.time()
+                manifest_contents.seek(0)
+                delta.addfile(manifest_info, manifest_contents)
+                manifest_contents.close()
+            finally:
+                delta.close()
+            remote_delta_path = os.path.join(autodir, '.install_delta.tar.gz')
+            host.send_file(delta_path, remote_delta_path)
+        finally:
+            os.remove(delta_path)
+
+        # drop the manifest first, an interrupted update leaves a client the
+        # next install will send in full
+        remove_paths = [INSTALL_MANIFEST_FILE]
+        for path in removed:
+            remove_paths.append(path)
+            if path.endswith('.py'):
+                remove_paths += [path + 'c', path + 'o']
+        commands = ['cd %s' % utils.sh_escape(autodir),
+                    'rm -f %s' % ' '.join('"%s"' % utils.sh_escape(path)
+                                          for path in remove_paths),
+                    'tar xzf .install_delta.tar.gz',
+                    'rm -f .install_delta.tar.gz']
+        host.run(' && '.join(commands))
+        if light:
+            # removed if the previous install was a full one
+            self._create_excluded_dirs(host, autodir)
+        return True
+
+
     def _install(self, host=None, autodir=None, use_autoserv=True,
                  use_packaging=True):
         """
@@ -316,11 +494,18 @@ class BaseAutotest(installable_object.InstallableObject):
             supports_autoserv_packaging = settings.get_value("PACKAGES",
                                                 "serve_packages_from_autoserv",
                                                 type=bool)
-            # Copy autotest recursively
-            if supports_autoserv_packaging and use_autoserv:
-                self._install_using_send_file(host, autodir)
-            else:
-                host.send_file(self.source_material, autodir, delete_dest=True)
+            light = supports_autoserv_packaging and use_autoserv
+            manifest = self._get_install_manifest(light)
+            if not manifest or not self._install_delta(host, autodir,
+                                                       manifest, light):
+                # Copy autotest recursively
+                if light:
+                    self._install_using_send_file(host, autodir)
+                else:
+                    host.send_file(self.source_material, autodir,
+                                   delete_dest=True)
+                if manifest:
+                    self._send_install_manifest(host, autodir, manifest)
             self._create_test_output_dir(host, autodir)
             logging.info("Installation of autotest completed")
             self.installed = True
@@ -1145,7 +1330,8 @@ class client_logger(object):
                         prebuild.setup(self.job.clientdir, src_dir)
                     break
         elif pkg_type == 'profiler':
-            src_dirs += [os.path.join(self.job.clientdir, 'profilers', name)]
+            src_dir = os.path.join(self.job.clientdir, 'profilers', name)
+            src_dirs += [src_dir]
             if autoserv_prebuild:
                 prebuild.setup(self.job.clientdir, src_dir)
         elif pkg_type == 'dep':
@@ -1158,22 +1344,34 @@ class client_logger(object):
         # iterate over src_dirs until we find one that exists, then tar it
         for src_dir in src_dirs:
             if os.path.exists(src_dir):
-                try:
+                exclude_paths = None
+                exclude_file_path = os.path.join(src_dir, ".pack_exclude")
+                if os.path.exists(exclude_file_path):
+                    exclude_file = open(exclude_file_path)
+                    exclude_paths = exclude_file.read().splitlines()
+                    exclude_file.close()
+
+                def build(dest_dir):
                     logging.info('Bundling %s into %s', src_dir, pkg_name)
-                    temp_dir = autotemp.tempdir(unique_id='autoserv-packager',
-                                                dir=self.job.tmpdir)
-
-                    exclude_paths = None
-                    exclude_file_path = os.path.join(src_dir, ".pack_exclude")
-                    if os.path.exists(exclude_file_path):
-                        exclude_file = open(exclude_file_path)
-                        exclude_paths = exclude_file.read().splitlines()
-                        exclude_file.close()
-
-                    tarball_path = self.job.pkgmgr.tar_package(
-                                            pkg_name, src_dir, temp_dir.name,
-                                            " .", exclude_paths)
-                    self.host.send_file(tarball_path, remote_dest)
+                    return self.job.pkgmgr.tar_package(pkg_name, src_dir,
+                                                       dest_dir, " .",
+                                                       exclude_paths)
+
+                cache = package_cache.get_package_cache()
+                if cache:
+                    # the same tarball is shared by all the hosts and jobs
+                    tarball_path, lock = cache.get_tarball(
+                            pkg_name, src_dir, exclude_paths, build)
+                    try:
+                        self.host.send_file(tarball_path, remote_dest)
+                    finally:
+                        cache.release(lock)
+                    return
+
+                temp_dir = autotemp.tempdir(unique_id='autoserv-packager',
+                                            dir=self.job.tmpdir)
+                try:
+                    self.host.send_file(build(temp_dir.name), remote_dest)
                 finally:
                     temp_dir.clean()
                 return
@@ -2,7 +2,7 @@
 
 __author__ = "raphtee@google.com (Travis Miller)"
 
-import unittest, os, tempfile, logging
+import unittest, os, tempfile, logging, shutil
 
 import common
 from autotest.server import autotest_remote, utils, hosts, server_job, profilers
@@ -349,6 +349,106 @@ class TestBaseAutotest(unittest.TestCase):
                              '/autotest/dest/:/autotest/fifo3')
 
 
+class InstallManifestTest(unittest.TestCase):
+    class FakeHost(object):
+        """A host whose autodir is a local directory."""
+        def __init__(self, tmpdir):
+            class job(object):
+                pass
+            self.job = job()
+            self.job.tmpdir = tmpdir
+            self.sent = []
+
+
+        def run(self, command, ignore_status=False):
+            return utils.run(command, ignore_status=ignore_status)
+
+
+        def send_file(self, source, dest):
+            self.sent.append(dest)
+            shutil.copy(source, dest)
+
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.source_dir = os.path.join(self.tmpdir, 'client')
+        self.autodir = os.path.join(self.tmpdir, 'autodir')
+        os.mkdir(self.autodir)
+        self.write(self.source_dir, 'job.py', 'job\n')
+        self.write(self.source_dir, 'shared/old.py', 'old\n')
+        self.host = self.FakeHost(self.tmpdir)
+        self.base_autotest = autotest_remote.BaseAutotest.__new__(
+                autotest_remote.BaseAutotest)
+        self.base_autotest.source_material = self.source_dir + '/'
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def write(self, base_dir, path, contents):
+        path = os.path.join(base_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        output = open(path, 'w')
+        output.write(contents)
+        output.close()
+
+
+    def read(self, path):
+        return open(os.path.join(self.autodir, path)).read()
+
+
+    def install(self):
+        manifest = self.base_autotest._get_install_manifest(False)
+        if self.base_autotest._install_delta(self.host, self.autodir,
+                                             manifest, False):
+            return True
+        shutil.rmtree(self.autodir)
+        shutil.copytree(self.source_dir, self.autodir)
+        self.base_autotest._send_install_manifest(self.host, self.autodir,
+                                                  manifest)
+        return False
+
+
+    def test_manifest(self):
+        manifest = self.base_autotest._get_install_manifest(False)
+        self.assertEqual(sorted(manifest), ['job.py', 'shared/old.py'])
+        self.assertEqual(manifest['job.py'][0],
+                         os.path.join(self.source_dir, 'job.py'))
+
+
+    def test_unchanged_client_not_sent(self):
+        self.assertFalse(self.install())
+        self.host.sent = []
+        self.assertTrue(self.install())
+        self.assertEqual(self.host.sent, [])
+
+
+    def test_only_changes_sent(self):
+        self.install()
+        self.write(self.autodir, 'shared/old.pyc', 'compiled')
+        self.write(self.autodir, 'results/keep', 'results')
+        self.write(self.source_dir, 'job.py', 'new job\n')
+        self.write(self.source_dir, 'shared/new.py', 'new\n')
+        os.remove(os.path.join(self.source_dir, 'shared/old.py'))
+
+        self.assertTrue(self.install())
+        self.assertEqual(self.read('job.py'), 'new job\n')
+        self.assertEqual(self.read('shared/new.py'), 'new\n')
+        self.assertEqual(self.read('results/keep'), 'results')
+        self.assertFalse(os.path.exists(os.path.join(self.autodir,
+                                                     'shared/old.py')))
+        self.assertFalse(os.path.exists(os.path.join(self.autodir,
+                                                     'shared/old.pyc')))
+        self.assertFalse(os.path.exists(os.path.join(
+                self.autodir, '.install_delta.tar.gz')))
+
+        self.host.sent = []
+        self.assertTrue(self.install())
+        self.assertEqual(self.host.sent, [])
+
+
 class test_autotest_mixin(unittest.TestCase):
     def setUp(self):
         # a dummy Autotest and job class for use in the mixin
@@ -0,0 +1,249 @@
+"""
+A cache of the package tarballs autoserv builds from its client directory
+for the clients that fetch packages from it, shared by all the autoserv
+processes of the server.
+
+The tarballs are keyed on a hash of the content of the directory packaged,
+so a test sent to any number of hosts, by any number of jobs, is only tarred
+once for as long as it does not change. A request for a tarball another
+process is building waits for that build rather than starting its own. The
+least recently used tarballs are evicted once the cache grows past its size
+limit, except the ones being sent.
+"""
+
+import errno, fcntl, logging, os, re, shutil, stat, tempfile
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared import autotemp, error, utils
+from autotest.client.shared.settings import settings
+
+
+# the cache entries are named after the key of the tarball they hold
+_ENTRY_NAME_RE = re.compile(r'^[0-9a-f]{32}$')
+_READ_SIZE = 1 << 20
+
+
+def tree_hash(src_dir, exclude_paths=None):
+    """
+    Hash the names, modes and contents of everything under src_dir, and the
+    paths excluded from its tarball.
+
+    @param src_dir: The directory to hash.
+    @param exclude_paths: The list of paths excluded from the tarball.
+
+    @return The hex digest of the tree.
+    """
+    digest = utils.hash('md5')
+    digest.update(repr(exclude_paths))
+    for dirpath, dirnames, filenames in os.walk(src_dir):
+        dirnames.sort()
+        relative_dir = dirpath[len(src_dir):]
+        for name in dirnames + sorted(filenames):
+            path = os.path.join(dirpath, name)
+            mode = os.lstat(path).st_mode
+            digest.update('\0%s/%s\0%o\0' % (relative_dir, name, mode))
+            if stat.S_ISLNK(mode):
+                digest.update(os.readlink(path))
+            elif stat.S_ISREG(mode):
+                src_file = open(path, 'rb')
+                try:
+                    data = src_file.read(_READ_SIZE)
+                    while data:
+                        digest.update(data)
+                        data = src_file.read(_READ_SIZE)
+                finally:
+                    src_file.close()
+    return digest.hexdigest()
+
+
+class PackageCache(object):
+    """
+    A directory of package tarballs, one subdirectory per tarball named
+    after its key, each with a lock file next to it.
+
+    A shared lock on the lock file of an entry keeps it from being evicted,
+    an exclusive one is held while it is built or evicted.
+    """
+    def __init__(self, cache_dir, max_size):
+        """
+        @param cache_dir: The directory holding the tarballs.
+        @param max_size: The size in bytes the cache is kept under.
+        """
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        try:
+            os.makedirs(cache_dir, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        # the tarballs are sent to the hosts as they are, so nobody else may
+        # be able to put theirs in the cache
+        stat_result = os.lstat(cache_dir)
+        if not stat.S_ISDIR(stat_result.st_mode):
+            raise error.AutoservError('Package cache %s is not a directory' %
+                                      cache_dir)
+        if stat_result.st_uid != os.getuid():
+            raise error.AutoservError('Package cache %s is not owned by uid '
+                                      '%d' % (cache_dir, os.getuid()))
+        if stat_result.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+            raise error.AutoservError('Package cache %s is writable by other '
+                                      'users' % cache_dir)
+
+
+    def _lock_path(self, key):
+        return os.path.join(self.cache_dir, key + '.lock')
+
+
+    def _lock(self, key, operation):
+        """
+        Lock the entry of key.
+
+        @return The file descriptor holding the lock, for release().
+        """
+        lock_path = self._lock_path(key)
+        while True:
+            lock = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0644)
+            try:
+                fcntl.flock(lock, operation)
+                # the lock file is removed when its entry is evicted, retry
+                # with a new one if it was while we waited for the lock
+                if os.path.exists(lock_path) and os.path.samestat(
+                        os.fstat(lock), os.stat(lock_path)):
+                    return lock
+            except:
+                os.close(lock)
+                raise
+            os.close(lock)
+
+
+    def release(self, lock):
+        """
+        Release a lock returned by get_tarball().
+        """
+        os.close(lock)
+
+
+    def get_tarball(self, pkg_name, src_dir, exclude_paths, build):
+        """
+        Get the tarball of src_dir from the cache, building it if it is not
+        there yet.
+
+        @param pkg_name: The name of the tarball.
+        @param src_dir: The directory packaged.
+        @param exclude_paths: The list of paths excluded from the tarball.
+        @param build: A function taking a directory, building the tarball in
+                it and returning its path.
+
+        @return A (tarball path, lock) tuple. The tarball stays in the cache
+                until the lock is given to release().
+        """
+        key_hash = utils.hash('md5', pkg_name)
+        key_hash.update(tree_hash(src_dir, exclude_paths))
+        key = key_hash.hexdigest()
+        entry_dir = os.path.join(self.cache_dir, key)
+        tarball_path = os.path.join(entry_dir, pkg_name)
+
+        built = False
+        while True:
+            lock = self._lock(key, fcntl.LOCK_SH)
+            if os.path.exists(tarball_path):
+                # the modification time orders the tarballs for eviction
+                os.utime(tarball_path, None)
+                if built:
+                    self._evict()
+                return tarball_path, lock
+            # build it unless another process did while we waited
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                if not os.path.exists(tarball_path):
+                    self._build(entry_dir, build)
+                    built = True
+            finally:
+                self.release(lock)
+
+
+    def _build(self, entry_dir, build):
+        temp_dir = autotemp.tempdir(unique_id='package-cache',
+                                    dir=self.cache_dir)
+        try:
+            tarball_path = build(temp_dir.name)
+            # an entry left incomplete by an interrupted build
+            if os.path.exists(entry_dir):
+                shutil.rmtree(entry_dir)
+            os.mkdir(entry_dir)
+            os.rename(tarball_path,
+                      os.path.join(entry_dir, os.path.basename(tarball_path)))
+        finally:
+            temp_dir.clean()
+
+
+    def _entries(self):
+        """
+        @return A list of (modification time, size, key) of the cached
+                tarballs.
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if not _ENTRY_NAME_RE.match(key):
+                continue
+            entry_dir = os.path.join(self.cache_dir, key)
+            try:
+                for name in os.listdir(entry_dir):
+                    stat_result = os.stat(os.path.join(entry_dir, name))
+                    entries.append((stat_result.st_mtime, stat_result.st_size,
+                                    key))
+            except OSError:
+                pass  # evicted by another process
+        return entries
+
+
+    def _evict(self):
+        """
+        Remove the least recently used tarballs until the cache is under
+        its size limit, skipping the ones in use.
+        """
+        entries = sorted(self._entries())
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                lock = self._lock(key, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                continue  # being sent or built
+            try:
+                logging.debug('Evicting package cache entry %s', key)
+                shutil.rmtree(os.path.join(self.cache_dir, key),
+                              ignore_errors=True)
+                os.unlink(self._lock_path(key))
+            finally:
+                self.release(lock)
+            total_size -= size
+
+
+def get_package_cache():
+    """
+    Get the package cache configured in global_config.ini.
+
+    @return A PackageCache, or None if the cache is disabled or its
+            directory can't be trusted.
+    """
+    max_size_mb = settings.get_value('PACKAGES',
+                                     'autoserv_package_cache_size_mb',
+                                     type=int, default=1024)
+    if max_size_mb <= 0:
+        return None
+    cache_dir = settings.get_value('PACKAGES', 'autoserv_package_cache_dir',
+                                   default='')
+    if not cache_dir:
+        cache_dir = os.path.join(tempfile.gettempdir(),
+                                 'autoserv_package_cache.%d' % os.getuid())
+    try:
+        return PackageCache(cache_dir, max_size_mb << 20)
+    except error.AutoservError, e:
+        logging.warning('Not caching packages: %s', e)
+        return None
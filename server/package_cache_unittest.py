@@ -0,0 +1,129 @@
+#!/usr/bin/python
+
+import os, shutil, tempfile, unittest
+
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared import error
+from autotest.client.shared.settings import settings
+from autotest.server import package_cache
+
+
+class PackageCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmpdir, 'src')
+        os.mkdir(self.src_dir)
+        self.write_src('test.py', 'pass\n')
+        self.cache = package_cache.PackageCache(
+                os.path.join(self.tmpdir, 'cache'), 1000)
+        self.builds = []
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def write_src(self, name, contents):
+        src_file = open(os.path.join(self.src_dir, name), 'w')
+        src_file.write(contents)
+        src_file.close()
+
+
+    def get_tarball(self, pkg_name, exclude_paths=None, size=100):
+        def build(dest_dir):
+            self.builds.append(pkg_name)
+            tarball_path = os.path.join(dest_dir, pkg_name)
+            tarball = open(tarball_path, 'w')
+            tarball.write('x' * size)
+            tarball.close()
+            return tarball_path
+        return self.cache.get_tarball(pkg_name, self.src_dir, exclude_paths,
+                                      build)
+
+
+    def get_tarball_path(self, pkg_name, **dargs):
+        tarball_path, lock = self.get_tarball(pkg_name, **dargs)
+        self.cache.release(lock)
+        return tarball_path
+
+
+    def test_tarball_built_once(self):
+        tarball_path = self.get_tarball_path('test-a.tar.bz2')
+        self.assertEqual(os.path.basename(tarball_path), 'test-a.tar.bz2')
+        self.assertEqual(self.get_tarball_path('test-a.tar.bz2'),
+                         tarball_path)
+        self.assertEqual(self.builds, ['test-a.tar.bz2'])
+
+
+    def test_changed_tree_rebuilt(self):
+        tarball_path = self.get_tarball_path('test-a.tar.bz2')
+        self.write_src('test.py', 'pass # changed\n')
+        self.assertNotEqual(self.get_tarball_path('test-a.tar.bz2'),
+                            tarball_path)
+        self.get_tarball_path('test-a.tar.bz2', exclude_paths=['test.py'])
+        self.assertEqual(self.builds, ['test-a.tar.bz2'] * 3)
+
+
+    def test_least_recently_used_evicted(self):
+        first_path = self.get_tarball_path('test-a.tar.bz2', size=400)
+        second_path = self.get_tarball_path('test-b.tar.bz2', size=400)
+        os.utime(first_path, (1, 1))
+        os.utime(second_path, (2, 2))
+        self.get_tarball_path('test-a.tar.bz2')
+        third_path = self.get_tarball_path('test-c.tar.bz2', size=400)
+        self.assertTrue(os.path.exists(first_path))
+        self.assertFalse(os.path.exists(second_path))
+        self.assertTrue(os.path.exists(third_path))
+
+
+    def test_tarball_in_use_not_evicted(self):
+        first_path, lock = self.get_tarball('test-a.tar.bz2', size=800)
+        os.utime(first_path, (1, 1))
+        try:
+            self.get_tarball_path('test-b.tar.bz2', size=800)
+            self.assertTrue(os.path.exists(first_path))
+        finally:
+            self.cache.release(lock)
+        self.get_tarball_path('test-c.tar.bz2', size=100)
+        self.assertFalse(os.path.exists(first_path))
+
+
+    def test_cache_dir_private(self):
+        mode = os.stat(os.path.join(self.tmpdir, 'cache')).st_mode
+        self.assertEqual(mode & 0077, 0)
+
+
+    def test_untrusted_cache_dir_refused(self):
+        shared_dir = os.path.join(self.tmpdir, 'shared')
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0777)
+        self.assertRaises(error.AutoservError, package_cache.PackageCache,
+                          shared_dir, 1000)
+
+        real_getuid = os.getuid
+        os.getuid = lambda: real_getuid() + 1
+        try:
+            self.assertRaises(error.AutoservError,
+                              package_cache.PackageCache,
+                              os.path.join(self.tmpdir, 'cache'), 1000)
+        finally:
+            os.getuid = real_getuid
+
+
+    def test_get_package_cache_untrusted_dir(self):
+        shared_dir = os.path.join(self.tmpdir, 'shared')
+        os.mkdir(shared_dir)
+        os.chmod(shared_dir, 0777)
+        settings.override_value('PACKAGES', 'autoserv_package_cache_dir',
+                                shared_dir)
+        try:
+            self.assertEqual(package_cache.get_package_cache(), None)
+        finally:
+            settings.reset_values()
+
+
+if __name__ == '__main__':
+    unittest.main()
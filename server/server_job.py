@@ -12,6 +12,7 @@ from autotest.client import sysinfo
 from autotest.client.shared import base_job
 from autotest.client.shared import error, utils, packages
 from autotest.client.shared import logging_manager
+from autotest.client.shared.settings import settings
 from autotest.server import test, subcommand, profilers
 from autotest.server.hosts import abstract_ssh
 from autotest.tko import db as tko_db, status_lib, utils as tko_utils
@@ -130,6 +131,8 @@ class base_server_job(base_job.base_job):
 
         warning_manager
         warning_loggers
+
+        max_parallel
     """
 
     _STATUS_VERSION = 1
@@ -188,6 +191,11 @@ class base_server_job(base_job.base_job):
         self.drop_caches = False
         self.drop_caches_between_iterations = False
         self._control_filename = control_filename
+        # the maximum number of machines parallel_simple() runs a function
+        # on at once, all of them if 0; control files may change it
+        self.max_parallel = settings.get_value('AUTOSERV',
+                                               'max_parallel_machines',
+                                               type=int, default=0)
 
         self.logging = logging_manager.get_logging_manager(
                 manage_stdout_and_stderr=True, redirect_fds=True)
@@ -417,7 +425,8 @@ class base_server_job(base_job.base_job):
 
 
     def parallel_simple(self, function, machines, log=True, timeout=None,
-                        return_results=False):
+                        return_results=False, max_parallel=None,
+                        result_callback=None, max_failure_fraction=None):
         """
         Run 'function' using parallel_simple, with an extra wrapper to handle
         the necessary setup for continuous parsing, if possible. If continuous
@@ -432,26 +441,52 @@ class base_server_job(base_job.base_job):
         @param return_results: If True instead of an AutoServError being raised
                 on any error a list of the results|exceptions from the function
                 called on each arg is returned.  [default: False]
+        @param max_parallel: Maximum number of machines function runs on at
+                once, self.max_parallel if None.  [default: None]
+        @param result_callback: Called with every machine and the
+                result|exception of function on it as soon as it finishes.
+                [default: None]
+        @param max_failure_fraction: Once at least this fraction of the
+                machines failed, stop function on the others. None runs it on
+                all of them.  [default: None]
 
         @raises error.AutotestError: If any of the functions failed.
         """
+        if max_parallel is None:
+            max_parallel = self.max_parallel
         wrapper = self._make_parallel_wrapper(function, machines, log)
         return subcommand.parallel_simple(wrapper, machines,
                                           log=log, timeout=timeout,
-                                          return_results=return_results)
+                                          return_results=return_results,
+                                          max_parallel=max_parallel,
+                                          result_callback=result_callback,
+                                          max_failure_fraction=
+                                          max_failure_fraction)
 
 
-    def parallel_on_machines(self, function, machines, timeout=None):
+    def parallel_on_machines(self, function, machines, timeout=None,
+                             max_parallel=None, result_callback=None,
+                             max_failure_fraction=None):
         """
         @param function: Called in parallel with one machine as its argument.
         @param machines: A list of machines to call function(machine) on.
         @param timeout: Seconds after which the function call should timeout.
+        @param max_parallel: Maximum number of machines function runs on at
+                once, self.max_parallel if None.
+        @param result_callback: Called with every machine and the
+                result|exception of function on it as soon as it finishes.
+        @param max_failure_fraction: Once at least this fraction of the
+                machines failed, stop function on the others.
 
         @returns A list of machines on which function(machine) returned
                 without raising an exception.
         """
         results = self.parallel_simple(function, machines, timeout=timeout,
-                                       return_results=True)
+                                       return_results=True,
+                                       max_parallel=max_parallel,
+                                       result_callback=result_callback,
+                                       max_failure_fraction=
+                                       max_failure_fraction)
         success_machines = []
         for result, machine in itertools.izip(results, machines):
             if not isinstance(result, Exception):
@@ -35,7 +35,7 @@ class test_init(base_job_unittest.test_init.generic_tests, unittest.TestCase):
     OPTIONAL_ATTRIBUTES = (
         base_job_unittest.test_init.generic_tests.OPTIONAL_ATTRIBUTES
         - set(['serverdir', 'conmuxdir', 'num_tests_run', 'num_tests_failed',
-               'warning_manager', 'warning_loggers']))
+               'warning_manager', 'warning_loggers', 'max_parallel']))
 
     def setUp(self):
         self.god = mock.mock_god()
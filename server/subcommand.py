@@ -1,6 +1,6 @@
 __author__ = """Copyright Andy Whitcroft, Martin J. Bligh - 2006, 2007"""
 
-import sys, os, time, signal, cPickle, logging
+import sys, os, time, signal, cPickle, logging, select, fcntl, errno
 
 from autotest.client.shared import error, utils
 
@@ -10,38 +10,146 @@ from autotest.client.shared import error, utils
 logging_manager_object = None
 
 
-def parallel(tasklist, timeout=None, return_results=False):
+# seconds between two checks of the subcommands running, at most; a
+# subcommand returning its result wakes the check up right away
+_POLL_INTERVAL = 0.1
+
+
+def _read_result_pipe(task, output):
+    """
+    Read what the subcommand wrote to its result pipe so far into output.
+
+    @returns False once the subcommand closed the pipe, True otherwise.
+    """
+    while True:
+        try:
+            data = os.read(task.result_pickle.fileno(), 65536)
+        except OSError, e:
+            if e.errno == errno.EAGAIN:
+                return True
+            raise
+        if not data:
+            return False
+        output.append(data)
+
+
+def _get_result(task, output):
+    """
+    Unpickle the result of a finished subcommand from what it wrote to its
+    result pipe, or make up an exception if it died without a result.
+    """
+    _read_result_pipe(task, output)
+    task.result_pickle.close()
+    try:
+        return cPickle.loads(''.join(output))
+    except Exception:
+        return error.AutoservSubcommandError(task.func, task.returncode)
+
+
+def parallel(tasklist, timeout=None, return_results=False, max_parallel=None,
+             result_callback=None, max_failure_fraction=None):
     """
     Run a set of predefined subcommands in parallel.
 
+    The subcommands are reaped in the order they finish, with the result
+    pipes of those running polled so that one returning is handled right
+    away.
+
     @param tasklist: A list of subcommand instances to execute.
-    @param timeout: Number of seconds after which the commands should timeout.
+    @param timeout: Number of seconds after which the commands should timeout,
+            counted from the start of each of them.
     @param return_results: If True instead of an AutoServError being raised
             on any error a list of the results|exceptions from the tasks is
             returned.  [default: False]
+    @param max_parallel: Maximum number of subcommands running at once, the
+            others wait for one of them to finish. All of them are run at
+            once if None or 0.  [default: None]
+    @param result_callback: A callable called with every subcommand and its
+            result|exception as soon as it finishes.  [default: None]
+    @param max_failure_fraction: Once at least this fraction of the
+            subcommands failed, kill the ones still running and do not start
+            the others, their results being exceptions. 0 stops on the first
+            failure, None runs them all.  [default: None]
     """
+    if not max_parallel:
+        max_parallel = len(tasklist)
     run_error = False
-    for task in tasklist:
-        task.fork_start()
-
-    remaining_timeout = None
-    if timeout:
-        endtime = time.time() + timeout
-
-    results = []
-    for task in tasklist:
-        if timeout:
-            remaining_timeout = max(endtime - time.time(), 1)
-        try:
-            status = task.fork_waitfor(timeout=remaining_timeout)
-        except error.AutoservSubcommandError:
-            run_error = True
-        else:
+    failures = 0
+    stopped = False
+    results = [None] * len(tasklist)
+    # the index of every subcommand running -> the time it times out at
+    running = {}
+    # the index of every subcommand running -> what it returned so far
+    outputs = {}
+    # the result pipes still open -> the index of their subcommand, watched
+    # with poll() rather than select(), which can't take fds above 1023
+    open_pipes = {}
+    poller = select.poll()
+    next_index = 0
+
+    while running or (next_index < len(tasklist) and not stopped):
+        while (not stopped and next_index < len(tasklist)
+               and len(running) < max_parallel):
+            task = tasklist[next_index]
+            task.fork_start()
+            fd = task.result_pickle.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            running[next_index] = timeout and time.time() + timeout
+            outputs[next_index] = []
+            open_pipes[fd] = next_index
+            poller.register(fd, select.POLLIN)
+            next_index += 1
+
+        # a subcommand closes its result pipe just before exiting
+        for fd, _ in poller.poll(_POLL_INTERVAL * 1000):
+            index = open_pipes[fd]
+            if not _read_result_pipe(tasklist[index], outputs[index]):
+                del open_pipes[fd]
+                poller.unregister(fd)
+
+        for index, end_time in sorted(running.items()):
+            task = tasklist[index]
+            try:
+                status = task.poll()
+                if status is None:
+                    if not end_time or time.time() < end_time:
+                        continue
+                    task.kill_after_timeout(timeout)
+                    status = task.wait()
+            except error.AutoservSubcommandError:
+                status = task.returncode
+            del running[index]
+            fd = task.result_pickle.fileno()
+            if fd in open_pipes:
+                del open_pipes[fd]
+                poller.unregister(fd)
+            results[index] = _get_result(task, outputs.pop(index))
             if status != 0:
                 run_error = True
-
-        results.append(cPickle.load(task.result_pickle))
-        task.result_pickle.close()
+                failures += 1
+            if result_callback:
+                result_callback(task, results[index])
+
+        if (not stopped and max_failure_fraction is not None and failures
+                and failures >= max_failure_fraction * len(tasklist)):
+            stopped = True
+            logging.error('%d of %d subcommands failed, stopping the %d still '
+                          'running', failures, len(tasklist), len(running))
+            # signal them all first, so they do not die one after another
+            for index in running:
+                try:
+                    os.kill(tasklist[index].pid, signal.SIGTERM)
+                except OSError:
+                    pass
+            for index in running:
+                tasklist[index].kill()
+
+    for index in xrange(next_index, len(tasklist)):
+        results[index] = error.AutoservError(
+                'Subcommand %s was not run, too many subcommands failed'
+                % tasklist[index])
+        run_error = True
 
     if return_results:
         return results
@@ -53,7 +161,8 @@ def parallel(tasklist, timeout=None, return_results=False):
 
 
 def parallel_simple(function, arglist, log=True, timeout=None,
-                    return_results=False):
+                    return_results=False, max_parallel=None,
+                    result_callback=None, max_failure_fraction=None):
     """
     Each element in the arglist used to create a subcommand object,
     where that arg is used both as a subdir name, and a single argument
@@ -73,6 +182,14 @@ def parallel_simple(function, arglist, log=True, timeout=None,
     @param return_results: If True instead of an AutoServError being raised
             on any error a list of the results|exceptions from the function
             called on each arg is returned.  [default: False]
+    @param max_parallel: Maximum number of subcommands running at once, all
+            of them if None or 0.  [default: None]
+    @param result_callback: A callable called with every arg and the
+            result|exception of function on it as soon as it finishes.
+            [default: None]
+    @param max_failure_fraction: Once at least this fraction of the calls
+            failed, kill the ones still running and do not start the others.
+            None runs them all.  [default: None]
 
     @returns None or a list of results/exceptions.
     """
@@ -82,15 +199,19 @@ def parallel_simple(function, arglist, log=True, timeout=None,
     # Bypass the multithreading if only one machine.
     if len(arglist) == 1:
         arg = arglist[0]
-        if return_results:
-            try:
-                result = function(arg)
-            except Exception, e:
+        try:
+            result = function(arg)
+        except Exception, e:
+            if result_callback:
+                result_callback(arg, e)
+            if return_results:
                 return [e]
+            raise
+        if result_callback:
+            result_callback(arg, result)
+        if return_results:
             return [result]
-        else:
-            function(arg)
-            return
+        return
 
     subcommands = []
     for arg in arglist:
@@ -100,7 +221,13 @@ def parallel_simple(function, arglist, log=True, timeout=None,
         else:
             subdir = None
         subcommands.append(subcommand(function, args, subdir))
-    return parallel(subcommands, timeout, return_results=return_results)
+    if result_callback:
+        callback = lambda task, result: result_callback(task.args[0], result)
+    else:
+        callback = None
+    return parallel(subcommands, timeout, return_results=return_results,
+                    max_parallel=max_parallel, result_callback=callback,
+                    max_failure_fraction=max_failure_fraction)
 
 
 class subcommand(object):
@@ -255,9 +382,17 @@ class subcommand(object):
                     return returncode
                 time.sleep(1)
 
-            utils.nuke_pid(self.pid)
-            print "subcommand failed pid %d" % self.pid
-            print "%s" % (self.func,)
-            print "timeout after %ds" % timeout
-            print
+            self.kill_after_timeout(timeout)
             return None
+
+
+    def kill(self):
+        utils.nuke_pid(self.pid)
+
+
+    def kill_after_timeout(self, timeout):
+        self.kill()
+        print "subcommand failed pid %d" % self.pid
+        print "%s" % (self.func,)
+        print "timeout after %ds" % timeout
+        print
@@ -1,7 +1,7 @@
 #!/usr/bin/python
 # Copyright 2009 Google Inc. Released under the GPL v2
 
-import unittest
+import os, resource, time, unittest
 
 try:
     import autotest.common as common
@@ -265,100 +265,136 @@ class subcommand_test(unittest.TestCase):
         self.god.check_playback()
 
 
-class parallel_test(unittest.TestCase):
-    def setUp(self):
-        self.god = mock.mock_god()
-        self.god.stub_function(subcommand.cPickle, 'load')
-
-
-    def tearDown(self):
-        self.god.unstub_all()
-
-
-    def _get_cmd(self, func, args):
-        cmd = _create_subcommand(func, args)
-        cmd.result_pickle = self.god.create_mock_class(file, 'file')
-        return self.god.create_mock_class(cmd, 'subcommand')
+def _double(x):
+    return x * 2
 
 
-    def _get_tasklist(self):
-        return [self._get_cmd(lambda x: x * 2, (3,)),
-                self._get_cmd(lambda: None, [])]
+def _sleep_then_double(seconds, x):
+    time.sleep(seconds)
+    return x * 2
 
 
-    def _setup_common(self):
-        tasklist = self._get_tasklist()
+def _fail(message):
+    raise Exception(message)
 
-        for task in tasklist:
-            task.fork_start.expect_call()
 
-        return tasklist
+class parallel_test(unittest.TestCase):
+    """Runs the subcommands in real child processes."""
+    def _get_cmd(self, func, *args):
+        return subcommand.subcommand(func, args)
 
 
     def test_success(self):
-        tasklist = self._setup_common()
-
-        for task in tasklist:
-            task.fork_waitfor.expect_call(timeout=None).and_return(0)
-            (subcommand.cPickle.load.expect_call(task.result_pickle)
-                    .and_return(6))
-            task.result_pickle.close.expect_call()
-
-        subcommand.parallel(tasklist)
-        self.god.check_playback()
+        tasklist = [self._get_cmd(_double, i) for i in xrange(3)]
+        self.assertEquals(subcommand.parallel(tasklist), None)
+        self.assertEquals([task.returncode for task in tasklist], [0, 0, 0])
 
 
     def test_failure(self):
-        tasklist = self._setup_common()
-
-        for task in tasklist:
-            task.fork_waitfor.expect_call(timeout=None).and_return(1)
-            (subcommand.cPickle.load.expect_call(task.result_pickle)
-                    .and_return(6))
-            task.result_pickle.close.expect_call()
-
+        tasklist = [self._get_cmd(_double, 1), self._get_cmd(_fail, 'fail')]
         self.assertRaises(subcommand.error.AutoservError, subcommand.parallel,
                           tasklist)
-        self.god.check_playback()
-
-
-    def test_timeout(self):
-        self.god.stub_function(subcommand.time, 'time')
-
-        tasklist = self._setup_common()
-        timeout = 10
-
-        subcommand.time.time.expect_call().and_return(1)
-
-        for task in tasklist:
-            subcommand.time.time.expect_call().and_return(1)
-            task.fork_waitfor.expect_call(timeout=timeout).and_return(None)
-            (subcommand.cPickle.load.expect_call(task.result_pickle)
-                    .and_return(6))
-            task.result_pickle.close.expect_call()
-
-        self.assertRaises(subcommand.error.AutoservError, subcommand.parallel,
-                          tasklist, timeout=timeout)
-        self.god.check_playback()
 
 
     def test_return_results(self):
-        tasklist = self._setup_common()
+        tasklist = [self._get_cmd(_sleep_then_double, 0.5, 3),
+                    self._get_cmd(_fail, 'fail')]
+        results = subcommand.parallel(tasklist, return_results=True)
+        self.assertEquals(results[0], 6)
+        self.assertEquals(str(results[1]), 'fail')
 
-        tasklist[0].fork_waitfor.expect_call(timeout=None).and_return(0)
-        (subcommand.cPickle.load.expect_call(tasklist[0].result_pickle)
-                .and_return(6))
-        tasklist[0].result_pickle.close.expect_call()
-
-        error = Exception('fail')
-        tasklist[1].fork_waitfor.expect_call(timeout=None).and_return(1)
-        (subcommand.cPickle.load.expect_call(tasklist[1].result_pickle)
-                .and_return(error))
-        tasklist[1].result_pickle.close.expect_call()
 
+    def test_large_result(self):
+        tasklist = [self._get_cmd(_double, 'x' * (1 << 20))]
         self.assertEquals(subcommand.parallel(tasklist, return_results=True),
-                          [6, error])
-        self.god.check_playback()
+                          ['x' * (2 << 20)])
+
+
+    def test_high_fds(self):
+        # select() can't watch fds above 1023, a job on that many machines
+        # has result pipes up there
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard_limit != resource.RLIM_INFINITY and hard_limit < 1100:
+            return
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft_limit, 1100),
+                                                    hard_limit))
+        devnull = os.open(os.devnull, os.O_RDONLY)
+        fillers = []
+        try:
+            while len(fillers) < 1030:
+                fillers.append(os.dup(devnull))
+            tasklist = [self._get_cmd(_double, i) for i in xrange(2)]
+            self.assertEquals(subcommand.parallel(tasklist,
+                                                  return_results=True),
+                              [0, 2])
+        finally:
+            for fd in fillers:
+                os.close(fd)
+            os.close(devnull)
+            resource.setrlimit(resource.RLIMIT_NOFILE,
+                               (soft_limit, hard_limit))
+
+
+    def test_results_in_completion_order(self):
+        tasklist = [self._get_cmd(_sleep_then_double, 1, 1),
+                    self._get_cmd(_sleep_then_double, 0, 2)]
+        finished = []
+        results = subcommand.parallel(
+                tasklist, return_results=True,
+                result_callback=lambda task, result: finished.append(result))
+        self.assertEquals(results, [2, 4])
+        self.assertEquals(finished, [4, 2])
+
+
+    def test_max_parallel(self):
+        tasklist = [self._get_cmd(_sleep_then_double, 0.2, i)
+                    for i in xrange(4)]
+        running = []
+        def callback(task, result):
+            running.append(len([other for other in tasklist
+                                if other.pid and other.returncode is None]))
+        self.assertEquals(subcommand.parallel(tasklist, return_results=True,
+                                              max_parallel=2,
+                                              result_callback=callback),
+                          [0, 2, 4, 6])
+        self.assertEquals(max(running), 1)
+
+
+    def test_timeout(self):
+        tasklist = [self._get_cmd(_sleep_then_double, 60, 1),
+                    self._get_cmd(_double, 2)]
+        start_time = time.time()
+        results = subcommand.parallel(tasklist, timeout=1,
+                                      return_results=True)
+        self.assertTrue(time.time() - start_time < 30)
+        self.assertTrue(isinstance(results[0],
+                                   subcommand.error.AutoservSubcommandError))
+        self.assertEquals(results[1], 4)
+        self.assertTrue(tasklist[0].returncode < 0)
+
+
+    def test_max_failure_fraction(self):
+        tasklist = [self._get_cmd(_fail, 'fail'),
+                    self._get_cmd(_sleep_then_double, 60, 1),
+                    self._get_cmd(_double, 2)]
+        start_time = time.time()
+        results = subcommand.parallel(tasklist, return_results=True,
+                                      max_parallel=2, max_failure_fraction=0.3)
+        self.assertTrue(time.time() - start_time < 30)
+        self.assertEquals(str(results[0]), 'fail')
+        self.assertTrue(isinstance(results[1],
+                                   subcommand.error.AutoservSubcommandError))
+        self.assertTrue(isinstance(results[2], subcommand.error.AutoservError))
+        self.assertEquals(tasklist[2].pid, None)
+
+
+    def test_failures_under_max_fraction(self):
+        tasklist = [self._get_cmd(_fail, 'fail'),
+                    self._get_cmd(_sleep_then_double, 0.5, 1),
+                    self._get_cmd(_double, 2)]
+        results = subcommand.parallel(tasklist, return_results=True,
+                                      max_parallel=2, max_failure_fraction=0.5)
+        self.assertEquals(results[1:], [2, 4])
 
 
 class test_parallel_simple(unittest.TestCase):
@@ -424,7 +460,10 @@ class test_parallel_simple(unittest.TestCase):
             (subcommand.subcommand.expect_call(func, [arg], subdir)
                     .and_return(cmd))
 
-        subcommand.parallel.expect_call(cmds, None, return_results=False)
+        subcommand.parallel.expect_call(cmds, None, return_results=False,
+                                        max_parallel=None,
+                                        result_callback=None,
+                                        max_failure_fraction=None)
         return func, args
 
 
@@ -5,19 +5,106 @@ try:
 except ImportError:
     import common
 from autotest.client.shared.settings import settings
-from autotest.tko import utils
+from autotest.tko import packed_iterations, utils
+
+
+# maximum number of rows written by a single multi-row insert statement, to
+# stay well below the server's maximum packet size
+_INSERT_BATCH_SIZE = 500
+
+# maximum number of machines and of kernels remembered by a db_sql instance
+_LOOKUP_CACHE_SIZE = 10000
+
+# the kinds of row writes counted in db_sql.row_counts
+ROW_COUNT_KEYS = ('unchanged', 'updated', 'inserted', 'deleted')
+
+# the fields of a tko_tests row written by the parser
+_TEST_FIELDS = ('job_idx', 'test', 'subdir', 'kernel_idx', 'status', 'reason',
+                'machine_idx', 'started_time', 'finished_time')
+
+# the tables holding rows of a test that are written again when it is
+# reparsed, with the fields identifying a row of the test and the field
+# holding its value
+_TEST_CHILD_TABLES = (
+        ('tko_iteration_attributes', ('iteration', 'attribute'), 'value'),
+        ('tko_iteration_result', ('iteration', 'attribute'), 'value'),
+        ('tko_packed_iterations', (), 'data'),
+        ('tko_test_attributes', ('attribute',), 'value'))
+
+
+def _same_value(stored, new):
+    # the parser leaves out empty strings the database then stores as ''
+    if stored is None or new is None:
+        return stored in (None, '') and new in (None, '')
+    return stored == new
 
 
 class MySQLTooManyRows(Exception):
     pass
 
 
+class _LookupCache(object):
+    """
+    A dictionary holding at most max_size entries.  When it grows past that,
+    the least recently used tenth of them is dropped at once, so the cost of
+    an eviction is spread over many insertions.
+    """
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._values = {}
+        self._last_used = {}
+        self._clock = 0
+
+
+    def __len__(self):
+        return len(self._values)
+
+
+    def _touch(self, key):
+        self._clock += 1
+        self._last_used[key] = self._clock
+
+
+    def get(self, key, default=None):
+        if key not in self._values:
+            return default
+        self._touch(key)
+        return self._values[key]
+
+
+    def set(self, key, value):
+        self._values[key] = value
+        self._touch(key)
+        if len(self._values) > self._max_size:
+            by_age = sorted(self._last_used, key=self._last_used.get)
+            for old_key in by_age[:len(by_age) - self._max_size * 9 / 10]:
+                del self._values[old_key]
+                del self._last_used[old_key]
+
+
+    def clear(self):
+        self._values.clear()
+        self._last_used.clear()
+
+
 class db_sql(object):
     def __init__(self, debug=False, autocommit=True, host=None,
-                 database=None, user=None, password=None):
+                 database=None, user=None, password=None,
+                 lookup_cache_size=_LOOKUP_CACHE_SIZE, pack_iterations=None):
         self.debug = debug
         self.autocommit = autocommit
         self._load_config(host, database, user, password)
+        if pack_iterations is not None:
+            self.pack_iterations = pack_iterations
+
+        # hostname -> (machine_idx, machine info dict last seen or None) and
+        # kernel_hash -> kernel_idx, for the rows read or written through this
+        # instance, so that every job does not look them up again
+        self._machine_cache = _LookupCache(lookup_cache_size)
+        self._kernel_cache = _LookupCache(lookup_cache_size)
+
+        # number of test rows written, or found up to date, by ROW_COUNT_KEYS
+        self.row_counts = dict.fromkeys(ROW_COUNT_KEYS, 0)
 
         self.con = None
         self._init_db()
@@ -68,12 +155,20 @@ class db_sql(object):
         self.max_delay = settings.get_value("AUTOTEST_WEB", "max_retry_delay", type=int,
                                    default=60)
 
+        # store test iterations in tko_packed_iterations
+        self.pack_iterations = settings.get_value(
+                "AUTOTEST_WEB", "tko_pack_iterations", type=bool,
+                default=False)
+
 
     def _init_db(self):
         # make sure we clean up any existing connection
         if self.con:
             self.con.close()
             self.con = None
+        # rows inserted by the transaction in progress are lost
+        self._machine_cache.clear()
+        self._kernel_cache.clear()
 
         # create the db connection and cursor
         self.con = self.connect(self.host, self.database,
@@ -244,17 +339,36 @@ class db_sql(object):
 
 
     def _exec_sql_with_commit(self, sql, values, commit):
+        """
+        @returns The number of rows affected by the statement.
+        """
         if self.autocommit:
             # re-run the query until it succeeds
             def exec_sql():
                 self.cur.execute(sql, values)
                 self.con.commit()
-            self.run_with_retry(exec_sql)
+                return self.cur.rowcount
+            return self.run_with_retry(exec_sql)
         else:
             # take one shot at running the query
             self.cur.execute(sql, values)
             if commit:
                 self.con.commit()
+            return self.cur.rowcount
+
+
+    def _executemany_with_commit(self, sql, values_list, commit):
+        if self.autocommit:
+            # re-run the query until it succeeds
+            def exec_sql():
+                self.cur.executemany(sql, values_list)
+                self.con.commit()
+            self.run_with_retry(exec_sql)
+        else:
+            # take one shot at running the query
+            self.cur.executemany(sql, values_list)
+            if commit:
+                self.con.commit()
 
 
     def insert(self, table, data, commit=None):
@@ -276,6 +390,42 @@ class db_sql(object):
         self._exec_sql_with_commit(cmd, values, commit)
 
 
+    def insert_many(self, table, rows, commit=None):
+        """\
+                'insert into table (keys) values (%s ... %s), (%s ... %s)',
+                values
+
+                rows:
+                        list of dictionaries of fields and data
+
+                Like insert(), fields with None data are left out, so
+                the rows are grouped by the fields they set and each group
+                is written with as few statements as possible.
+        """
+        groups = {}
+        group_order = []
+        for data in rows:
+            fields = tuple(field for field in sorted(data)
+                           if data[field] is not None)
+            if fields not in groups:
+                groups[fields] = []
+                group_order.append(fields)
+            groups[fields].append(data)
+
+        for fields in group_order:
+            group_rows = groups[fields]
+            row_refs = '(%s)' % ','.join(['%s'] * len(fields))
+            for start in xrange(0, len(group_rows), _INSERT_BATCH_SIZE):
+                batch = group_rows[start:start + _INSERT_BATCH_SIZE]
+                values = [data[field] for data in batch for field in fields]
+                cmd = ('insert into %s (%s) values %s' %
+                       (table, ','.join(self._quote(field) for field in fields),
+                        ','.join([row_refs] * len(batch))))
+                self.dprint('%s %s' % (cmd, values))
+
+                self._exec_sql_with_commit(cmd, values, commit)
+
+
     def delete(self, table, where, commit = None):
         cmd = ['delete from', table]
         if commit is None:
@@ -285,7 +435,7 @@ class db_sql(object):
         sql = ' '.join(cmd)
         self.dprint('%s %s' % (sql, values))
 
-        self._exec_sql_with_commit(sql, values, commit)
+        return self._exec_sql_with_commit(sql, values, commit)
 
 
     def update(self, table, data, where, commit = None):
@@ -312,18 +462,45 @@ class db_sql(object):
         self._exec_sql_with_commit(cmd, values, commit)
 
 
+    def _test_idx_batches(self, test_idxs, field='test_idx'):
+        """
+        Split test_idxs in batches of at most _INSERT_BATCH_SIZE.
+
+        @returns A list of (where clause, values) tuples for select() and
+                delete(), one per batch.
+        """
+        test_idxs = sorted(test_idxs)
+        batches = []
+        for start in xrange(0, len(test_idxs), _INSERT_BATCH_SIZE):
+            batch = test_idxs[start:start + _INSERT_BATCH_SIZE]
+            batches.append(('%s IN (%s)' % (self._quote(field),
+                                            ','.join(['%s'] * len(batch))),
+                            batch))
+        return batches
+
+
+    def delete_tests(self, test_idxs, commit=None):
+        """
+        Delete tests and all of their rows, a batch of tests per statement.
+        """
+        for table, _, _ in _TEST_CHILD_TABLES:
+            for where in self._test_idx_batches(test_idxs):
+                self.row_counts['deleted'] += self.delete(table, where,
+                                                          commit=commit)
+        for where in self._test_idx_batches(test_idxs, 'test_id'):
+            self.row_counts['deleted'] += self.delete(
+                    'tko_test_labels_tests', where, commit=commit)
+        for where in self._test_idx_batches(test_idxs):
+            self.row_counts['deleted'] += self.delete('tko_tests', where,
+                                                      commit=commit)
+
+
     def delete_afe_job(self, tag, commit = None):
         job_idx = self.find_job(tag)
         afe_job_idx = self.find_afe_job(tag)
-        for test_idx in self.find_tests(job_idx):
-            where = {'test_idx' : test_idx}
-            self.delete('tko_iteration_result', where)
-            self.delete('tko_iteration_attributes', where)
-            self.delete('tko_test_attributes', where)
-            self.delete('tko_test_labels_tests', {'test_id': test_idx})
+        self.delete_tests(self.find_tests(job_idx), commit=commit)
         where = {'job_idx' : job_idx}
         self.delete('tko_job_keyvals', {'job_id' : job_idx})
-        self.delete('tko_tests', where)
         self.delete('tko_jobs', where)
         self.delete('afe_aborted_host_queue_entries', {'queue_entry_id' : afe_job_idx})
         self.delete('afe_special_tasks', {'queue_entry_id' : afe_job_idx})
@@ -333,15 +510,9 @@ class db_sql(object):
 
     def delete_job(self, tag, commit = None):
         job_idx = self.find_job(tag)
-        for test_idx in self.find_tests(job_idx):
-            where = {'test_idx' : test_idx}
-            self.delete('tko_iteration_result', where)
-            self.delete('tko_iteration_attributes', where)
-            self.delete('tko_test_attributes', where)
-            self.delete('tko_test_labels_tests', {'test_id': test_idx})
+        self.delete_tests(self.find_tests(job_idx), commit=commit)
         where = {'job_idx' : job_idx}
         self.delete('tko_job_keyvals', {'job_id' : job_idx})
-        self.delete('tko_tests', where)
         self.delete('tko_jobs', where)
 
 
@@ -349,7 +520,8 @@ class db_sql(object):
         job.machine_idx = self.lookup_machine(job.machine)
         if not job.machine_idx:
             job.machine_idx = self.insert_machine(job, commit=commit)
-        else:
+        elif (self._machine_cache.get(job.machine)[1] !=
+              self.machine_info_dict(job)):
             self.update_machine_information(job, commit=commit)
 
         afe_job_id = utils.get_afe_job_id(tag)
@@ -369,67 +541,220 @@ class db_sql(object):
             self.insert('tko_jobs', data, commit=commit)
             job.index = self.get_last_autonumber_value()
         self.update_job_keyvals(job, commit=commit)
+
+        # the rows of all the new tests are written together, one table at a
+        # time, and those of the tests parsed before are compared with what
+        # is stored to only write the ones that changed
+        test_rows = {}
+        parsed_tests = []
         for test in job.tests:
-            self.insert_test(job, test, commit=commit)
+            if hasattr(test, 'test_idx'):
+                parsed_tests.append(test)
+            else:
+                self._insert_test_row(job, test, test_rows, commit=commit)
+        self._insert_test_rows(test_rows, commit=commit)
+        self._update_tests(job, parsed_tests, commit=commit)
 
 
     def update_job_keyvals(self, job, commit=None):
-        for key, value in job.keyval_dict.iteritems():
-            where = {'job_id': job.index, 'key': key}
-            data = dict(where, value=value)
-            exists = self.select('id', 'tko_job_keyvals', where=where)
+        if not job.keyval_dict:
+            return
+        rows = self.select('`key`', 'tko_job_keyvals', {'job_id': job.index})
+        existing_keys = set(row[0] for row in rows)
 
-            if exists:
-                self.update('tko_job_keyvals', data, where=where, commit=commit)
+        updated_values, new_rows = [], []
+        for key, value in job.keyval_dict.iteritems():
+            if key in existing_keys:
+                updated_values.append([value, job.index, key])
             else:
-                self.insert('tko_job_keyvals', data, commit=commit)
+                new_rows.append({'job_id': job.index, 'key': key,
+                                 'value': value})
+
+        if updated_values:
+            cmd = ('update tko_job_keyvals set `value`=%s '
+                   'WHERE `job_id`=%s and `key`=%s')
+            self.dprint('%s %s' % (cmd, updated_values))
+            self._executemany_with_commit(cmd, updated_values, commit)
+        self.insert_many('tko_job_keyvals', new_rows, commit=commit)
 
 
     def insert_test(self, job, test, commit = None):
+        if hasattr(test, 'test_idx'):
+            self._update_tests(job, [test], commit=commit)
+        else:
+            test_rows = {}
+            self._insert_test_row(job, test, test_rows, commit=commit)
+            self._insert_test_rows(test_rows, commit=commit)
+
+
+    def _test_data(self, job, test, commit=None):
         kver = self.insert_kernel(test.kernel, commit=commit)
-        data = {'job_idx':job.index, 'test':test.testname,
+        return {'job_idx':job.index, 'test':test.testname,
                 'subdir':test.subdir, 'kernel_idx':kver,
                 'status':self.status_idx[test.status],
                 'reason':test.reason, 'machine_idx':job.machine_idx,
                 'started_time': test.started_time,
                 'finished_time':test.finished_time}
-        is_update = hasattr(test, "test_idx")
-        if is_update:
-            test_idx = test.test_idx
-            self.update('tko_tests', data,
-                        {'test_idx': test_idx}, commit=commit)
-            where = {'test_idx': test_idx}
-            self.delete('tko_iteration_result', where)
-            self.delete('tko_iteration_attributes', where)
-            where['user_created'] = 0
-            self.delete('tko_test_attributes', where)
+
+
+    def _insert_test_row(self, job, test, test_rows, commit=None):
+        """
+        Insert the tko_tests row of a new test, and add the rows of its
+        iterations, attributes and labels to test_rows, a dictionary of
+        lists of rows keyed by table, for _insert_test_rows().
+        """
+        self.insert('tko_tests', self._test_data(job, test, commit=commit),
+                    commit=commit)
+        self.row_counts['inserted'] += 1
+        test.test_idx = self.get_last_autonumber_value()
+        self._add_test_child_rows(test, test_rows)
+        for label_index in test.labels:
+            test_rows.setdefault('tko_test_labels_tests', []).append(
+                    {'test_id': test.test_idx, 'testlabel_id': label_index})
+
+
+    def _add_test_child_rows(self, test, test_rows):
+        """
+        Add the rows of the iterations and attributes of a test to
+        test_rows.
+        """
+        def add_row(table, data):
+            test_rows.setdefault(table, []).append(data)
+
+        test_idx = test.test_idx
+        if self.pack_iterations and test.iterations:
+            add_row('tko_packed_iterations',
+                    {'test_idx': test_idx,
+                     'data': packed_iterations.pack(test.iterations)})
+            iterations = []
         else:
-            self.insert('tko_tests', data, commit=commit)
-            test_idx = test.test_idx = self.get_last_autonumber_value()
-        data = {'test_idx': test_idx}
+            iterations = test.iterations
 
-        for i in test.iterations:
-            data['iteration'] = i.index
+        for i in iterations:
             for key, value in i.attr_keyval.iteritems():
-                data['attribute'] = key
-                data['value'] = value
-                self.insert('tko_iteration_attributes', data,
-                            commit=commit)
+                add_row('tko_iteration_attributes',
+                        {'test_idx': test_idx, 'iteration': i.index,
+                         'attribute': key, 'value': value})
             for key, value in i.perf_keyval.iteritems():
-                data['attribute'] = key
-                data['value'] = value
-                self.insert('tko_iteration_result', data,
-                            commit=commit)
+                add_row('tko_iteration_result',
+                        {'test_idx': test_idx, 'iteration': i.index,
+                         'attribute': key, 'value': value})
 
         for key, value in test.attributes.iteritems():
-            data = {'test_idx': test_idx, 'attribute': key,
-                    'value': value}
-            self.insert('tko_test_attributes', data, commit=commit)
+            add_row('tko_test_attributes',
+                    {'test_idx': test_idx, 'attribute': key, 'value': value})
 
-        if not is_update:
-            for label_index in test.labels:
-                data = {'test_id': test_idx, 'testlabel_id': label_index}
-                self.insert('tko_test_labels_tests', data, commit=commit)
+
+    def _insert_test_rows(self, test_rows, commit=None):
+        for table in ('tko_iteration_attributes', 'tko_iteration_result',
+                      'tko_packed_iterations', 'tko_test_attributes',
+                      'tko_test_labels_tests'):
+            if table in test_rows:
+                self.insert_many(table, test_rows[table], commit=commit)
+                self.row_counts['inserted'] += len(test_rows[table])
+
+
+    def _update_tests(self, job, tests, commit=None):
+        """
+        Write the tests parsed again, which already have a test_idx, by
+        comparing their rows with the stored ones and only writing the
+        rows that changed, each kind of write batched over all the tests.
+        The labels and user created attributes of the tests are kept.
+        """
+        if not tests:
+            return
+        test_idxs = [test.test_idx for test in tests]
+
+        tests_data = dict((test.test_idx,
+                           self._test_data(job, test, commit=commit))
+                          for test in tests)
+        stored_tests = {}
+        fields = ','.join(self._quote(field) for field in _TEST_FIELDS)
+        for where in self._test_idx_batches(test_idxs):
+            for row in self.select('test_idx,' + fields, 'tko_tests', where):
+                stored_tests[row[0]] = row[1:]
+        updated_values = []
+        for test_idx in test_idxs:
+            data = tests_data[test_idx]
+            new_row = [data[field] for field in _TEST_FIELDS]
+            stored_row = stored_tests.get(test_idx)
+            if stored_row and all(_same_value(stored, new) for stored, new
+                                  in zip(stored_row, new_row)):
+                self.row_counts['unchanged'] += 1
+            else:
+                updated_values.append(new_row + [test_idx])
+        if updated_values:
+            cmd = ('update tko_tests set %s WHERE `test_idx`=%%s' %
+                   ', '.join(self._quote(field) + '=%s'
+                             for field in _TEST_FIELDS))
+            self.dprint('%s %s' % (cmd, updated_values))
+            self._executemany_with_commit(cmd, updated_values, commit)
+            self.row_counts['updated'] += len(updated_values)
+
+        test_rows = {}
+        for test in tests:
+            self._add_test_child_rows(test, test_rows)
+        for table, key_fields, value_field in _TEST_CHILD_TABLES:
+            self._update_test_child_rows(table, key_fields, value_field,
+                                         test_idxs, test_rows.get(table, []),
+                                         commit=commit)
+
+
+    def _update_test_child_rows(self, table, key_fields, value_field,
+                                test_idxs, rows, commit=None):
+        """
+        Make the rows of table belonging to the tests test_idxs match rows,
+        writing only the differences.
+        """
+        key_fields = ('test_idx',) + key_fields
+        if table == 'tko_test_attributes':
+            # the attributes added by users are not parsed
+            extra_condition = ' and `user_created`=0'
+        else:
+            extra_condition = ''
+
+        # key -> list of values, several values meaning duplicated rows
+        stored = {}
+        fields = ','.join(self._quote(field)
+                          for field in key_fields + (value_field,))
+        for where_clause, values in self._test_idx_batches(test_idxs):
+            for row in self.select(fields, table,
+                                   (where_clause + extra_condition, values)):
+                stored.setdefault(tuple(row[:-1]), []).append(row[-1])
+
+        deleted_keys, updated_values, new_rows = [], [], []
+        for data in rows:
+            key = tuple(data[field] for field in key_fields)
+            stored_values = stored.pop(key, None)
+            if stored_values is None:
+                new_rows.append(data)
+            elif len(stored_values) > 1:
+                deleted_keys.append(key)
+                self.row_counts['deleted'] += len(stored_values)
+                new_rows.append(data)
+            elif _same_value(stored_values[0], data[value_field]):
+                self.row_counts['unchanged'] += 1
+            else:
+                updated_values.append([data[value_field]] + list(key))
+        for key, stored_values in stored.iteritems():
+            deleted_keys.append(key)
+            self.row_counts['deleted'] += len(stored_values)
+
+        key_condition = ' and '.join(self._quote(field) + '=%s'
+                                     for field in key_fields)
+        key_condition += extra_condition
+        if deleted_keys:
+            cmd = 'delete from %s WHERE %s' % (table, key_condition)
+            self.dprint('%s %s' % (cmd, deleted_keys))
+            self._executemany_with_commit(cmd, deleted_keys, commit)
+        if updated_values:
+            cmd = 'update %s set %s=%%s WHERE %s' % (
+                    table, self._quote(value_field), key_condition)
+            self.dprint('%s %s' % (cmd, updated_values))
+            self._executemany_with_commit(cmd, updated_values, commit)
+            self.row_counts['updated'] += len(updated_values)
+        self.insert_many(table, new_rows, commit=commit)
+        self.row_counts['inserted'] += len(new_rows)
 
 
     def read_machine_map(self):
@@ -457,7 +782,10 @@ class db_sql(object):
     def insert_machine(self, job, commit = None):
         machine_info = self.machine_info_dict(job)
         self.insert('tko_machines', machine_info, commit=commit)
-        return self.get_last_autonumber_value()
+        machine_idx = self.get_last_autonumber_value()
+        self._machine_cache.set(machine_info['hostname'],
+                                (machine_idx, machine_info))
+        return machine_idx
 
 
     def update_machine_information(self, job, commit = None):
@@ -465,21 +793,38 @@ class db_sql(object):
         self.update('tko_machines', machine_info,
                     where={'hostname': machine_info['hostname']},
                     commit=commit)
+        cached = self._machine_cache.get(machine_info['hostname'])
+        if cached:
+            self._machine_cache.set(machine_info['hostname'],
+                                    (cached[0], machine_info))
 
 
     def lookup_machine(self, hostname):
+        cached = self._machine_cache.get(hostname)
+        if cached:
+            return cached[0]
         where = { 'hostname' : hostname }
-        rows = self.select('machine_idx', 'tko_machines', where)
+        rows = self.select('machine_idx, machine_group, owner', 'tko_machines',
+                           where)
         if rows:
-            return rows[0][0]
+            machine_idx, group, owner = rows[0]
+            self._machine_cache.set(hostname, (machine_idx,
+                                               {'hostname': hostname,
+                                                'machine_group': group,
+                                                'owner': owner}))
+            return machine_idx
         else:
             return None
 
 
     def lookup_kernel(self, kernel):
+        kernel_idx = self._kernel_cache.get(kernel.kernel_hash)
+        if kernel_idx:
+            return kernel_idx
         rows = self.select('kernel_idx', 'tko_kernels',
                                 {'kernel_hash':kernel.kernel_hash})
         if rows:
+            self._kernel_cache.set(kernel.kernel_hash, rows[0][0])
             return rows[0][0]
         else:
             return None
@@ -506,6 +851,7 @@ class db_sql(object):
                      'printable':printable},
                     commit=commit)
         kver = self.get_last_autonumber_value()
+        self._kernel_cache.set(kernel.kernel_hash, kver)
 
         if patch_count > 0:
             printable += ' p%d' % (kver)
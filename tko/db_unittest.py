@@ -0,0 +1,329 @@
+#!/usr/bin/python
+
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.test_utils import unittest
+from autotest.tko import db
+
+
+class _FakeCursor(object):
+    def __init__(self):
+        self.statements = []
+        self.select_results = []
+        self.rowcount = 0
+        self._last_autonumber = 0
+
+
+    def execute(self, sql, values):
+        self.statements.append((sql, list(values)))
+        self.rowcount = 2
+        if sql.startswith('SELECT LAST_INSERT_ID'):
+            self._last_autonumber += 1
+
+
+    def executemany(self, sql, values_list):
+        self.statements.append((sql, [list(values) for values in values_list]))
+
+
+    def fetchall(self):
+        if self.statements[-1][0].startswith('SELECT LAST_INSERT_ID'):
+            return [(self._last_autonumber,)]
+        if self.select_results:
+            return self.select_results.pop(0)
+        return []
+
+
+class _FakeConnection(object):
+    def __init__(self):
+        self.cursor_instance = _FakeCursor()
+
+
+    def cursor(self):
+        return self.cursor_instance
+
+
+    def commit(self):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class _FakeDb(db.db_sql):
+    def connect(self, host, database, user, password):
+        return _FakeConnection()
+
+
+class _Object(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class InsertTest(unittest.TestCase):
+    def setUp(self):
+        self.db = _FakeDb(autocommit=False, host='host', database='tko',
+                          user='user', password='password')
+        self.db.status_idx = {'GOOD': 6}
+        self.cursor = self.db.cur
+        del self.cursor.statements[:]
+
+
+    def test_insert_many(self):
+        self.db.insert_many('tko_test_attributes',
+                            [{'test_idx': 1, 'attribute': 'a', 'value': 'x'},
+                             {'test_idx': 1, 'attribute': 'b', 'value': None},
+                             {'test_idx': 2, 'attribute': 'c', 'value': 'y'}])
+        self.assertEquals(self.cursor.statements, [
+                ('insert into tko_test_attributes (`attribute`,`test_idx`,'
+                 '`value`) values (%s,%s,%s),(%s,%s,%s)',
+                 ['a', 1, 'x', 'c', 2, 'y']),
+                ('insert into tko_test_attributes (`attribute`,`test_idx`) '
+                 'values (%s,%s)', ['b', 1])])
+
+
+    def test_insert_many_batches(self):
+        rows = [{'test_idx': index} for index in xrange(1200)]
+        self.db.insert_many('tko_tests', rows)
+        self.assertEquals([len(values) for _, values
+                           in self.cursor.statements], [500, 500, 200])
+
+
+    def test_insert_many_no_rows(self):
+        self.db.insert_many('tko_tests', [])
+        self.assertEquals(self.cursor.statements, [])
+
+
+    def test_update_job_keyvals(self):
+        job = _Object(index=7, keyval_dict={'old': '1', 'new': '2'})
+        self.cursor.select_results.append([('old',)])
+        self.db.update_job_keyvals(job)
+        statements = self.cursor.statements
+        self.assertEquals(len(statements), 3)
+        self.assert_(statements[1][0].startswith('update tko_job_keyvals'))
+        self.assertEquals(statements[1][1], [['1', 7, 'old']])
+        self.assertEquals(statements[2][1], [7, 'new', '2'])
+
+
+    def test_insert_job_batches_test_rows(self):
+        kernel = _Object(kernel_hash='hash', base='2.6', patches=[])
+        tests = []
+        for index in xrange(3):
+            iteration = _Object(index=1, attr_keyval={'a': 'b'},
+                                perf_keyval={'p1': 1.0, 'p2': 2.0})
+            tests.append(_Object(kernel=kernel, testname='test%d' % index,
+                                 subdir='test%d' % index, status='GOOD',
+                                 reason='', started_time=None,
+                                 finished_time=None, iterations=[iteration],
+                                 attributes={'attr': 'value'}, labels=[1]))
+        # the machine and the kernel exist already
+        self.cursor.select_results = [[(1, 'group', None)], [(1,)]]
+        job = _Object(machine='host1', machine_group='group',
+                      machine_owner=None, label='label', user='user',
+                      queued_time=None, started_time=None, finished_time=None,
+                      keyval_dict={}, tests=tests)
+        self.db.insert_job('1-user/host1', job)
+
+        inserts = [sql.split(' (')[0] for sql, _ in self.cursor.statements
+                   if sql.startswith('insert')]
+        self.assertEquals(inserts, ['insert into tko_jobs'] +
+                          ['insert into tko_tests'] * 3 +
+                          ['insert into tko_iteration_attributes',
+                           'insert into tko_iteration_result',
+                           'insert into tko_test_attributes',
+                           'insert into tko_test_labels_tests'])
+        result_values = [values for sql, values in self.cursor.statements
+                         if sql.startswith('insert into tko_iteration_result')]
+        self.assertEquals(len(result_values[0]), 3 * 2 * 4)
+
+
+    def test_insert_job_packs_iterations(self):
+        self.db.pack_iterations = True
+        kernel = _Object(kernel_hash='hash', base='2.6', patches=[])
+        iteration = _Object(index=1, attr_keyval={'a': 'b'},
+                            perf_keyval={'p1': 1.0})
+        test = _Object(kernel=kernel, testname='test', subdir='test',
+                       status='GOOD', reason='', started_time=None,
+                       finished_time=None, iterations=[iteration],
+                       attributes={}, labels=[])
+        self.cursor.select_results = [[(1, 'group', None)], [(1,)]]
+        job = _Object(machine='host1', machine_group='group',
+                      machine_owner=None, label='label', user='user',
+                      queued_time=None, started_time=None, finished_time=None,
+                      keyval_dict={}, tests=[test])
+        self.db.insert_job('1-user/host1', job)
+
+        inserts = [sql.split(' (')[0] for sql, _ in self.cursor.statements
+                   if sql.startswith('insert')]
+        self.assertEquals(inserts, ['insert into tko_jobs',
+                                    'insert into tko_tests',
+                                    'insert into tko_packed_iterations'])
+
+
+class ReparseTest(unittest.TestCase):
+    def setUp(self):
+        self.db = _FakeDb(autocommit=False, host='host', database='tko',
+                          user='user', password='password')
+        self.db.status_idx = {'GOOD': 6}
+        self.cursor = self.db.cur
+        del self.cursor.statements[:]
+        kernel = _Object(kernel_hash='hash', base='2.6', patches=[])
+        iteration = _Object(index=1, attr_keyval={'same': 'x', 'changed': 'y'},
+                            perf_keyval={'new': 1.0})
+        self.test = _Object(kernel=kernel, testname='test', subdir='test',
+                            status='GOOD', reason='', started_time=None,
+                            finished_time=None, iterations=[iteration],
+                            attributes={'attr': 'value'}, labels=[1],
+                            test_idx=5)
+        self.job = _Object(machine='host1', machine_group='group',
+                           machine_owner=None, label='label', user='user',
+                           queued_time=None, started_time=None,
+                           finished_time=None, keyval_dict={},
+                           tests=[self.test], index=3)
+
+
+    def _statements(self, prefix):
+        return [(sql, values) for sql, values in self.cursor.statements
+                if sql.startswith(prefix)]
+
+
+    def test_only_changed_rows_are_written(self):
+        self.cursor.select_results = [
+                # machine, kernel
+                [(1, 'group', None)], [(1,)],
+                # tko_tests, stored with a NULL reason
+                [(5, 3, 'test', 'test', 1, 6, None, 1, None, None)],
+                # tko_iteration_attributes
+                [(5, 1, 'same', 'x'), (5, 1, 'changed', 'old')],
+                # tko_iteration_result
+                [(5, 1, 'gone', 2.0)],
+                # tko_packed_iterations
+                [],
+                # tko_test_attributes, with duplicated rows
+                [(5, 'attr', 'value'), (5, 'attr', 'value')]]
+        self.db.insert_job('3-user/host1', self.job)
+
+        self.assertEquals(self._statements('update tko_tests'), [])
+        self.assertEquals(
+                [values for _, values
+                 in self._statements('update tko_iteration_attributes')],
+                [[['y', 5, 1, 'changed']]])
+        self.assertEquals(
+                [values for _, values
+                 in self._statements('delete from tko_iteration_result')],
+                [[[5, 1, 'gone']]])
+        self.assertEquals(
+                [values for _, values
+                 in self._statements('insert into tko_iteration_result')],
+                [['new', 1, 5, 1.0]])
+        self.assertEquals(
+                [values for _, values
+                 in self._statements('delete from tko_test_attributes')],
+                [[[5, 'attr']]])
+        self.assertEquals(len(self._statements('insert into '
+                                               'tko_test_attributes')), 1)
+        self.assertEquals(self._statements('insert into tko_test_labels'), [])
+        self.assertEquals(self.db.row_counts, {'unchanged': 2, 'updated': 1,
+                                               'inserted': 2, 'deleted': 3})
+
+
+    def test_changed_test_row_is_updated(self):
+        self.cursor.select_results = [
+                [(1, 'group', None)], [(1,)],
+                [(5, 3, 'test', 'test', 1, 6, 'old reason', 1, None, None)]]
+        self.db.insert_job('3-user/host1', self.job)
+        (sql, values), = self._statements('update tko_tests')
+        self.assertEquals(values, [[3, 'test', 'test', 1, 6, '', 1, None,
+                                    None, 5]])
+
+
+    def test_delete_tests(self):
+        self.db.delete_tests(xrange(600))
+        deletes = self._statements('delete from')
+        self.assertEquals(len(deletes), 6 * 2)
+        self.assertEquals([len(values) for _, values in deletes[:2]],
+                          [500, 100])
+        self.assert_(deletes[-1][0].startswith('delete from tko_tests'))
+        self.assertEquals(self.db.row_counts['deleted'], 6 * 2 * 2)
+
+
+    def test_delete_job(self):
+        self.cursor.select_results = [[(3,)], [(5,), (6,)]]
+        self.db.delete_job('3-user/host1')
+        deletes = self._statements('delete from')
+        self.assertEquals(
+                [sql.split()[2] for sql, _ in deletes],
+                ['tko_iteration_attributes', 'tko_iteration_result',
+                 'tko_packed_iterations', 'tko_test_attributes',
+                 'tko_test_labels_tests', 'tko_tests', 'tko_job_keyvals',
+                 'tko_jobs'])
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.db = _FakeDb(autocommit=False, host='host', database='tko',
+                          user='user', password='password')
+        self.cursor = self.db.cur
+        del self.cursor.statements[:]
+        self.job = _Object(machine='host1', machine_group='group',
+                           machine_owner=None, label='label', user='user',
+                           queued_time=None, started_time=None,
+                           finished_time=None, keyval_dict={}, tests=[])
+
+
+    def _count_statements(self, prefix):
+        return len([sql for sql, _ in self.cursor.statements
+                    if sql.startswith(prefix)])
+
+
+    def test_machine_is_looked_up_once(self):
+        self.cursor.select_results = [[(3, 'group', None)]]
+        self.db.insert_job('1-user/host1', self.job)
+        self.db.insert_job('2-user/host1', self.job)
+        self.assertEquals(self._count_statements('select'), 1)
+        self.assertEquals(self._count_statements('update tko_machines'), 0)
+        self.assertEquals(self.job.machine_idx, 3)
+
+
+    def test_changed_machine_is_updated(self):
+        self.cursor.select_results = [[(3, 'other_group', None)]]
+        self.db.insert_job('1-user/host1', self.job)
+        self.db.insert_job('2-user/host1', self.job)
+        self.assertEquals(self._count_statements('update tko_machines'), 1)
+
+
+    def test_inserted_rows_are_cached(self):
+        self.db.insert_job('1-user/host1', self.job)
+        kernel = _Object(kernel_hash='hash', base='2.6', patches=[])
+        kernel_idx = self.db.insert_kernel(kernel)
+        del self.cursor.statements[:]
+
+        self.assertEquals(self.db.lookup_machine('host1'),
+                          self.job.machine_idx)
+        self.assertEquals(self.db.insert_kernel(kernel), kernel_idx)
+        self.assertEquals(self.cursor.statements, [])
+
+
+    def test_reconnecting_clears_the_caches(self):
+        self.db.insert_job('1-user/host1', self.job)
+        self.db._init_db()
+        self.assertEquals(self.db.lookup_machine('host1'), None)
+
+
+    def test_eviction(self):
+        cache = db._LookupCache(10)
+        for key in xrange(10):
+            cache.set(key, key)
+        cache.get(0)
+        cache.set(10, 10)
+        self.assertEquals(len(cache), 9)
+        self.assertEquals(cache.get(0), 0)
+        self.assertEquals(cache.get(1), None)
+        self.assertEquals(cache.get(2), None)
+        self.assertEquals(cache.get(3), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
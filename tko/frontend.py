@@ -4,6 +4,7 @@ try:
 except ImportError:
     import common
 from autotest.client.shared import kernel_versions
+from autotest.tko import packed_iterations
 
 MAX_RECORDS = 50000L
 MAX_CELLS = 500000L
@@ -296,6 +297,11 @@ class iteration:
         rows = db.select(','.join(fields), 'tko_iteration_result', where)
         for row in rows:
             iterations.append(klass(*row))
+        # the iterations of the tests parsed with tko_pack_iterations
+        for data, in db.select('data', 'tko_packed_iterations', where):
+            for index, attributes, perf in packed_iterations.unpack(data):
+                for key, value in sorted(perf.iteritems()):
+                    iterations.append(klass(index, key, value))
         return iterations
 
 
@@ -26,6 +26,61 @@ __author__ = 'darrenkuo@google.com (Darren Kuo)'
 mktime = time.mktime
 datetime = datetime.datetime
 
+# name of the file the parser serializes a job directory to
+SERIALIZED_JOB_FILE = 'job.serialize'
+
+
+def find_serialized_jobs(path):
+    """Finds the serialized jobs under a results directory.
+
+    Walks path, without descending into the test directories of the jobs
+    it finds, only into the machine directories of multi-machine jobs.
+
+    @param
+    path: a results directory, a job directory or a job.serialize file.
+
+    @return a generator of the paths of the job.serialize files.
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        if SERIALIZED_JOB_FILE in filenames:
+            yield os.path.join(dirpath, SERIALIZED_JOB_FILE)
+        elif 'status.log' not in filenames and 'status' not in filenames:
+            continue
+        # a job directory, only its machine directories can hold jobs
+        machines = set()
+        if '.machines' in filenames:
+            machines_file = open(os.path.join(dirpath, '.machines'))
+            try:
+                machines.update(line.strip() for line in machines_file)
+            finally:
+                machines_file.close()
+        dirnames[:] = [dirname for dirname in dirnames
+                       if dirname in machines]
+
+
+def iter_serialized_jobs(paths):
+    """Deserializes job.serialize files one at a time.
+
+    Only one job is held in memory at a time, however many files are
+    read, as long as the caller does not keep the jobs around.
+
+    @param
+    paths: an iterable of job.serialize file names, such as returned by
+    find_serialized_jobs().
+
+    @return a generator of (file name, tag, tko job) tuples.
+    """
+    serializer = JobSerializer()
+    for path in paths:
+        tag, job = serializer.deserialize_tag_and_job(path)
+        yield path, tag, job
+
+
 class JobSerializer(object):
     """A class that takes a job object of the tko module and package
     it with a protocol buffer.
@@ -75,15 +130,28 @@ class JobSerializer(object):
         be returned.
         """
 
+        return self.deserialize_tag_and_job(infile)[1]
+
+
+    def deserialize_tag_and_job(self, infile):
+        """Takes in a binary file name and returns the tag it was
+        serialized with and a tko job object.
+
+        @param
+        infile: the name of the binary file that will be deserialized.
+
+        @return a (tag, tko job) tuple.
+        """
+
         job_pb = tko_pb2.Job()
 
-        binary = open(infile, 'r')
+        binary = open(infile, 'rb')
         try:
             job_pb.ParseFromString(binary.read())
         finally:
             binary.close()
 
-        return self.get_tko_job(job_pb)
+        return job_pb.tag, self.get_tko_job(job_pb)
 
 
     def serialize_to_binary(self, the_job, tag, binaryfilename):
@@ -367,8 +435,12 @@ class JobSerializer(object):
             if field_type in (str, int, long):
                 resultdict[field] = field_type(value)
             elif field_type == datetime:
-                resultdict[field] = (
-                            datetime.fromtimestamp(value/1000.0))
+                # set_trivial_attr() writes unset times as 0
+                if value:
+                    resultdict[field] = (
+                                datetime.fromtimestamp(value/1000.0))
+                else:
+                    resultdict[field] = None
 
         return resultdict
 
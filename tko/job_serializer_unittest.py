@@ -13,6 +13,7 @@ except ImportError:
 import datetime
 import os
 import re
+import shutil
 import tempfile
 import time
 import sys
@@ -353,5 +354,72 @@ class ReadBackGetterTest(JobSerializerUnittest):
                             newiteration.perf_keyval)
 
 
+class SerializedJobsReaderTest(unittest.TestCase):
+    """Check finding and reading back job.serialize files in bulk.
+    """
+
+    def setUp(self):
+        self.results_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.results_dir)
+
+
+    def make_job_dir(self, path, machines=None, serialized=True):
+        """Create a job directory with a test directory in it.
+        """
+        path = os.path.join(self.results_dir, path)
+        os.makedirs(os.path.join(path, 'test', 'results'))
+        open(os.path.join(path, 'status.log'), 'w').close()
+        # a stray file that must not be mistaken for a job
+        open(os.path.join(path, 'test', 'results',
+                          job_serializer.SERIALIZED_JOB_FILE), 'w').close()
+        if serialized:
+            open(os.path.join(path, job_serializer.SERIALIZED_JOB_FILE),
+                 'w').close()
+        if machines:
+            machines_file = open(os.path.join(path, '.machines'), 'w')
+            machines_file.write('\n'.join(machines))
+            machines_file.close()
+        return path
+
+
+    def test_find_serialized_jobs(self):
+        self.make_job_dir('1-user/host1')
+        self.make_job_dir('2-user', machines=['host2'], serialized=False)
+        self.make_job_dir('2-user/host2')
+        self.make_job_dir('3-user/host3', serialized=False)
+
+        found = list(job_serializer.find_serialized_jobs(self.results_dir))
+        self.assertEqual(
+                [os.path.relpath(path, self.results_dir) for path in found],
+                ['1-user/host1/job.serialize', '2-user/host2/job.serialize'])
+
+
+    def test_iter_serialized_jobs(self):
+        kernel = models.kernel('2.6.32', [], '1234')
+        tko_job = models.job('/tmp/', 'user', 'label', 'host1', None,
+                             None, None, '', '', '', None, {})
+        tko_job.tests = [models.test('test', 'test', 'GOOD', '', kernel,
+                                     'host1', None, None, [], {}, [])]
+        serializer = job_serializer.JobSerializer()
+        paths = []
+        for index in xrange(3):
+            path = os.path.join(self.results_dir, 'job%d' % index)
+            serializer.serialize_to_binary(tko_job, '%d-user/host1' % index,
+                                           path)
+            paths.append(path)
+
+        jobs = list(job_serializer.iter_serialized_jobs(paths))
+        self.assertEqual([(path, tag) for path, tag, _ in jobs],
+                         [(paths[0], '0-user/host1'),
+                          (paths[1], '1-user/host1'),
+                          (paths[2], '2-user/host1')])
+        job = jobs[0][2]
+        self.assertEqual(job.started_time, None)
+        self.assertEqual(job.tests[0].finished_time, None)
+
+
 if __name__ == '__main__':
     unittest.main()
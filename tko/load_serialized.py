@@ -0,0 +1,135 @@
+#!/usr/bin/python -u
+"""
+Load the results database from the job.serialize files the parser writes
+next to the status logs, instead of parsing the job directories again.
+
+Loading skips the status logs, the keyval files and the kernel discovery,
+which makes it much faster than tko/parse to populate a new results
+database, be it for a migration, a reporting replica or a restore.  The
+files are read one at a time, so any number of jobs can be loaded.
+"""
+
+import os, sys, optparse, time
+
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.tko import db as tko_db, utils as tko_utils
+
+
+# minimum number of seconds between two progress reports
+_PROGRESS_INTERVAL_SECS = 60
+
+
+def parse_args():
+    parser = optparse.OptionParser(
+            usage="%prog [options] results_dir|job_dir|job.serialize ...")
+    parser.add_option("-r", "--replace",
+                      help=("Replace the jobs already in the database, "
+                            "instead of skipping them"),
+                      dest="replace", action="store_true")
+    parser.add_option("-b", "--batch-size",
+                      help="Number of jobs loaded per transaction",
+                      dest="batch_size", type="int", default=50)
+    parser.add_option("-s", help="Database server hostname",
+                      dest="db_host", action="store")
+    parser.add_option("-u", help="Database username", dest="db_user",
+                      action="store")
+    parser.add_option("-p", help="Database password", dest="db_pass",
+                      action="store")
+    parser.add_option("-d", help="Database name", dest="db_name",
+                      action="store")
+    options, args = parser.parse_args()
+
+    if options.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if not args:
+        parser.error("at least one results directory must be provided")
+    return options, args
+
+
+def prepare_job(job):
+    """
+    Fix up a deserialized job for db.insert_job(): job.serialize stores
+    every value as a string, and labels by name rather than by index.
+    """
+    for test in job.tests:
+        for iteration in test.iterations:
+            perf_keyval = {}
+            for key, value in iteration.perf_keyval.iteritems():
+                try:
+                    perf_keyval[key] = float(value)
+                except ValueError:
+                    tko_utils.dprint("! Ignoring non numeric perf keyval "
+                                     "%s=%r of test %s" % (key, value,
+                                                           test.subdir))
+            iteration.perf_keyval = perf_keyval
+        test.labels = []
+
+
+def load_job(db, path, tag, job, replace):
+    """
+    Write a deserialized job to the database.
+
+    @returns False if the job was skipped because it is already in the
+            database, True otherwise.
+    """
+    if db.find_job(tag) is not None:
+        if not replace:
+            tko_utils.dprint("! Job %s (%s) is already loaded" % (tag, path))
+            return False
+        db.delete_job(tag)
+    prepare_job(job)
+    db.insert_job(tag, job)
+    return True
+
+
+def main():
+    options, args = parse_args()
+    try:
+        from autotest.tko import job_serializer
+    except ImportError:
+        tko_utils.dprint("ERROR: tko_pb2.py doesn't exist. Create by "
+                         "compiling tko/tko.proto.")
+        sys.exit(1)
+
+    db = tko_db.db(autocommit=False, host=options.db_host,
+                   user=options.db_user, password=options.db_pass,
+                   database=options.db_name)
+    loaded = skipped = uncommitted = 0
+    start_time = last_report_time = time.time()
+
+    def report():
+        elapsed = time.time() - start_time
+        tko_utils.dprint("Loaded %d jobs (%d skipped as already loaded) in "
+                         "%.0fs, %.2f/s" % (loaded, skipped, elapsed,
+                                            loaded / max(elapsed, 1e-6)))
+
+    for path in args:
+        paths = job_serializer.find_serialized_jobs(os.path.abspath(path))
+        for serialized_path, tag, job in job_serializer.iter_serialized_jobs(
+                paths):
+            try:
+                if load_job(db, serialized_path, tag, job, options.replace):
+                    loaded += 1
+                    uncommitted += 1
+                else:
+                    skipped += 1
+            except Exception:
+                # the jobs committed so far are skipped when run again
+                db.con.rollback()
+                tko_utils.dprint("ERROR: failed to load %s" % serialized_path)
+                raise
+            if uncommitted >= options.batch_size:
+                db.commit()
+                uncommitted = 0
+            if time.time() - last_report_time >= _PROGRESS_INTERVAL_SECS:
+                last_report_time = time.time()
+                report()
+    db.commit()
+    report()
+
+
+if __name__ == "__main__":
+    main()
@@ -36,7 +36,7 @@ class job(object):
         keyval = {}
         while True:
             try:
-                upper_keyval = utils.read_keyval(dir)
+                upper_keyval = tko_utils.read_keyval(dir)
                 # HACK: exclude hostname from the override - this is a special
                 # case where we want lower to override higher
                 if "hostname" in upper_keyval and "hostname" in keyval:
@@ -147,7 +147,7 @@ class test(object):
         keyval path. Does not assume that the path actually exists."""
         if not os.path.exists(keyval_path):
             return {}
-        return utils.read_keyval(keyval_path)
+        return tko_utils.read_keyval(keyval_path)
 
 
     @staticmethod
@@ -160,7 +160,7 @@ class test(object):
         # the keyval is <job_dir>/host_keyvals/<hostname> if it exists
         keyval_path = os.path.join(job_dir, "host_keyvals", hostname)
         if os.path.isfile(keyval_path):
-            return utils.read_keyval(keyval_path)
+            return tko_utils.read_keyval(keyval_path)
         else:
             return {}
 
@@ -199,17 +199,24 @@ class iteration(object):
         if not os.path.exists(keyval_path):
             return []
 
-        iterations = []
-        index = 1
+        keyvals = tko_utils.cached_parse(keyval_path, cls.parse_keyval_file)
+        return [cls(index, dict(attr), dict(perf))
+                for index, (attr, perf) in enumerate(keyvals, 1)]
+
+
+    @classmethod
+    def parse_keyval_file(cls, keyval_path):
+        """Parse an iteration keyval file into a list of (attr, perf)
+        dictionary pairs, one per iteration."""
+        keyvals = []
         attr, perf = {}, {}
         for line in file(keyval_path):
             line = line.strip()
             if line:
                 cls.parse_line_into_dicts(line, attr, perf)
             else:
-                iterations.append(cls(index, attr, perf))
-                index += 1
+                keyvals.append((attr, perf))
                 attr, perf = {}, {}
         if attr or perf:
-            iterations.append(cls(index, attr, perf))
-        return iterations
+            keyvals.append((attr, perf))
+        return keyvals
@@ -0,0 +1,82 @@
+"""
+Compact storage of the iteration keyvals of a test.
+
+Instead of a tko_iteration_result row per (iteration, perf key) and a
+tko_iteration_attributes row per (iteration, attribute), the iterations of a
+test can be stored in a single tko_packed_iterations row.  Its data holds
+the perf keyvals as an iterations x keys matrix of doubles, next to a small
+JSON header with the key names, the iteration indexes and the attributes,
+all compressed with zlib and base64 encoded to fit a text column.
+"""
+
+import array, base64, json, sys, zlib
+
+
+_FORMAT_VERSION = 1
+
+
+def pack(iterations):
+    """
+    @param iterations: A list of objects with index, attr_keyval and
+            perf_keyval attributes, such as tko.models.iteration instances.
+
+    @returns A string for the data column of tko_packed_iterations.
+    """
+    perf_keys = sorted(set(key for iteration in iterations
+                           for key in iteration.perf_keyval))
+    key_columns = dict((key, column) for column, key in enumerate(perf_keys))
+    matrix = array.array('d', [0.0]) * (len(iterations) * len(perf_keys))
+    # (row, column) of the keys some iterations do not have
+    missing = []
+    for row, iteration in enumerate(iterations):
+        for key in perf_keys:
+            column = key_columns[key]
+            value = iteration.perf_keyval.get(key)
+            if value is None:
+                missing.append((row, column))
+            else:
+                matrix[row * len(perf_keys) + column] = value
+    if sys.byteorder == 'big':
+        matrix.byteswap()
+
+    header = json.dumps({'version': _FORMAT_VERSION,
+                         'indexes': [iteration.index
+                                     for iteration in iterations],
+                         'perf_keys': perf_keys,
+                         'missing': missing,
+                         'attributes': [iteration.attr_keyval
+                                        for iteration in iterations]},
+                        sort_keys=True)
+    return base64.b64encode(zlib.compress(header + '\n' + matrix.tostring()))
+
+
+def unpack(data):
+    """
+    @param data: A string returned by pack().
+
+    @returns A list of (index, attribute dict, perf keyval dict) tuples, one
+            per iteration.
+    """
+    payload = zlib.decompress(base64.b64decode(data))
+    header_end = payload.index('\n')
+    header = json.loads(payload[:header_end])
+    if header['version'] != _FORMAT_VERSION:
+        raise ValueError('Unknown packed iterations version %r' %
+                         header['version'])
+
+    matrix = array.array('d')
+    matrix.fromstring(payload[header_end + 1:])
+    if sys.byteorder == 'big':
+        matrix.byteswap()
+    perf_keys = header['perf_keys']
+    missing = set(tuple(cell) for cell in header['missing'])
+
+    iterations = []
+    for row, (index, attributes) in enumerate(zip(header['indexes'],
+                                                  header['attributes'])):
+        perf = {}
+        for column, key in enumerate(perf_keys):
+            if (row, column) not in missing:
+                perf[key] = matrix[row * len(perf_keys) + column]
+        iterations.append((index, attributes, perf))
+    return iterations
@@ -0,0 +1,60 @@
+#!/usr/bin/python
+
+import math
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.test_utils import unittest
+from autotest.tko import models, packed_iterations
+
+
+class PackedIterationsTest(unittest.TestCase):
+    def _round_trip(self, iterations):
+        return packed_iterations.unpack(packed_iterations.pack(iterations))
+
+
+    def test_round_trip(self):
+        iterations = [models.iteration(1, {'kernel': '2.6.32'},
+                                       {'throughput': 10.5, 'latency': 0.25}),
+                      models.iteration(2, {'kernel': '2.6.32'},
+                                       {'throughput': 11.0, 'latency': 0.5})]
+        self.assertEquals(self._round_trip(iterations),
+                          [(1, {'kernel': '2.6.32'},
+                            {'throughput': 10.5, 'latency': 0.25}),
+                           (2, {'kernel': '2.6.32'},
+                            {'throughput': 11.0, 'latency': 0.5})])
+
+
+    def test_missing_keys(self):
+        iterations = [models.iteration(1, {}, {'a': 1.0}),
+                      models.iteration(2, {}, {'b': 0.0}),
+                      models.iteration(3, {'only': 'attributes'}, {})]
+        self.assertEquals(self._round_trip(iterations),
+                          [(1, {}, {'a': 1.0}), (2, {}, {'b': 0.0}),
+                           (3, {'only': 'attributes'}, {})])
+
+
+    def test_special_values(self):
+        iterations = [models.iteration(1, {}, {'nan': float('nan'),
+                                               'inf': float('inf'),
+                                               'big': 1e300})]
+        (_, _, perf), = self._round_trip(iterations)
+        self.assert_(math.isnan(perf['nan']))
+        self.assertEquals(perf['inf'], float('inf'))
+        self.assertEquals(perf['big'], 1e300)
+
+
+    def test_no_iterations(self):
+        self.assertEquals(self._round_trip([]), [])
+
+
+    def test_unknown_version(self):
+        data = packed_iterations.pack([]).decode('base64').decode('zlib')
+        data = data.replace('"version": 1', '"version": 99')
+        self.assertRaises(ValueError, packed_iterations.unpack,
+                          data.encode('zlib').encode('base64'))
+
+
+if __name__ == '__main__':
+    unittest.main()
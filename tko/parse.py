@@ -1,6 +1,7 @@
 #!/usr/bin/python -u
 
-import os, sys, optparse, fcntl, errno, traceback, socket
+import os, sys, optparse, fcntl, errno, traceback, socket, time
+import cPickle, multiprocessing, base64, json, cStringIO
 
 try:
     import autotest.common as common
@@ -11,6 +12,21 @@ from autotest.tko import db as tko_db, utils as tko_utils, status_lib, models
 from autotest.client.shared import utils
 
 
+# minimum number of seconds between two progress reports
+_PROGRESS_INTERVAL_SECS = 60
+
+# file, in a job directory, holding the state of the last parse of its status
+# log, so that the next parse only has to go through the lines added since
+PARSE_STATE_FILE = ".parse.state"
+# changed whenever the contents of the parse state file change
+_PARSE_STATE_VERSION = 2
+# number of bytes before the saved offset checked to still be the same, in
+# case the status log was replaced by a file reusing its inode
+_FINGERPRINT_SIZE = 4096
+# approximate number of bytes read from a status log at a time
+_READ_CHUNK_SIZE = 1024 * 1024
+
+
 def parse_args():
     # build up our options parser and parse sys.argv
     parser = optparse.OptionParser()
@@ -23,6 +39,10 @@ def parse_args():
     parser.add_option("-l", help=("Levels of subdirectories to include "
                                   "in the job name"),
                       type="int", dest="level", default=1)
+    parser.add_option("-f", "--full-reparse",
+                      help=("Reparse status logs from the start, ignoring "
+                            "the state saved by previous parses"),
+                      dest="full_reparse", action="store_true")
     parser.add_option("-n", help="No blocking on an existing parse",
                       dest="noblock", action="store_true")
     parser.add_option("-s", help="Database server hostname",
@@ -37,8 +57,15 @@ def parse_args():
                       help="write pidfile (.parser_execute)",
                       dest="write_pidfile", action="store_true",
                       default=False)
+    parser.add_option("-j", "--jobs",
+                      help="Number of processes parsing job directories in "
+                           "parallel, each with its own database connection",
+                      dest="jobs", type="int", default=1)
     options, args = parser.parse_args()
 
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     # we need a results directory
     if len(args) == 0:
         tko_utils.dprint("ERROR: at least one results directory must "
@@ -72,11 +99,171 @@ def mailfailure(jobname, job, message):
     mail.send("", job.user, "", subject, message_header + message)
 
 
-def parse_one(db, jobname, path, reparse, mail_on_failure):
+class StatusLogReader(object):
+    """
+    Iterates over the complete lines of a status log from a byte offset,
+    reading it a chunk at a time.  A last line without a newline may still be
+    being written, so it is kept aside in partial_line instead and the
+    iteration stops there: the rest of that line is read along with it by
+    the next reader, from offset.
+    """
+    def __init__(self, status_file, offset=0, chunk_size=_READ_CHUNK_SIZE):
+        self._file = status_file
+        self._chunk_size = chunk_size
+        # offset just past the last line returned
+        self.offset = offset
+        self.partial_line = ""
+
+
+    def __iter__(self):
+        self._file.seek(self.offset)
+        self.partial_line = ""
+        while not self.partial_line:
+            lines = self._file.readlines(self._chunk_size)
+            if not lines:
+                return
+            if not lines[-1].endswith("\n"):
+                self.partial_line = lines.pop()
+            for line in lines:
+                self.offset += len(line)
+                yield line
+
+
+# the classes the parser checkpoints are made of.  The results directory gets
+# files from the test machines, so a checkpoint is unpickled with only these
+# allowed in, none of which runs code when loaded
+_CHECKPOINT_CLASSES = set(
+        [("__builtin__", "set"), ("__builtin__", "frozenset"),
+         ("datetime", "datetime"), ("autotest.tko.status_lib", "status_stack"),
+         ("autotest.tko.parsers.version_0", "status_line"),
+         ("autotest.tko.parsers.version_1", "status_line")] +
+        [(module_name, name)
+         for module_name in ("autotest.tko.models",
+                             "autotest.tko.parsers.version_0",
+                             "autotest.tko.parsers.version_1")
+         for name in ("job", "kernel", "test", "patch", "iteration")])
+
+
+def _find_checkpoint_class(module_name, name):
+    if ((module_name, name) not in _CHECKPOINT_CLASSES or
+        module_name not in sys.modules):
+        raise cPickle.UnpicklingError("%s.%s can't be part of a parser "
+                                      "checkpoint" % (module_name, name))
+    return getattr(sys.modules[module_name], name)
+
+
+def _dump_snapshot(checkpoint, tests):
+    return base64.b64encode(cPickle.dumps((checkpoint, tests),
+                                          cPickle.HIGHEST_PROTOCOL))
+
+
+def _load_snapshot(snapshot):
+    """
+    @returns The (checkpoint, tests) tuple saved by _dump_snapshot().
+    @raises cPickle.UnpicklingError if the snapshot holds anything but the
+            objects of a parser checkpoint.
+    """
+    unpickler = cPickle.Unpickler(
+            cStringIO.StringIO(base64.b64decode(snapshot)))
+    unpickler.find_global = _find_checkpoint_class
+    return unpickler.load()
+
+
+def _get_fingerprint(status_file, offset):
+    start = max(0, offset - _FINGERPRINT_SIZE)
+    status_file.seek(start)
+    return utils.hash("md5", status_file.read(offset - start)).hexdigest()
+
+
+def _load_parse_state(path, status_log, status_version):
+    """
+    Load the state saved by the previous parse of a job.
+
+    @returns The state, its snapshot loaded, or None if there is none or it
+            does not apply to the current status log.
+    """
+    state_path = os.path.join(path, PARSE_STATE_FILE)
+    if not os.path.exists(state_path):
+        return None
+    try:
+        state = json.load(open(state_path))
+        if not isinstance(state, dict):
+            raise ValueError("not a parse state")
+    except Exception, e:
+        tko_utils.dprint("! Ignoring unreadable %s: %s" % (state_path, e))
+        return None
+
+    status_stat = os.stat(status_log)
+    try:
+        replaced = (state.get("version") != _PARSE_STATE_VERSION or
+                    state["status_log"] != os.path.basename(status_log) or
+                    state["status_version"] != status_version or
+                    state["inode"] != status_stat.st_ino or
+                    not 0 <= state["offset"] <= status_stat.st_size or
+                    _get_fingerprint(open(status_log), state["offset"]) !=
+                    state["fingerprint"])
+    except (KeyError, TypeError), e:
+        tko_utils.dprint("! Ignoring invalid %s: %s" % (state_path, e))
+        return None
+    if replaced:
+        tko_utils.dprint("! Ignoring %s, the status log was replaced" %
+                         state_path)
+        return None
+    try:
+        state["snapshot"] = _load_snapshot(state["snapshot"])
+    except Exception, e:
+        tko_utils.dprint("! Ignoring %s, invalid parser snapshot: %s" %
+                         (state_path, e))
+        return None
+    return state
+
+
+def _save_parse_state(path, state):
+    state_path = os.path.join(path, PARSE_STATE_FILE)
+    temp_path = state_path + ".tmp"
+    state_file = open(temp_path, "w")
+    try:
+        json.dump(state, state_file)
+    finally:
+        state_file.close()
+    os.rename(temp_path, state_path)
+
+
+def _remove_parse_state(path):
+    state_path = os.path.join(path, PARSE_STATE_FILE)
+    if os.path.exists(state_path):
+        os.remove(state_path)
+
+
+def format_row_counts(row_counts):
+    return ", ".join("%d %s" % (row_counts[key], key)
+                     for key in tko_db.ROW_COUNT_KEYS)
+
+
+def _unique_tests(tests):
+    """
+    The parser can return the same test object multiple times, as it gets
+    updated.  Return the tests without the duplicates, in order.
+    """
+    unique_tests = []
+    already_added = set()
+    for test in tests:
+        if test not in already_added:
+            already_added.add(test)
+            unique_tests.append(test)
+    return unique_tests
+
+
+def parse_one(db, jobname, path, reparse, mail_on_failure, resume=True):
     """
     Parse a single job. Optionally send email on failure.
+
+    When reparsing a job and resume is True, only the status log lines added
+    since the previous parse are parsed, starting from the parser state it
+    saved, and only the tests they changed are written.
     """
     tko_utils.dprint("\nScanning %s (%s)" % (jobname, path))
+    row_counts = dict(db.row_counts)
     old_job_idx = db.find_job(jobname)
     # old tests is a dict from tuple (test_name, subdir) to test_idx
     old_tests = {}
@@ -105,19 +292,44 @@ def parse_one(db, jobname, path, reparse, mail_on_failure):
         tko_utils.dprint("! Unable to parse job, no status file")
         return
 
-    # parse the status logs
-    tko_utils.dprint("+ Parsing dir=%s, jobname=%s" % (path, jobname))
-    status_lines = open(status_log).readlines()
-    parser.start(job)
-    tests = parser.end(status_lines)
+    # pick up where the previous parse stopped, if it saved its state
+    state = None
+    if old_job_idx is not None and resume:
+        state = _load_parse_state(path, status_log, status_version)
+    if state:
+        offset = state["offset"]
+        checkpoint, previous_tests = state["snapshot"]
+        tko_utils.dprint("+ Resuming at offset %d of %s" % (offset,
+                                                           status_log))
+    else:
+        offset, checkpoint, previous_tests = 0, None, []
 
-    # parser.end can return the same object multiple times, so filter out dups
-    job.tests = []
-    already_added = set()
-    for test in tests:
-        if test not in already_added:
-            already_added.add(test)
-            job.tests.append(test)
+    # parse the status logs a chunk at a time, up to the last complete line
+    # before saving the parser state, as the rest of the line may still be
+    # being written
+    tko_utils.dprint("+ Parsing dir=%s, jobname=%s" % (path, jobname))
+    status_file = open(status_log)
+    status_inode = os.fstat(status_file.fileno()).st_ino
+    reader = StatusLogReader(status_file, offset)
+    parser.start(job, checkpoint)
+    tests = parser.process_lines(reader)
+    fingerprint = _get_fingerprint(status_file, reader.offset)
+    status_file.close()
+    parsed_tests = _unique_tests(previous_tests + tests)
+    new_state = None
+    if parser.get_checkpoint() is not None:
+        # end() goes on to update the objects of the snapshot
+        snapshot = _dump_snapshot(parser.get_checkpoint(), parsed_tests)
+        new_state = {"version": _PARSE_STATE_VERSION,
+                     "status_log": os.path.basename(status_log),
+                     "status_version": status_version,
+                     "inode": status_inode,
+                     "offset": reader.offset,
+                     "fingerprint": fingerprint,
+                     "snapshot": snapshot}
+    partial_line = reader.partial_line
+    end_tests = parser.end(partial_line and [partial_line] or [])
+    job.tests = _unique_tests(tests + end_tests)
 
     # try and port test_idx over from the old tests, but if old tests stop
     # matching up with new ones just give up
@@ -127,17 +339,19 @@ def parse_one(db, jobname, path, reparse, mail_on_failure):
             test_idx = old_tests.pop((test.testname, test.subdir), None)
             if test_idx is not None:
                 test.test_idx = test_idx
-            else:
+            elif not state:
                 tko_utils.dprint("! Reparse returned new test "
                                  "testname=%r subdir=%r" %
                                  (test.testname, test.subdir))
-        for test_idx in old_tests.itervalues():
-            where = {'test_idx' : test_idx}
-            db.delete('tko_iteration_result', where)
-            db.delete('tko_iteration_attributes', where)
-            db.delete('tko_test_attributes', where)
-            db.delete('tko_test_labels_tests', {'test_id': test_idx})
-            db.delete('tko_tests', where)
+        if state:
+            # the tests missing from a resumed parse did not change, except
+            # for those end() made up for groups that were still running
+            stale_test_idxs = (set(state["end_only_test_idxs"]) -
+                               set(test.test_idx for test in job.tests
+                                   if hasattr(test, "test_idx")))
+        else:
+            stale_test_idxs = old_tests.values()
+        db.delete_tests(stale_test_idxs)
 
     # check for failures
     message_lines = [""]
@@ -160,6 +374,18 @@ def parse_one(db, jobname, path, reparse, mail_on_failure):
 
     # write the job into the database
     db.insert_job(jobname, job)
+    if reparse and old_job_idx is not None:
+        tko_utils.dprint("+ Test rows: %s" % format_row_counts(
+                dict((key, db.row_counts[key] - row_counts[key])
+                     for key in tko_db.ROW_COUNT_KEYS)))
+    if new_state is not None:
+        parsed_test_set = set(parsed_tests)
+        new_state["end_only_test_idxs"] = [
+                test.test_idx for test in end_tests
+                if test not in parsed_test_set]
+
+    # the serialized job holds all of its tests, changed or not
+    job.tests = _unique_tests(parsed_tests + end_tests)
 
     # Serializing job into a binary file
     try:
@@ -184,6 +410,11 @@ def parse_one(db, jobname, path, reparse, mail_on_failure):
 
     db.commit()
 
+    if new_state is not None:
+        _save_parse_state(path, new_state)
+    elif not resume:
+        _remove_parse_state(path)
+
 def _site_export_dummy(binary_file_name):
     pass
 
@@ -204,6 +435,7 @@ def _get_job_subdirs(path):
     # if this dir contains ONLY subdirectories, return them
     contents = set(os.listdir(path))
     contents.discard(".parse.lock")
+    contents.discard(PARSE_STATE_FILE)
     subdirs = set(sub for sub in contents if
                   os.path.isdir(os.path.join(path, sub)))
     if len(contents) == len(subdirs) != 0:
@@ -213,31 +445,147 @@ def _get_job_subdirs(path):
     return None
 
 
-def parse_leaf_path(db, path, level, reparse, mail_on_failure):
+def parse_leaf_path(db, path, level, reparse, mail_on_failure, resume=True):
     job_elements = path.split("/")[-level:]
     jobname = "/".join(job_elements)
     try:
         db.run_with_retry(parse_one, db, jobname, path, reparse,
-                          mail_on_failure)
+                          mail_on_failure, resume)
     except Exception:
         traceback.print_exc()
 
 
-def parse_path(db, path, level, reparse, mail_on_failure):
+def parse_path(db, path, level, reparse, mail_on_failure, resume=True):
     job_subdirs = _get_job_subdirs(path)
     if job_subdirs is not None:
         # parse status.log in current directory, if it exists. multi-machine
         # synchronous server side tests record output in this directory. without
         # this check, we do not parse these results.
         if os.path.exists(os.path.join(path, 'status.log')):
-            parse_leaf_path(db, path, level, reparse, mail_on_failure)
+            parse_leaf_path(db, path, level, reparse, mail_on_failure,
+                            resume)
         # multi-machine job
         for subdir in job_subdirs:
             jobpath = os.path.join(path, subdir)
-            parse_path(db, jobpath, level + 1, reparse, mail_on_failure)
+            parse_path(db, jobpath, level + 1, reparse, mail_on_failure,
+                       resume)
     else:
         # single machine job
-        parse_leaf_path(db, path, level, reparse, mail_on_failure)
+        parse_leaf_path(db, path, level, reparse, mail_on_failure, resume)
+
+
+def _open_db(options):
+    return tko_db.db(autocommit=False, host=options.db_host,
+                     user=options.db_user, password=options.db_pass,
+                     database=options.db_name)
+
+
+def parse_job_dir(db, path, options):
+    """
+    Parse the results under path while holding its .parse.lock.
+
+    @returns False if the directory was skipped because another parser holds
+            the lock and options.noblock is set, True otherwise.
+    """
+    lockfile = open(os.path.join(path, ".parse.lock"), "w")
+    flags = fcntl.LOCK_EX
+    if options.noblock:
+        flags |= fcntl.LOCK_NB
+    try:
+        fcntl.flock(lockfile, flags)
+    except IOError, e:
+        # lock is not available and nonblock has been requested
+        if e.errno == errno.EWOULDBLOCK:
+            lockfile.close()
+            return False
+        else:
+            raise # something unexpected happened
+    try:
+        parse_path(db, path, options.level, options.reparse,
+                   options.mailit, not options.full_reparse)
+    finally:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+    return True
+
+
+class ProgressReporter(object):
+    """
+    Reports how many job directories have been parsed, and how fast, at most
+    once every interval seconds and when the last one is done.
+    """
+    def __init__(self, total, interval=_PROGRESS_INTERVAL_SECS,
+                 time_func=time.time):
+        self.total = total
+        self.done = 0
+        self.skipped = 0
+        # test rows written by the parsers, by tko_db.ROW_COUNT_KEYS
+        self.row_counts = dict.fromkeys(tko_db.ROW_COUNT_KEYS, 0)
+        self._interval = interval
+        self._time_func = time_func
+        self._start_time = self._last_report_time = time_func()
+
+
+    def add_row_counts(self, row_counts):
+        for key in tko_db.ROW_COUNT_KEYS:
+            self.row_counts[key] += row_counts[key]
+
+
+    def job_dir_done(self, parsed):
+        self.done += 1
+        if not parsed:
+            self.skipped += 1
+        now = self._time_func()
+        if (self.done == self.total or
+            now - self._last_report_time >= self._interval):
+            self._last_report_time = now
+            tko_utils.dprint(self.get_message(now))
+
+
+    def get_message(self, now):
+        elapsed = now - self._start_time
+        rate = self.done / max(elapsed, 1e-6)
+        return ("Parsed %d/%d job directories (%d skipped as locked) in "
+                "%.0fs, %.2f/s" % (self.done, self.total, self.skipped,
+                                   elapsed, rate))
+
+
+# database connection and options of a parse_job_dir() worker process, set
+# up by init_worker(), which tko/parse_daemon also uses
+_worker_db = None
+_worker_options = None
+
+
+def init_worker(options):
+    global _worker_db, _worker_options
+    _worker_db = _open_db(options)
+    _worker_options = options
+
+
+def parse_job_dir_in_worker(path):
+    """
+    @returns A (parse_job_dir() result, test row counts) tuple.
+    """
+    parsed = parse_job_dir(_worker_db, path, _worker_options)
+    row_counts = _worker_db.row_counts
+    _worker_db.row_counts = dict.fromkeys(tko_db.ROW_COUNT_KEYS, 0)
+    return parsed, row_counts
+
+
+def _parse_job_dirs_in_parallel(jobs_list, options, progress):
+    pool = multiprocessing.Pool(options.jobs, init_worker, (options,))
+    try:
+        # one directory at a time, so a large job does not hold back others
+        for parsed, row_counts in pool.imap_unordered(
+                parse_job_dir_in_worker, jobs_list, 1):
+            progress.add_row_counts(row_counts)
+            progress.job_dir_done(parsed)
+    except:
+        pool.terminate()
+        pool.join()
+        raise
+    pool.close()
+    pool.join()
 
 
 def main():
@@ -257,34 +605,19 @@ def main():
         else:
             jobs_list = [os.path.join(results_dir, subdir)
                          for subdir in os.listdir(results_dir)]
+        progress = ProgressReporter(len(jobs_list))
 
-        # build up the database
-        db = tko_db.db(autocommit=False, host=options.db_host,
-                       user=options.db_user, password=options.db_pass,
-                       database=options.db_name)
-
-        # parse all the jobs
-        for path in jobs_list:
-            lockfile = open(os.path.join(path, ".parse.lock"), "w")
-            flags = fcntl.LOCK_EX
-            if options.noblock:
-                flags |= fcntl.LOCK_NB
-            try:
-                fcntl.flock(lockfile, flags)
-            except IOError, e:
-                # lock is not available and nonblock has been requested
-                if e.errno == errno.EWOULDBLOCK:
-                    lockfile.close()
-                    continue
-                else:
-                    raise # something unexpected happened
-            try:
-                parse_path(db, path, options.level, options.reparse,
-                           options.mailit)
-
-            finally:
-                fcntl.flock(lockfile, fcntl.LOCK_UN)
-                lockfile.close()
+        if options.jobs > 1 and len(jobs_list) > 1:
+            _parse_job_dirs_in_parallel(jobs_list, options, progress)
+        else:
+            db = _open_db(options)
+            for path in jobs_list:
+                progress.job_dir_done(parse_job_dir(db, path, options))
+            progress.add_row_counts(db.row_counts)
+
+        if options.reparse:
+            tko_utils.dprint("Test rows: %s" %
+                             format_row_counts(progress.row_counts))
 
     except:
         pid_file_manager.close_file(1)
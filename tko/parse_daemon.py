@@ -0,0 +1,281 @@
+#!/usr/bin/python -u
+"""
+A long running parser, taking the results directories of finished jobs
+through a Unix socket, for the scheduler to submit to instead of starting a
+tko/parse process per job.
+
+The daemon keeps a pool of parser processes, each with its own database
+connection and lookup caches, that survive from one job to the next.  For
+every results directory it accepts, it writes the .parser_execute pidfile a
+tko/parse --write-pidfile process would: its own pid while the job is
+parsed, then the exit status.  The scheduler follows the parse through that
+pidfile like it follows a parser process.
+
+A parser process that dies (killed for using too much memory, crashing)
+takes its parse with it without the pool ever telling the daemon.  Parses
+still pending --parse-timeout-mins after they were submitted are therefore
+given up on, their pidfile closed with a failure exit status.
+"""
+
+import os, sys, socket, optparse, multiprocessing, threading, traceback
+import signal, errno, time
+
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared import pidfile
+from autotest.tko import parse, utils as tko_utils
+
+
+# seconds a client or the daemon waits for the other end of a connection
+SOCKET_TIMEOUT_SECS = 30
+# maximum length of a request or a reply, a path and a newline
+_MAX_MESSAGE_SIZE = 4096
+# the log a parse writes to in the results directory, like FinalReparseTask
+_PARSE_LOG_FILE = '.parse.log'
+# seconds between two checks for overdue parses while no client connects
+_OVERDUE_CHECK_INTERVAL_SECS = 60
+
+
+class SubmitError(Exception):
+    pass
+
+
+def _read_line(connection):
+    data = ''
+    while not data.endswith('\n'):
+        if len(data) > _MAX_MESSAGE_SIZE:
+            raise socket.error('Message too long')
+        chunk = connection.recv(_MAX_MESSAGE_SIZE)
+        if not chunk:
+            raise socket.error('Connection closed after %r' % data)
+        data += chunk
+    return data[:-1]
+
+
+def submit(socket_path, results_dir, timeout=SOCKET_TIMEOUT_SECS):
+    """
+    Have the daemon listening on socket_path parse results_dir.
+
+    Returns once the daemon has written the parser pidfile of results_dir,
+    so it can be monitored right away.
+
+    @raises SubmitError if the daemon could not be reached or refused the
+            directory.
+    """
+    if '\n' in results_dir:
+        raise SubmitError('Invalid results directory %r' % results_dir)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        try:
+            connection.connect(socket_path)
+            connection.sendall(results_dir + '\n')
+            reply = _read_line(connection)
+        except socket.error, e:
+            raise SubmitError('Could not submit %s to the parse daemon at '
+                              '%s: %s' % (results_dir, socket_path, e))
+    finally:
+        connection.close()
+    if reply != 'OK':
+        raise SubmitError('The parse daemon refused %s: %s' % (results_dir,
+                                                               reply))
+
+
+def _parse_in_worker(results_dir):
+    """
+    Parse results_dir in a worker process set up by parse.init_worker(),
+    with its output going to the parse log of the directory.
+
+    @returns The exit status of the parse.  Never raises: the pool would not
+            call back the daemon, leaving the parse pending forever.
+    """
+    stderr = sys.stderr
+    log_file = None
+    try:
+        try:
+            log_file = open(os.path.join(results_dir, _PARSE_LOG_FILE), 'a')
+            sys.stderr = log_file
+            tko_utils.redirect_parser_debugging(log_file)
+            parse.parse_job_dir_in_worker(results_dir)
+        except Exception:
+            # to the parse log, or to the daemon's stderr if it can't be
+            # opened
+            traceback.print_exc()
+            return 1
+        return 0
+    finally:
+        tko_utils.redirect_parser_debugging(stderr)
+        sys.stderr = stderr
+        if log_file:
+            log_file.close()
+
+
+class ParseDaemon(object):
+    def __init__(self, socket_path, options):
+        self._socket_path = socket_path
+        self._options = options
+        self._pool = None
+        # results directory -> (PidFileManager, submit time), for the parses
+        # not done yet, shared with the thread running the pool callbacks
+        self._pending = {}
+        self._lock = threading.Lock()
+        # seconds after which a pending parse is given up on, None for never
+        self._parse_timeout_secs = None
+
+
+    def serve(self):
+        self._pool = multiprocessing.Pool(self._options.jobs,
+                                          parse.init_worker, (self._options,))
+        if self._options.parse_timeout_mins:
+            self._parse_timeout_secs = self._options.parse_timeout_mins * 60
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(self._socket_path)
+        except OSError, e:
+            # left behind by a daemon that did not exit cleanly
+            if e.errno != errno.ENOENT:
+                raise
+        listener.bind(self._socket_path)
+        listener.listen(socket.SOMAXCONN)
+        # wake up now and then to give up on the overdue parses
+        listener.settimeout(_OVERDUE_CHECK_INTERVAL_SECS)
+        tko_utils.dprint('Parse daemon listening on %s with %d parser '
+                         'processes' % (self._socket_path, self._options.jobs))
+        try:
+            while True:
+                self._close_overdue_parses(time.time())
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                connection.settimeout(SOCKET_TIMEOUT_SECS)
+                try:
+                    self._handle_connection(connection)
+                except socket.error, e:
+                    tko_utils.dprint('Dropping a connection: %s' % e)
+                finally:
+                    connection.close()
+        finally:
+            listener.close()
+            os.unlink(self._socket_path)
+            self._pool.terminate()
+            self._pool.join()
+
+
+    def _handle_connection(self, connection):
+        results_dir = _read_line(connection)
+        if not os.path.isabs(results_dir) or not os.path.isdir(results_dir):
+            connection.sendall('No such results directory\n')
+            return
+
+        self._lock.acquire()
+        try:
+            # a directory submitted again before its parse is done shares it
+            if results_dir not in self._pending:
+                pid_file_manager = pidfile.PidFileManager('parser',
+                                                          results_dir)
+                try:
+                    pid_file_manager.open_file()
+                except (IOError, OSError), e:
+                    connection.sendall('Could not write the pidfile: %s\n'
+                                       % e)
+                    return
+                self._pending[results_dir] = (pid_file_manager, time.time())
+                self._pool.apply_async(
+                        _parse_in_worker, (results_dir,),
+                        callback=lambda exit_code: self._parse_done(
+                                results_dir, pid_file_manager, exit_code))
+        finally:
+            self._lock.release()
+        connection.sendall('OK\n')
+
+
+    def _parse_done(self, results_dir, pid_file_manager, exit_code):
+        self._lock.acquire()
+        try:
+            # the parse may have been given up on, and the directory
+            # submitted again since
+            if self._pending.get(results_dir, (None,))[0] is not (
+                    pid_file_manager):
+                tko_utils.dprint('Parsed %s after it was given up on' %
+                                 results_dir)
+                return
+            del self._pending[results_dir]
+            pending = len(self._pending)
+        finally:
+            self._lock.release()
+        pid_file_manager.close_file(exit_code)
+        tko_utils.dprint('Parsed %s, exit status %d, %d parses pending' %
+                         (results_dir, exit_code, pending))
+
+
+    def _close_overdue_parses(self, now):
+        """
+        Give up on the parses submitted more than the parse timeout ago,
+        most likely lost with a parser process that died.
+        """
+        if not self._parse_timeout_secs:
+            return
+        overdue = []
+        self._lock.acquire()
+        try:
+            for results_dir, (pid_file_manager, submit_time) in (
+                    self._pending.items()):
+                if now - submit_time >= self._parse_timeout_secs:
+                    del self._pending[results_dir]
+                    overdue.append((results_dir, pid_file_manager))
+        finally:
+            self._lock.release()
+        for results_dir, pid_file_manager in overdue:
+            tko_utils.dprint('Giving up on the parse of %s, submitted more '
+                             'than %d seconds ago' %
+                             (results_dir, self._parse_timeout_secs))
+            pid_file_manager.close_file(1)
+
+
+def parse_args():
+    parser = optparse.OptionParser(usage="%prog [options] socket_path")
+    parser.add_option("-m", help="Send mail for FAILED tests",
+                      dest="mailit", action="store_true")
+    parser.add_option("-l", help=("Levels of subdirectories to include "
+                                  "in the job name"),
+                      type="int", dest="level", default=2)
+    parser.add_option("-s", help="Database server hostname",
+                      dest="db_host", action="store")
+    parser.add_option("-u", help="Database username", dest="db_user",
+                      action="store")
+    parser.add_option("-p", help="Database password", dest="db_pass",
+                      action="store")
+    parser.add_option("-d", help="Database name", dest="db_name",
+                      action="store")
+    parser.add_option("-j", "--jobs",
+                      help="Number of processes parsing job directories in "
+                           "parallel, each with its own database connection",
+                      dest="jobs", type="int", default=4)
+    parser.add_option("--parse-timeout-mins",
+                      help="Minutes after which a submitted job that is not "
+                           "parsed yet is reported as failed, in case its "
+                           "parser process died. 0 waits forever",
+                      dest="parse_timeout_mins", type="int", default=360)
+    # the scheduler reparses the jobs it submits, like FinalReparseTask
+    parser.set_defaults(reparse=True, noblock=False, full_reparse=False)
+    options, args = parser.parse_args()
+
+    if options.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if len(args) != 1:
+        parser.error("the path of the socket to listen on must be provided")
+    return options, args[0]
+
+
+def main():
+    options, socket_path = parse_args()
+    # exit through the finally clauses of serve() to clean up
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(1))
+    ParseDaemon(socket_path, options).serve()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+#!/usr/bin/python
+
+import os, shutil, socket, StringIO, sys, tempfile, threading
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.test_utils import mock, unittest
+from autotest.tko import parse_daemon
+
+
+class _FakePool(object):
+    def __init__(self):
+        self.submitted = []
+
+
+    def apply_async(self, function, args, callback):
+        self.submitted.append((function, args, callback))
+
+
+class SubmitTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.tmpdir, 'socket')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def _serve_once(self, reply):
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(1)
+        self.requests = []
+        def serve():
+            connection, _ = listener.accept()
+            self.requests.append(parse_daemon._read_line(connection))
+            connection.sendall(reply)
+            connection.close()
+            listener.close()
+        thread = threading.Thread(target=serve)
+        thread.start()
+        return thread
+
+
+    def test_submit(self):
+        thread = self._serve_once('OK\n')
+        parse_daemon.submit(self.socket_path, '/results/1-user/host1')
+        thread.join()
+        self.assertEquals(self.requests, ['/results/1-user/host1'])
+
+
+    def test_refused(self):
+        thread = self._serve_once('No such results directory\n')
+        self.assertRaises(parse_daemon.SubmitError, parse_daemon.submit,
+                          self.socket_path, '/results/1-user/host1')
+        thread.join()
+
+
+    def test_no_daemon(self):
+        self.assertRaises(parse_daemon.SubmitError, parse_daemon.submit,
+                          self.socket_path, '/results/1-user/host1')
+
+
+    def test_invalid_results_dir(self):
+        self.assertRaises(parse_daemon.SubmitError, parse_daemon.submit,
+                          self.socket_path, '/results/1-user\nhost1')
+
+
+class ParseInWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.results_dir = tempfile.mkdtemp()
+        self.log_path = os.path.join(self.results_dir,
+                                     parse_daemon._PARSE_LOG_FILE)
+        self.stderr = sys.stderr
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        sys.stderr = self.stderr
+        shutil.rmtree(self.results_dir)
+
+
+    def test_parse(self):
+        self.god.stub_function(parse_daemon.parse, 'parse_job_dir_in_worker')
+        parse_daemon.parse.parse_job_dir_in_worker.expect_call(
+                self.results_dir)
+        self.assertEquals(parse_daemon._parse_in_worker(self.results_dir), 0)
+        self.god.check_playback()
+        self.assertEquals(sys.stderr, self.stderr)
+
+
+    def test_parse_failure_logged(self):
+        self.god.stub_function(parse_daemon.parse, 'parse_job_dir_in_worker')
+        parse_daemon.parse.parse_job_dir_in_worker.expect_call(
+                self.results_dir).and_raises(ValueError('bad status log'))
+        self.assertEquals(parse_daemon._parse_in_worker(self.results_dir), 1)
+        self.god.check_playback()
+        self.assertEquals(sys.stderr, self.stderr)
+        self.assert_('bad status log' in open(self.log_path).read())
+
+
+    def test_unwritable_log(self):
+        os.mkdir(self.log_path)
+        sys.stderr = StringIO.StringIO()
+        self.assertEquals(parse_daemon._parse_in_worker(self.results_dir), 1)
+        self.assert_(self.log_path in sys.stderr.getvalue())
+
+
+class ParseDaemonTest(unittest.TestCase):
+    def setUp(self):
+        self.results_dir = tempfile.mkdtemp()
+        self.daemon = parse_daemon.ParseDaemon('socket', None)
+        self.pool = self.daemon._pool = _FakePool()
+
+
+    def tearDown(self):
+        shutil.rmtree(self.results_dir)
+
+
+    def _submit(self, results_dir):
+        client, server = socket.socketpair()
+        try:
+            client.sendall(results_dir + '\n')
+            self.daemon._handle_connection(server)
+            return parse_daemon._read_line(client)
+        finally:
+            client.close()
+            server.close()
+
+
+    def _read_pidfile(self):
+        return open(os.path.join(self.results_dir,
+                                 '.parser_execute')).read().splitlines()
+
+
+    def test_pidfile_follows_the_parse(self):
+        self.assertEquals(self._submit(self.results_dir), 'OK')
+        self.assertEquals(self._read_pidfile(), [str(os.getpid())])
+
+        (function, args, callback), = self.pool.submitted
+        self.assertEquals(args, (self.results_dir,))
+        callback(1)
+        self.assertEquals(self._read_pidfile(),
+                          [str(os.getpid()), str(1 << 8), '0'])
+
+
+    def test_pending_directory_is_parsed_once(self):
+        self._submit(self.results_dir)
+        self.assertEquals(self._submit(self.results_dir), 'OK')
+        self.assertEquals(len(self.pool.submitted), 1)
+
+        self.pool.submitted[0][2](0)
+        self._submit(self.results_dir)
+        self.assertEquals(len(self.pool.submitted), 2)
+
+
+    def test_failed_parse_completes_the_pidfile(self):
+        self._submit(self.results_dir)
+        os.mkdir(os.path.join(self.results_dir, parse_daemon._PARSE_LOG_FILE))
+        stderr = sys.stderr
+        sys.stderr = StringIO.StringIO()
+        try:
+            (function, args, callback), = self.pool.submitted
+            exit_code = function(*args)
+        finally:
+            sys.stderr = stderr
+        callback(exit_code)
+        self.assertEquals(self._read_pidfile(),
+                          [str(os.getpid()), str(1 << 8), '0'])
+        self.assertEquals(self.daemon._pending, {})
+
+
+    def test_unwritable_pidfile(self):
+        os.mkdir(os.path.join(self.results_dir, '.parser_execute'))
+        self.assertNotEqual(self._submit(self.results_dir), 'OK')
+        self.assertEquals(self.pool.submitted, [])
+        self.assertEquals(self.daemon._pending, {})
+
+
+    def test_overdue_parse_given_up_on(self):
+        self.daemon._parse_timeout_secs = 60
+        self._submit(self.results_dir)
+        (function, args, callback), = self.pool.submitted
+        submit_time = self.daemon._pending[self.results_dir][1]
+        self.daemon._close_overdue_parses(submit_time + 59)
+        self.assertEquals(len(self.daemon._pending), 1)
+
+        self.daemon._close_overdue_parses(submit_time + 60)
+        self.assertEquals(self.daemon._pending, {})
+        self.assertEquals(self._read_pidfile(),
+                          [str(os.getpid()), str(1 << 8), '0'])
+
+        # submitted again, the late callback of the lost parse is ignored
+        self._submit(self.results_dir)
+        callback(0)
+        self.assertEquals(len(self.daemon._pending), 1)
+        self.assertEquals(self._read_pidfile(), [str(os.getpid())])
+
+
+    def test_missing_directory(self):
+        self.assertNotEqual(self._submit(os.path.join(self.results_dir, 'x')),
+                            'OK')
+        self.assertEquals(self._submit('relative/path'),
+                          'No such results directory')
+        self.assertEquals(self.pool.submitted, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,403 @@
+#!/usr/bin/python
+
+import os, unittest, tempfile, shutil, json, base64, fcntl, multiprocessing
+
+try:
+    import autotest.common as common
+except ImportError:
+    import common
+from autotest.client.shared.test_utils import mock
+from autotest.tko import parse, db as tko_db, utils as tko_utils
+
+
+class StatusLogReaderTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'status.log')
+        self.append('line A\nline B\n')
+
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+
+    def append(self, data):
+        status_file = open(self.path, 'a')
+        status_file.write(data)
+        status_file.close()
+
+
+    def test_complete_lines(self):
+        reader = parse.StatusLogReader(open(self.path), chunk_size=4)
+        self.assertEqual(list(reader), ['line A\n', 'line B\n'])
+        self.assertEqual(reader.offset, 14)
+        self.assertEqual(reader.partial_line, '')
+
+
+    def test_resume_from_offset(self):
+        reader = parse.StatusLogReader(open(self.path), offset=7)
+        self.assertEqual(list(reader), ['line B\n'])
+
+
+    def test_partial_line_appended_between_reads(self):
+        self.append('l')
+        reader = parse.StatusLogReader(open(self.path))
+        lines = iter(reader)
+        self.assertEqual(lines.next(), 'line A\n')
+        # the writer completes the last line while we go through the others
+        self.append(' rest\nline C\n')
+        self.assertEqual(list(lines), ['line B\n'])
+        self.assertEqual(reader.partial_line, 'l')
+        self.assertEqual(reader.offset, 14)
+
+        # the next reader gets the whole line
+        reader = parse.StatusLogReader(open(self.path), offset=reader.offset)
+        self.assertEqual(list(reader), ['l rest\n', 'line C\n'])
+        self.assertEqual(reader.partial_line, '')
+
+
+class FakeDB(object):
+    """Keeps the test rows of a single job in memory."""
+    def __init__(self):
+        self.row_counts = dict.fromkeys(tko_db.ROW_COUNT_KEYS, 0)
+        self.job_idx = None
+        self.rows = {}
+        self.next_test_idx = 1
+        self.written_tests = []
+        self.deleted_test_idxs = []
+
+
+    def find_job(self, tag):
+        return self.job_idx
+
+
+    def select(self, fields, table, where):
+        return [(test_idx, subdir, testname)
+                for test_idx, (testname, subdir, status)
+                in sorted(self.rows.iteritems())]
+
+
+    def delete_tests(self, test_idxs):
+        for test_idx in test_idxs:
+            self.deleted_test_idxs.append(test_idx)
+            del self.rows[test_idx]
+
+
+    def insert_job(self, tag, job):
+        self.job_idx = 1
+        self.written_tests = []
+        for test in job.tests:
+            if not hasattr(test, 'test_idx'):
+                test.test_idx = self.next_test_idx
+                self.next_test_idx += 1
+            self.rows[test.test_idx] = (test.testname, test.subdir,
+                                        test.status)
+            self.written_tests.append((test.test_idx, test.testname,
+                                       test.status))
+
+
+    def commit(self):
+        pass
+
+
+class ResumedParseTest(unittest.TestCase):
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.status_log = os.path.join(self.job_dir, 'status.log')
+        keyval = open(os.path.join(self.job_dir, 'keyval'), 'w')
+        keyval.write('status_version=1\n')
+        keyval.close()
+        self.lines = ['START\t----\t----\ttimestamp=1000\n']
+        for index in xrange(3):
+            test = 'test%d' % index
+            self.lines += [
+                    '\tSTART\t%s\t%s\ttimestamp=1001\n' % (test, test),
+                    '\t\tGOOD\t%s\t%s\ttimestamp=1002\tdone\n' % (test, test),
+                    '\tEND GOOD\t%s\t%s\ttimestamp=1003\n' % (test, test)]
+        self.lines.append('END GOOD\t----\t----\ttimestamp=1004\n')
+        self.god = mock.mock_god()
+        self.god.stub_with(tko_utils, 'dprint', lambda message: None)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.job_dir)
+
+
+    def append(self, lines):
+        status_file = open(self.status_log, 'a')
+        status_file.write(''.join(lines))
+        status_file.close()
+
+
+    def parse(self, db, resume=True):
+        parse.parse_one(db, 'job', self.job_dir, True, False, resume)
+
+
+    def load_state(self):
+        return parse._load_parse_state(self.job_dir, self.status_log, 1)
+
+
+    def start_job(self):
+        """Parse the job while its second test is running."""
+        self.append(self.lines[:5])
+        db = FakeDB()
+        self.parse(db)
+        return db
+
+
+    def test_state_round_trip(self):
+        self.start_job()
+        state = self.load_state()
+        self.assertEqual(state['offset'], len(''.join(self.lines[:5])))
+        checkpoint, tests = state['snapshot']
+        testnames = [test.testname for test in tests]
+        self.assertTrue('test0' in testnames)
+        self.assertTrue('test1' in testnames)
+        self.assertFalse('test2' in testnames)
+
+
+    def test_replaced_status_log(self):
+        self.start_job()
+        new_log = self.status_log + '.new'
+        new_log_file = open(new_log, 'w')
+        new_log_file.write(''.join(self.lines[:5]))
+        new_log_file.close()
+        os.rename(new_log, self.status_log)
+        self.assertEqual(self.load_state(), None)
+
+
+    def test_status_log_rewritten_in_place(self):
+        self.start_job()
+        status_file = open(self.status_log, 'r+')
+        status_file.write('END')
+        status_file.close()
+        self.assertEqual(self.load_state(), None)
+
+
+    def test_status_log_truncated(self):
+        self.start_job()
+        status_file = open(self.status_log, 'r+')
+        status_file.truncate(10)
+        status_file.close()
+        self.assertEqual(self.load_state(), None)
+
+
+    def test_unreadable_state(self):
+        self.start_job()
+        state_file = open(os.path.join(self.job_dir, parse.PARSE_STATE_FILE),
+                          'w')
+        state_file.write('[1, 2')
+        state_file.close()
+        self.assertEqual(self.load_state(), None)
+
+
+    def test_snapshot_does_not_run_code(self):
+        self.start_job()
+        state_path = os.path.join(self.job_dir, parse.PARSE_STATE_FILE)
+        state = json.load(open(state_path))
+        marker = os.path.join(self.job_dir, 'marker')
+        state['snapshot'] = base64.b64encode(
+                "cos\nsystem\n(S'touch %s'\ntR." % marker)
+        state_file = open(state_path, 'w')
+        json.dump(state, state_file)
+        state_file.close()
+
+        self.assertEqual(self.load_state(), None)
+        self.assertFalse(os.path.exists(marker))
+
+
+    def test_resumed_parse_writes_only_new_tests(self):
+        db = self.start_job()
+        old_rows = dict(db.rows)
+        old_test_idxs = dict(((testname, status), test_idx)
+                             for test_idx, (testname, subdir, status)
+                             in old_rows.iteritems())
+        self.append(self.lines[5:])
+        self.parse(db)
+
+        # the finished test is not written again, the running one is
+        # updated in place
+        written = [(testname, status)
+                   for test_idx, testname, status in db.written_tests]
+        self.assertFalse(('test0', 'GOOD') in written)
+        self.assertTrue(('test1', 'GOOD') in written)
+        self.assertTrue(('test2', 'GOOD') in written)
+        self.assertTrue((old_test_idxs[('test1', 'ABORT')], 'test1', 'GOOD')
+                        in db.written_tests)
+        self.assertEqual(db.rows[old_test_idxs[('test0', 'GOOD')]],
+                         old_rows[old_test_idxs[('test0', 'GOOD')]])
+
+        # the rows end() made up for the running groups are gone, and the
+        # job ends up with the rows of a full parse
+        self.assertTrue(db.deleted_test_idxs)
+        for test_idx in db.deleted_test_idxs:
+            self.assertTrue(test_idx in old_rows)
+            self.assertFalse(test_idx in db.rows)
+        full_db = FakeDB()
+        self.parse(full_db, resume=False)
+        self.assertEqual(sorted(db.rows.values()),
+                         sorted(full_db.rows.values()))
+
+
+class ProgressReporterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 100.0
+        self.messages = []
+        self.god = mock.mock_god()
+        self.god.stub_with(tko_utils, 'dprint', self.messages.append)
+        self.progress = parse.ProgressReporter(4, interval=10,
+                                               time_func=lambda: self.now)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+
+
+    def job_dir_done(self, seconds, parsed=True):
+        self.now += seconds
+        self.progress.job_dir_done(parsed)
+
+
+    def test_counts(self):
+        self.job_dir_done(1)
+        self.job_dir_done(1, parsed=False)
+        self.assertEqual(self.progress.done, 2)
+        self.assertEqual(self.progress.skipped, 1)
+        self.assertEqual(self.progress.get_message(104.0),
+                         'Parsed 2/4 job directories (1 skipped as locked) '
+                         'in 4s, 0.50/s')
+
+
+    def test_reports_throttled(self):
+        self.job_dir_done(1)
+        self.job_dir_done(5)
+        self.assertEqual(self.messages, [])
+        self.job_dir_done(5)
+        self.assertEqual(len(self.messages), 1)
+        self.assertTrue(self.messages[0].startswith('Parsed 3/4 '))
+        # the last directory is always reported
+        self.job_dir_done(1)
+        self.assertEqual(len(self.messages), 2)
+        self.assertTrue(self.messages[1].startswith('Parsed 4/4 '))
+
+
+    def test_add_row_counts(self):
+        self.progress.add_row_counts({'unchanged': 1, 'updated': 2,
+                                      'inserted': 3, 'deleted': 4})
+        self.progress.add_row_counts({'unchanged': 10, 'updated': 0,
+                                      'inserted': 0, 'deleted': 1})
+        self.assertEqual(self.progress.row_counts,
+                         {'unchanged': 11, 'updated': 2, 'inserted': 3,
+                          'deleted': 5})
+
+
+class Options(object):
+    def __init__(self, **dargs):
+        self.noblock = False
+        self.level = 0
+        self.reparse = True
+        self.mailit = False
+        self.full_reparse = False
+        self.jobs = 2
+        self.__dict__.update(dargs)
+
+
+class ParseJobDirTest(unittest.TestCase):
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.god = mock.mock_god()
+        self.god.stub_function(parse, 'parse_path')
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+        shutil.rmtree(self.job_dir)
+
+
+    def test_parse(self):
+        parse.parse_path.expect_call('db', self.job_dir, 0, True, False, True)
+        self.assertTrue(parse.parse_job_dir('db', self.job_dir, Options()))
+        self.god.check_playback()
+
+
+    def test_noblock_skips_locked_dir(self):
+        lockfile = open(os.path.join(self.job_dir, '.parse.lock'), 'w')
+        try:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            self.assertFalse(parse.parse_job_dir('db', self.job_dir,
+                                                 Options(noblock=True)))
+        finally:
+            lockfile.close()
+        # parse_path() was not called
+        self.god.check_playback()
+
+
+class RowCountDB(object):
+    def __init__(self):
+        self.row_counts = dict.fromkeys(tko_db.ROW_COUNT_KEYS, 0)
+
+
+class FakePool(object):
+    """Runs the work of a multiprocessing.Pool in the calling process."""
+    def __init__(self, processes, initializer, initargs):
+        initializer(*initargs)
+
+
+    def imap_unordered(self, function, iterable, chunksize):
+        return (function(item) for item in iterable)
+
+
+    def close(self):
+        pass
+
+
+    def join(self):
+        pass
+
+
+class WorkerRowCountsTest(unittest.TestCase):
+    def setUp(self):
+        self.god = mock.mock_god()
+        self.god.stub_with(parse, '_open_db', lambda options: RowCountDB())
+        self.god.stub_with(parse, 'parse_job_dir', self.parse_job_dir)
+        self.god.stub_with(multiprocessing, 'Pool', FakePool)
+        self.god.stub_with(tko_utils, 'dprint', lambda message: None)
+        self.god.stub_with(parse, '_worker_db', None)
+        self.god.stub_with(parse, '_worker_options', None)
+
+
+    def tearDown(self):
+        self.god.unstub_all()
+
+
+    def parse_job_dir(self, db, path, options):
+        # each job writes as many rows as the length of its name
+        db.row_counts['inserted'] += len(path)
+        db.row_counts['unchanged'] += 1
+        return path != 'locked'
+
+
+    def test_worker_row_counts_reset(self):
+        parse.init_worker(Options())
+        self.assertEqual(parse.parse_job_dir_in_worker('job'),
+                         (True, {'unchanged': 1, 'updated': 0,
+                                 'inserted': 3, 'deleted': 0}))
+        self.assertEqual(parse.parse_job_dir_in_worker('locked'),
+                         (False, {'unchanged': 1, 'updated': 0,
+                                  'inserted': 6, 'deleted': 0}))
+
+
+    def test_row_counts_aggregated(self):
+        progress = parse.ProgressReporter(3)
+        parse._parse_job_dirs_in_parallel(['a', 'bb', 'locked'], Options(),
+                                          progress)
+        self.assertEqual(progress.row_counts,
+                         {'unchanged': 3, 'updated': 0, 'inserted': 9,
+                          'deleted': 0})
+        self.assertEqual(progress.done, 3)
+        self.assertEqual(progress.skipped, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
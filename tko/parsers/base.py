@@ -1,4 +1,4 @@
-import traceback
+import itertools, traceback
 
 from autotest.tko import status_lib, utils as tko_utils
 
@@ -9,24 +9,59 @@ class parser(object):
     standard parser interfaction functions. The derived classes must
     implement a state_iterator method for this class to be useful.
     """
-    def start(self, job):
+    def start(self, job, checkpoint=None):
         """ Initialize the parser for processing the results of
-        'job'."""
+        'job'. If 'checkpoint' is given, it must come from the
+        get_checkpoint() method of a parser of the same version, and
+        parsing resumes from the state the parser was in at the time."""
         # initialize all the basic parser parameters
         self.job = job
         self.finished = False
         self.line_buffer = status_lib.line_buffer()
+        self.resume_from = checkpoint
         # create and prime the parser state machine
         self.state = self.state_iterator(self.line_buffer)
         self.state.next()
 
 
+    # maximum number of lines queued in the line buffer at a time, so that
+    # memory usage does not depend on the size of the status log
+    max_buffered_lines = 1000
+
+
+    def _run_state_machine(self, lines, finish=False):
+        """ Feed 'lines', which may be any iterable, into the parser
+        state machine a batch at a time, then signal the end of the
+        lines if 'finish' is set. Return a list of all the new test
+        results produced. Tests updated several times are only listed
+        once, so that the list does not grow with every line."""
+        new_tests = []
+        already_added = set()
+        def add_tests(tests):
+            for test in tests:
+                if test not in already_added:
+                    already_added.add(test)
+                    new_tests.append(test)
+
+        lines = iter(lines)
+        while True:
+            batch = list(itertools.islice(lines, self.max_buffered_lines))
+            if not batch:
+                break
+            self.line_buffer.put_multiple(batch)
+            add_tests(self.state.next())
+        if finish:
+            # run the state machine to clear out the buffer
+            self.finished = True
+            add_tests(self.state.next())
+        return new_tests
+
+
     def process_lines(self, lines):
         """ Feed 'lines' into the parser state machine, and return
         a list of all the new test results produced."""
-        self.line_buffer.put_multiple(lines)
         try:
-            return self.state.next()
+            return self._run_state_machine(lines)
         except StopIteration:
             msg = ("WARNING: parser was called to process status "
                    "lines after it was end()ed\n"
@@ -42,11 +77,8 @@ class parser(object):
         """ Feed 'lines' into the parser state machine, signal to the
         state machine that no more lines are forthcoming, and then
         return a list of all the new test results produced."""
-        self.line_buffer.put_multiple(lines)
-        # run the state machine to clear out the buffer
-        self.finished = True
         try:
-            return self.state.next()
+            return self._run_state_machine(lines, finish=True)
         except StopIteration:
             msg = ("WARNING: parser was end()ed multiple times\n"
                    "Current traceback:\n" +
@@ -57,6 +89,15 @@ class parser(object):
             return []
 
 
+    def get_checkpoint(self):
+        """ Return a picklable snapshot of the parser state machine as
+        of the last process_lines() call, which start() can resume from,
+        or None if the parser does not support it. The snapshot shares
+        objects with the parser, so it must be pickled before any more
+        lines are processed."""
+        return None
+
+
     @staticmethod
     def make_job(dir):
         """ Create a new instance of the job model used by the
@@ -4,6 +4,10 @@ from autotest.tko import models, status_lib, utils as tko_utils
 from autotest.tko.parsers import base, version_0
 
 
+# an iteration keyval line, key{type}=value or an untyped key=value
+_ITERATION_KEYVAL_RE = re.compile(r"^([^=]*?)(?:\{(\w*)\})?=(.*)$")
+
+
 class job(version_0.job):
     def exit_status(self):
         # find the .autoserv_execute path
@@ -56,18 +60,14 @@ class test(models.test):
 class iteration(models.iteration):
     @staticmethod
     def parse_line_into_dicts(line, attr_dict, perf_dict):
-        key, val_type, value = "", "", ""
-
-        # figure out what the key, value and keyval type are
-        typed_match = re.search("^([^=]*)\{(\w*)\}=(.*)$", line)
-        if typed_match:
-            key, val_type, value = typed_match.groups()
-        else:
-            # old-fashioned untyped match, assume perf
-            untyped_match = re.search("^([^=]*)=(.*)$", line)
-            if untyped_match:
-                key, value = untyped_match.groups()
+        # key{type}=value, or the old-fashioned untyped key=value for perf
+        match = _ITERATION_KEYVAL_RE.match(line)
+        if match:
+            key, val_type, value = match.groups()
+            if val_type is None:
                 val_type = "perf"
+        else:
+            key, val_type, value = "", "", ""
 
         # parse the actual value into a dict
         try:
@@ -169,26 +169,40 @@ class parser(base.parser):
         line_buffer.put_back(abort)
 
 
+    def get_checkpoint(self):
+        return self._checkpoint
+
+
     def state_iterator(self, buffer):
-        line = None
         new_tests = []
-        job_count, boot_count = 0, 0
-        min_stack_size = 0
-        stack = status_lib.status_stack()
-        current_kernel = kernel("", [])  # UNKNOWN
-        current_status = status_lib.statuses[-1]
-        current_reason = None
-        started_time_stack = [None]
-        subdir_stack = [None]
-        running_test = None
-        running_reasons = set()
-        yield []   # we're ready to start running
-
-        # create a RUNNING SERVER_JOB entry to represent the entire test
-        running_job = test.parse_partial_test(self.job, "----", "SERVER_JOB",
-                                              "", current_kernel,
-                                              self.job.started_time)
-        new_tests.append(running_job)
+        self._checkpoint = self.resume_from
+        if self.resume_from:
+            (line, job_count, boot_count, min_stack_size, stack,
+             current_kernel, current_status, current_reason,
+             started_time_stack, subdir_stack, running_test, running_reasons,
+             running_job, running_client) = self.resume_from
+            yield []   # we're ready to start running
+        else:
+            line = None
+            job_count, boot_count = 0, 0
+            min_stack_size = 0
+            stack = status_lib.status_stack()
+            current_kernel = kernel("", [])  # UNKNOWN
+            current_status = status_lib.statuses[-1]
+            current_reason = None
+            started_time_stack = [None]
+            subdir_stack = [None]
+            running_test = None
+            running_reasons = set()
+            running_client = None
+            yield []   # we're ready to start running
+
+            # create a RUNNING SERVER_JOB entry to represent the entire test
+            running_job = test.parse_partial_test(self.job, "----",
+                                                  "SERVER_JOB", "",
+                                                  current_kernel,
+                                                  self.job.started_time)
+            new_tests.append(running_job)
 
         while True:
             # are we finished with parsing?
@@ -218,6 +232,14 @@ class parser(base.parser):
 
             # stop processing once the buffer is empty
             if buffer.size() == 0:
+                if not self.finished:
+                    # everything the loop needs to pick up from here
+                    self._checkpoint = (
+                            line, job_count, boot_count, min_stack_size,
+                            stack, current_kernel, current_status,
+                            current_reason, started_time_stack, subdir_stack,
+                            running_test, running_reasons, running_job,
+                            running_client)
                 yield new_tests
                 new_tests = []
                 continue
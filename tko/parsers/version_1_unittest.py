@@ -1,12 +1,13 @@
 #!/usr/bin/python
 
-import unittest, datetime, time
+import unittest, datetime, time, os, pickle, resource, shutil, sys, tempfile
 
 try:
     import autotest.common as common
 except ImportError:
     import common
 from autotest.client.shared import utils
+from autotest.tko import utils as tko_utils
 from autotest.tko.parsers import version_1
 
 
@@ -245,6 +246,16 @@ class iteration_parse_line_into_dicts(unittest.TestCase):
         self.assertEqual(({}, {}), result)
 
 
+    def test_braces_in_untagged_key(self):
+        result = self.parse_line("key{not-a-tag}=1")
+        self.assertEqual(({}, {"key{not-a-tag}": 1}), result)
+
+
+    def test_value_with_equals(self):
+        result = self.parse_line("attr-val{attr}=a=b")
+        self.assertEqual(({"attr-val": "a=b"}, {}), result)
+
+
 class DummyAbortTestCase(unittest.TestCase):
     def setUp(self):
         self.indent = 3
@@ -269,5 +280,125 @@ class DummyAbortTestCase(unittest.TestCase):
             '\t'*self.indent, self.testname, self.reason))
 
 
+class CheckpointTestCase(unittest.TestCase):
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.lines = ["START\t----\t----\ttimestamp=1000\n"]
+        for index in xrange(4):
+            test = "test%d" % index
+            self.lines += [
+                "\tSTART\t%s\t%s\ttimestamp=1001\n" % (test, test),
+                "\t\tGOOD\t%s\t%s\ttimestamp=1002\tdone\n" % (test, test),
+                "\tEND GOOD\t%s\t%s\ttimestamp=1003\n" % (test, test)]
+        self.lines.append("END GOOD\t----\t----\ttimestamp=1004\n")
+
+
+    def tearDown(self):
+        shutil.rmtree(self.job_dir)
+
+
+    def _start(self, checkpoint=None):
+        parser = version_1.parser()
+        parser.start(version_1.parser.make_job(self.job_dir), checkpoint)
+        return parser
+
+
+    def _summarize(self, tests):
+        summary = []
+        for test in tests:
+            test_summary = (test.testname, test.subdir, test.status,
+                            test.reason)
+            if test_summary not in summary:
+                summary.append(test_summary)
+        return summary
+
+
+    def test_resume_from_checkpoint(self):
+        parser = self._start()
+        expected = self._summarize(parser.end(self.lines))
+
+        for split in xrange(len(self.lines)):
+            parser = self._start()
+            tests = parser.process_lines(self.lines[:split])
+            checkpoint, tests = pickle.loads(
+                    pickle.dumps((parser.get_checkpoint(), tests)))
+            parser = self._start(checkpoint)
+            tests += parser.end(self.lines[split:])
+            self.assertEquals(self._summarize(tests), expected)
+
+
+    def test_base_parser_has_no_checkpoint(self):
+        parser = version_1.version_0.parser()
+        parser.start(version_1.parser.make_job(self.job_dir))
+        self.assertEquals(parser.get_checkpoint(), None)
+
+
+class HugeStatusLogTestCase(unittest.TestCase):
+    # a few MB of status lines, generated as they are parsed
+    NUM_LINES = 100000
+    MAX_RSS_GROWTH_KB = 4 * 1024
+
+
+    def setUp(self):
+        self.job_dir = tempfile.mkdtemp()
+        self.parser = version_1.parser()
+        self.parser.start(version_1.parser.make_job(self.job_dir))
+        self.buffer_sizes = []
+        self.rss_samples = []
+        line_buffer = self.parser.line_buffer
+        put_multiple = line_buffer.put_multiple
+        def recording_put_multiple(lines):
+            put_multiple(lines)
+            self.buffer_sizes.append(line_buffer.size())
+            self.rss_samples.append(self._get_rss_kb())
+        line_buffer.put_multiple = recording_put_multiple
+        # the parser logs every line it goes through
+        self.devnull = open(os.devnull, "w")
+        tko_utils.redirect_parser_debugging(self.devnull)
+
+
+    def tearDown(self):
+        tko_utils.redirect_parser_debugging(sys.stdout)
+        self.devnull.close()
+        shutil.rmtree(self.job_dir)
+
+
+    def _get_rss_kb(self):
+        try:
+            pages = int(open("/proc/self/statm").read().split()[1])
+        except (IOError, IndexError, ValueError):
+            return None
+        return pages * resource.getpagesize() / 1024
+
+
+    def _generate_lines(self):
+        yield "START\t----\t----\ttimestamp=1000\n"
+        yield "\tSTART\tstress\tstress\ttimestamp=1001\n"
+        for index in xrange(self.NUM_LINES):
+            yield ("\t\tINFO\t----\t----\titeration %d of a long stress "
+                   "run\n" % index)
+        yield "\tEND GOOD\tstress\tstress\ttimestamp=1002\n"
+        yield "END GOOD\t----\t----\ttimestamp=1003\n"
+
+
+    def test_line_buffer_is_bounded(self):
+        tests = self.parser.end(self._generate_lines())
+        self.assertEquals([test.testname for test in tests],
+                          ["SERVER_JOB", "CLIENT_JOB.0", "stress"])
+        self.assert_(len(self.buffer_sizes) > 1)
+        self.assert_(max(self.buffer_sizes) <=
+                     self.parser.max_buffered_lines)
+
+
+    def test_memory_does_not_grow_with_log_size(self):
+        rss_before = self._get_rss_kb()
+        if rss_before is None:
+            return # no way to measure it on this platform
+        self.parser.process_lines(self._generate_lines())
+        rss_growth = max(self.rss_samples) - rss_before
+        self.assert_(rss_growth < self.MAX_RSS_GROWTH_KB,
+                     "parsing grew the resident set by %d KB" % rss_growth)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -35,6 +35,7 @@ def get_data_files():
                                     tko_dir + '/draw_graphs',
                                     tko_dir + '/machine_load',
                                     tko_dir + '/parse',
+                                    tko_dir + '/parse_daemon',
                                     tko_dir + '/plotgraph',
                                     tko_dir + '/retrieve_jobs',
                                     tko_dir + '/tko.proto'])]
@@ -42,6 +43,8 @@ def get_data_files():
 
 def get_scripts():
     return [tko_dir + '/autotest-db-delete-job',
+            tko_dir + '/autotest-tko-load-serialized',
+            tko_dir + '/autotest-tko-pack-iterations',
             tko_dir + '/autotest-tko-parse']
 
 
@@ -1,5 +1,7 @@
 import os, sys, datetime, re
 
+from autotest.client.shared import utils as client_utils
+
 
 _debug_logger = sys.stderr
 def dprint(msg):
@@ -11,6 +13,52 @@ def redirect_parser_debugging(ostream):
     _debug_logger = ostream
 
 
+# the parsed keyval files, (path, parser) -> (file signature, contents)
+_keyval_cache = {}
+# the cache is dropped when it grows past this many files, so a long running
+# parser does not keep every keyval it ever read
+_KEYVAL_CACHE_SIZE = 4096
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime, stat.st_size, stat.st_ino
+
+
+def cached_parse(path, parser):
+    """ Return parser(path), parsing each file once per process rather than
+    every time it is asked for, unless the file changed since.
+
+    @param path - the path of the file to parse
+    @param parser - a function taking the path and returning its contents
+
+    @return - the parsed contents, which are shared by all the callers and
+    must not be modified
+    """
+    try:
+        signature = _file_signature(path)
+    except OSError:
+        return parser(path)
+    key = (path, parser)
+    cached = _keyval_cache.get(key)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    contents = parser(path)
+    if len(_keyval_cache) >= _KEYVAL_CACHE_SIZE:
+        _keyval_cache.clear()
+    _keyval_cache[key] = (signature, contents)
+    return contents
+
+
+def read_keyval(path):
+    """ Read a keyval file like client utils.read_keyval() does, through
+    the cache of the parsed keyval files. The keyval returned is a copy the
+    caller is free to modify. """
+    if os.path.isdir(path):
+        path = os.path.join(path, 'keyval')
+    return dict(cached_parse(path, client_utils.read_keyval))
+
+
 def get_timestamp(mapping, field):
     val = mapping.get(field, None)
     if val is not None:
@@ -1,6 +1,6 @@
 #!/usr/bin/python
 
-import os, unittest, time, datetime, itertools
+import os, unittest, time, datetime, itertools, tempfile, shutil
 
 try:
     import autotest.common as common
@@ -129,5 +129,61 @@ class drop_redundant_messages(unittest.TestCase):
                 set(["abcdef", "defghi"]))
 
 
+class read_keyval_test(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.keyval_path = os.path.join(self.tmpdir, "keyval")
+        self.write_keyval("a=1\nb=text\n")
+        self.parsed = []
+
+
+    def tearDown(self):
+        utils._keyval_cache.clear()
+        shutil.rmtree(self.tmpdir)
+
+
+    def write_keyval(self, contents):
+        keyval_file = open(self.keyval_path, "w")
+        keyval_file.write(contents)
+        keyval_file.close()
+
+
+    def parser(self, path):
+        self.parsed.append(path)
+        return open(path).read()
+
+
+    def test_file_parsed_once(self):
+        self.assertEqual(utils.cached_parse(self.keyval_path, self.parser),
+                         "a=1\nb=text\n")
+        self.assertEqual(utils.cached_parse(self.keyval_path, self.parser),
+                         "a=1\nb=text\n")
+        self.assertEqual(self.parsed, [self.keyval_path])
+
+
+    def test_changed_file_parsed_again(self):
+        utils.cached_parse(self.keyval_path, self.parser)
+        self.write_keyval("a=2\n")
+        os.utime(self.keyval_path, (0, 0))
+        self.assertEqual(utils.cached_parse(self.keyval_path, self.parser),
+                         "a=2\n")
+        self.assertEqual(self.parsed, [self.keyval_path] * 2)
+
+
+    def test_missing_file_not_cached(self):
+        missing_path = os.path.join(self.tmpdir, "missing")
+        self.assertRaises(IOError, utils.cached_parse, missing_path,
+                          self.parser)
+        self.assertEqual(utils._keyval_cache, {})
+
+
+    def test_read_keyval_returns_copies(self):
+        keyval = utils.read_keyval(self.tmpdir)
+        self.assertEqual(keyval, {"a": 1, "b": "text"})
+        del keyval["a"]
+        self.assertEqual(utils.read_keyval(self.keyval_path),
+                         {"a": 1, "b": "text"})
+
+
 if __name__ == "__main__":
     unittest.main()
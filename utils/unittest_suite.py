@@ -146,6 +146,7 @@ REQUIRES_DJANGO = set((
         'models_unittest.py',
         'scheduler_models_unittest.py',
         'metahost_scheduler_unittest.py',
+        'scheduler_benchmark_unittest.py',
         'site_metahost_scheduler_unittest.py',
         'rpc_utils_unittest.py',
         'site_rpc_utils_unittest.py',